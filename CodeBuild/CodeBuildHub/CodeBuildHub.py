@@ -2,7 +2,7 @@ import boto3
 import os
 import json
 import datetime
-import http.client
+import time
 import logging
 from urllib.parse import unquote
 
@@ -31,80 +31,101 @@ XRay = os.getenv('XRay_Enabled', "False")
 if XRay == "False":
     xray_enabled = False
 
-try:
-    import pymysql
-    from pymysql import MySQLError
-    MySQLEnabled = True
-except:
-    MySQLEnabled = False
-    logging.info("Pymysql not found!")
+# Código compartilhado dos hubs (cloudman_hub), disponível via PYTHONPATH
+from cloudman_hub import set_log_function, get_client
+from cloudman_hub.rds import RDSSink, connect_database, match_credentials, mysql_enabled
+from cloudman_hub.s3_source import read_s3_text
+from cloudman_hub.envelope import forward
+from cloudman_hub.metrics import get_hop_metrics, flush_metrics
+from cloudman_hub.codebuild import BuildCoalescer, coalescing_enabled, read_artifact
+from cloudman_hub.hubconfig import targets
+from cloudman_hub.batch import batch_item_failures
+from cloudman_hub.sinks import build_sinks, dispatch
+from cloudman_hub.xray import set_recorder, execute_with_xray
+set_log_function(logging.info)
+# As chamadas aos targets do código compartilhado ficam em subsegmentos quando o X-Ray está habilitado.
+set_recorder(xray_recorder if xray_enabled else None)
 
 # Cria um cliente para acessar os serviços AWS
 Region = os.getenv("Region")
 AccountID = os.getenv("Account")
-sqs = boto3.client('sqs', region_name=Region)
-dynamodb = boto3.resource('dynamodb', region_name=Region)
-lambda_client = boto3.client('lambda', region_name=Region)
-sns = boto3.client('sns', region_name=Region)
-s3 = boto3.client('s3')
+s3 = get_client('s3')
 CodeBuildName = os.getenv("Name")
+# "True" processa todos os records de eventos SQS/SNS/S3; "False" apenas o primeiro.
+BatchMode = os.getenv("BATCH_MODE", "True")
 
 
-def execute_with_xray(segment_name, function, *args, **kwargs):
+def read_record(record):
     """
-    Executa uma função dentro de um subsegmento do X-Ray se ele estiver habilitado.
-    :param segment_name: Nome do subsegmento do X-Ray.
-    :param function: Função a ser executada.
-    :param args: Argumentos posicionais para a função.
-    :param kwargs: Argumentos nomeados para a função.
-    :return: O resultado da função executada.
+    Extrai a mensagem de um record de um evento SNS, SQS ou S3.
+    :param record: Item de event['Records'].
+    :return: Tupla (EventSource, Message, Information) do record.
     """
-    '''if xray_enabled:
-        with xray_recorder.in_subsegment(segment_name):
-            return function(*args, **kwargs)
-    else:
-        return function(*args, **kwargs)'''
-    return function(*args, **kwargs)
-
-
-def main(event):
-    logging.info("Event: %s", event)
+    EventSource = record.get('eventSource') or record.get('EventSource')
     Information = "Source unknown!!"
     Message = "No Message!!"
-    try:
-        EventSource = event['Records'][0]['eventSource']
-    except:
-        EventSource = "API"
-    Subject = "None"
     if EventSource == "aws:sns":
-        SNSName = event['Records'][0]['Sns']['TopicArn'].split(":")[-1]
+        SNSName = record['Sns']['TopicArn'].split(":")[-1]
         EventSource += SNSName
-        Subject = event['Records'][0]['Sns']['Subject']
-        Message = event['Records'][0]['Sns']['Message']
+        Message = record['Sns']['Message']
         Information = "Message from SNS " + SNSName
     elif EventSource == "aws:sqs":
-        SQSName = event['Records'][0]['eventSourceARN'].split(":")[-1]
-        Message = event['Records'][0]['body']
+        SQSName = record['eventSourceARN'].split(":")[-1]
+        Message = record['body']
         Information = "Message from SQS " + SQSName
     elif EventSource == "aws:s3":
-        EventSource += event['Records'][0]['s3']["bucket"]['arn'].split(
+        EventSource += record['s3']["bucket"]['arn'].split(
             ":")[-1]
-        FileSize = str(event['Records'][0]['s3']['object']["size"])
-        bucket_name = event['Records'][0]['s3']['bucket']["name"]
-        file_path_encoded = event['Records'][0]['s3']['object']["key"]
+        FileSize = str(record['s3']['object']["size"])
+        bucket_name = record['s3']['bucket']["name"]
+        file_path_encoded = record['s3']['object']["key"]
         # Decodifica o nome do arquivo
         file_path = unquote(file_path_encoded).replace('+', ' ')
         Ext = file_path.split(".")[-1]
         logging.info("bucket_name: %s, file_path: %s", bucket_name, file_path)
-        # lê o conteúdo do arquivo
-        if Ext == "txt":
-            response = execute_with_xray(
-                bucket_name, s3.get_object, Bucket=bucket_name, Key=file_path)
-            Message = response['Body'].read().decode('utf-8')
+        # lê o conteúdo do arquivo (em blocos; arquivos grandes seguem por referência)
+        Inline = True
+        if Ext == "txt" or file_path.endswith(".txt.gz"):
+            Message, Inline = execute_with_xray(
+                bucket_name, read_s3_text, s3, bucket_name, file_path,
+                size=record['s3']['object'].get("size"),
+                etag=record['s3']['object'].get("eTag"))
         else:
             Message = "File is not .txt"
         Information = "File " + file_path + " from S3 bucket " + \
             bucket_name + ", with size of " + FileSize
+        if not Inline:
+            Information += ", forwarded by reference"
+    return EventSource, Message, Information
+
+
+def main(event):
+    # Momento do recebimento do evento, gravado em cada hop para as métricas de latência.
+    Received = time.time()
+    logging.info("Event: %s", event)
+    Information = "Source unknown!!"
+    Message = "No Message!!"
+    Records = event.get('Records') or []
+    try:
+        EventSource = Records[0].get('eventSource') or Records[0]['EventSource']
+    except:
+        EventSource = "API"
+    Subject = "None"
+    # Inputs guarda uma entrada (EventSource, Message, Information, RecordID) por mensagem.
+    Inputs = []
+    if EventSource in ("aws:sns", "aws:sqs", "aws:s3"):
+        # No modo batch todos os records são processados; caso contrário apenas o primeiro.
+        if BatchMode != "True":
+            Records = Records[:1]
+        for record in Records:
+            Inputs.append(read_record(record) + (record.get('messageId'),))
+        EventSource = Inputs[0][0] if len(Inputs) == 1 else EventSource
+    elif 'Coalesced' in event:
+        # Build iniciado por uma janela de coalescência: uma entrada por mensagem do artefato.
+        EventSource = "CodeBuild"
+        for CoalescedMessage in event['Coalesced']['Messages']:
+            Inputs.append((EventSource, CoalescedMessage,
+                           "Coalesced trigger of window " + str(event['Coalesced']['Window']), None))
     elif 'requestContext' in event and 'elb' in event['requestContext']:
         EventSource = "aws:elb"
         ALBName = event['requestContext']['elb']['targetGroupArn'].split(
@@ -115,10 +136,10 @@ def main(event):
         Subject = "None"
         try:
             Source = event["source"]
-            Message = str(event["message"])
+            Message = event["message"]
         except:
             Source = "API"
-            Message = str(event)
+            Message = event
         if Source == "aws:lambda":
             EventSource = "Lambda"
             Information = "Event from Lambda"
@@ -127,130 +148,41 @@ def main(event):
             EventSource = "EC2"
         else:
             Information = "Event from API"
+    if not Inputs:
+        Inputs.append((EventSource, Message, Information, None))
 
-    logging.info("Source of Event: %s", EventSource)
-    Agora = datetime.datetime.now()
+    logging.info("Source of Event: %s Records: %d", EventSource, len(Inputs))
     CodeBuildName = os.getenv("Name")
-    NewMessage = f"CodeBuild: {CodeBuildName}. Source: {EventSource}. Date/Time: {str(Agora)}. <- {Message}"
-    logging.info("Message to be sent: %s", NewMessage)
-
-    # *************************Bloco SQS**************************************
-    for i in range(SQSTargetMaxNumber):
-        message_body = NewMessage
-        logging.info("QueueTargetUrl[%d]: %s", i, QueueTargetUrl[i])
-        response = execute_with_xray(
-            SQSTargetName[i], sqs.send_message, QueueUrl=QueueTargetUrl[i], MessageBody=message_body)
-        logging.info('Mensagem SQS %d enviada com ID: %s',
-                     i, response['MessageId'])
-
-    # *************************Bloco DynamoDB**********************************
-    for i in range(DynamoDBTargetMaxNumber):
-        Table = TableNameTargetList[i][0]
-        TableName = TableNameTargetList[i][1]
-        get_item_response = execute_with_xray(
-            TableName, Table.get_item, Key={'ID': "1"})
-        item = get_item_response['Item']
-        cont = item['Cont'] + 1
-        execute_with_xray(TableName, Table.update_item, Key={'ID': "1"},
-                          UpdateExpression='SET Cont = :val1', ExpressionAttributeValues={':val1': cont})
-        ID = CodeBuildName + ":" + str(Agora)
-        put_item_response = execute_with_xray(TableName, Table.put_item, Item={
-                                              'ID': ID, "Message": NewMessage})
-        logging.info("DynamoDB response: %s", put_item_response)
-
-    # *************************Bloco SNS**********************************
-    for i in range(SNSTargetMaxNumber):
-        topic_arn = TopicTargetARN[i]
-        message = NewMessage
-        response = execute_with_xray(topic_arn, sns.publish, TopicArn=topic_arn,
-                                     Message=json.dumps({'default': json.dumps(message)}), MessageStructure='json')
-        logging.info("Response SNS: %s", response)
-
-    # *************************Bloco Lambda ********************
-    lambda_client = boto3.client('lambda')
-    for function_name in LambdaNameList:
-        response = execute_with_xray(function_name, lambda_client.invoke, FunctionName=function_name,
-                                     InvocationType='Event', Payload=json.dumps({"message": NewMessage, "source": "aws:lambda"}))
-        if response.get('StatusCode') == 202:
-            logging.info("Invoke lambda: %s", function_name)
-        else:
-            logging.error('Invocation error %s.', function_name)
-
-    # *************************Bloco S3**********************************
-    for i in range(S3TargetMaxNumber):
-        bucket_name = S3BucketTargetName[i]
-        folder_name = CodeBuildName + "/"
-        file_name = CodeBuildName + ":" + str(Agora) + ".txt"
-        file_content = NewMessage
-        file_path = folder_name + file_name
-        response = execute_with_xray(
-            bucket_name, s3.put_object, Bucket=bucket_name, Key=file_path, Body=file_content)
-        logging.info("Objeto inserido na bucket '%s'", bucket_name)
-
-    # *************************Bloco EFS **********************************
-    for efs_mount_path in EFSList:
-        # Escreva um arquivo de teste no EFS
-        file_name = CodeBuildName + ":" + str(Agora) + ".txt"
-        test_file_path = os.path.join(efs_mount_path, file_name)
-        with open(test_file_path, "w") as file:
-            file.write(NewMessage)
-
-    for connection, db_name in RDSConnections:
-        insert_query = "INSERT INTO exemplo (texto) VALUES (%s)"
-        try:
-            Data = json.dumps(NewMessage)
-            execute_query(connection, insert_query, (Data,))
-            logging.info(
-                "Item inserido na tabela 'exemplo' do banco de dados '%s'", db_name)
-        except MySQLError as e:
-            logging.error(
-                "Erro ao inserir item no banco de dados '%s': %s", db_name, e)
-
-    # *************************Bloco SSM Parameter **********************************
-    for Name, region in zip(SSMParameterTargetName, SSMParameterTargetRegion):
-        ssm_client = boto3.client('ssm', region_name=region)
-        try:
-            response = execute_with_xray(
-                Name, ssm_client.get_parameter, Name=Name, WithDecryption=True)
-            current_value = response['Parameter']['Value']
-            try:
-                int_value = int(current_value)
-                new_value = str(int_value + 1)
-            except ValueError:
-                new_value = '0'
-            execute_with_xray(Name, ssm_client.put_parameter, Name=Name,
-                              Value=new_value, Type='String', Overwrite=True)
-            logging.info("SSM Parameter %s updated: %s", Name, new_value)
-        except Exception as e:
-            logging.error(
-                "Erro ao processar o parâmetro %s na região %s: %s", Name, region, e)
-
-    # *************************Bloco EC2 **********************************
-    MessageJSON = json.dumps(NewMessage).encode('utf-8')
-    for DNS, EC2Name in zip(EC2TargetDNS, EC2TargetName):
-        try:
-            Path = f'/{EC2Name}'
-            Conn = http.client.HTTPConnection(DNS)
-            Headers = {'Content-type': 'application/json'}
-            Response = execute_with_xray(
-                EC2Name, Conn.request, "POST", Path, body=MessageJSON, headers=Headers)
-            Response = Conn.getresponse()
-            if Response.status == 200:
-                logging.info("Message sent with Success to %s.", EC2Name)
-            else:
-                logging.error("Message sent error to %s. Código: %d",
-                              EC2Name, Response.status)
-            Conn.close()
-        except Exception as e:
-            logging.error("Message sent error %s: %s", EC2Name, e)
-
-    # *************************Bloco CodeBuild ********************
-    codebuild = boto3.client('codebuild')
-    environment_variables = [
-        {'name': 'EVENT', 'value': NewMessage, 'type': 'PLAINTEXT'}]
-    for CodeBuildName in CodeBuildNameList:
-        response = execute_with_xray(CodeBuildName, codebuild.start_build, projectName=CodeBuildName,
-                                     environmentVariablesOverride=environment_variables)
+    # Messages guarda uma entrada (RecordID, NewMessage, Stamp) por mensagem a ser enviada.
+    Messages = []
+    for n, (RecordSource, Message, Information, RecordID) in enumerate(Inputs):
+        # O payload segue inalterado no envelope; este hub apenas se acrescenta à lista de hops.
+        Envelope, NewMessage = forward(Message, CodeBuildName, received=Received)
+        if NewMessage is None:
+            logging.info("Loop encontrado! %s %s", RecordID, Envelope.get("Hops"))
+            continue
+        get_hop_metrics().record(Envelope)
+        Agora = datetime.datetime.now()
+        # Stamp torna únicos os IDs do DynamoDB e os nomes de arquivo dentro de um batch.
+        Stamp = str(Agora) if len(Inputs) == 1 else f"{Agora}-{n}"
+        logging.info("Message to be sent: %s", NewMessage)
+        Messages.append((RecordID, NewMessage, Stamp))
+    if not Messages:
+        return
+
+    # Todos os targets são disparados em paralelo (ver cloudman_hub.sinks); cada sink retorna o RecordID
+    # das mensagens que não conseguiu entregar e o status e tempo de cada um ficam em FanOutResult.
+    FanOutResult, failed = dispatch(Sinks, Messages, CodeBuildName)
+    logging.info("Fan-out result: %s", json.dumps(FanOutResult))
+    # Duração, bytes e resultado de cada target foram registrados por dispatch; gravados com as latências dos hops.
+    flush_metrics()
+    NewMessage = Messages[-1][1]
+
+    # *************************Retorno SQS (batch parcial)**********************************
+    if EventSource.startswith("aws:sqs"):
+        if failed:
+            logging.error("Records com falha: %s", failed)
+        return batch_item_failures(failed)
 
     # *************************Retorno ALB **********************************
     if EventSource == "aws:elb":
@@ -269,343 +201,75 @@ def main(event):
     if EventSource == "API":
         return NewMessage
 
+    return FanOutResult
+
 
 # ***************************Resources Target***********************************
+# Os targets vêm da configuração pré-compilada do hub (HUB_CONFIG_FILE) quando ela acompanha
+# o projeto, senão das variáveis de ambiente aws_*_Target_*_{i} (ver cloudman_hub.hubconfig).
 
-# ****************Identifica a URL de cada SQS Target***************************
-SQSTargetMaxNumber = 0
-SQSTargetName = []
-QueueTargetUrl = []
-Name = ""
-i = 0
-while True:
-    Name = os.getenv(f"aws_sqs_queue_Target_Name_{str(i)}")
-    Region = os.getenv(f"aws_sqs_queue_Target_Region_{str(i)}")
-    SQSURL = os.getenv(f"aws_sqs_queue_Target_URL_{str(i)}")
-    if Name != None:
-        SQSTargetName.append(Name)
-        QueueTargetUrl.append(SQSURL)
-    else:
-        SQSTargetMaxNumber = i
-        break
-    i += 1
-logging.info("SQS Target Total: %d %s", i, SQSTargetName)
-
-# **********Identifica a ARN Target de cada SNS Target**************************
-SNSTargetMaxNumber = 0
-SNSTargetName = []
-TopicTargetARN = []
-i = 0
-while True:
-    Name = os.getenv(f"aws_sns_topic_Target_Name_{str(i)}")
-    Region = os.getenv(f"aws_sns_topic_Target_Region_{str(i)}")
-    Account = os.getenv(f"aws_sns_topic_Target_Account_{str(i)}")
-    if (Account):
-        pass
-    else:
-        Account = AccountID
-    if Name != None:
-        SNSTargetName.append(Name)
-        ARN = f"arn:aws:sns:{Region}:{Account}:{Name}"
-        TopicTargetARN.append(ARN)
-    else:
-        SNSTargetMaxNumber = i
-        break
-    i += 1
-logging.info("SNS Target Total: %d %s", i, SNSTargetName)
-
-# **************Inicializa cada tabela DynamoDB*********************************
-DynamoDBTargetMaxNumber = 0
-TableNameTargetList = []
-ListDynamo = []
-i = 0
-while True:
-    TableName = os.getenv(f"aws_dynamodb_table_Target_Name_{str(i)}")
-    Region = os.getenv(f"aws_dynamodb_table_Target_Region_{str(i)}")
-    Account = os.getenv(f"aws_dynamodb_table_Target_Account_{str(i)}")
-    if TableName != None:
-        TableNameTargetList.append([dynamodb.Table(TableName), TableName])
-        ListDynamo.append(TableName)
-        Table = TableNameTargetList[i][0]
-        response = Table.get_item(Key={'ID': "1"})
-        if 'Item' not in response:
-            Table.put_item(
-                Item={'ID': "1", "CodeBuildName": "Criado por " + CodeBuildName, 'Cont': 0})
-    else:
-        DynamoDBTargetMaxNumber = i
-        break
-    i += 1
-logging.info("DynamoDB Target Total: %d %s", i, ListDynamo)
-
-# *************Inicializa cada Lambda a ser invocada***************************
-LambdaMaxNumber = 0
-LambdaNameList = []
-i = 0
-while True:
-    Name = os.getenv(f"aws_lambda_function_Target_Name_{str(i)}")
-    Region = os.getenv(f"aws_lambda_function_Target_Region_{str(i)}")
-    Account = os.getenv(f"aws_lambda_function_Target_Account_{str(i)}")
-    if Name != None:
-        LambdaNameList.append(Name)
-        LambdaMaxNumber = i
-    else:
-        break
-    i += 1
-logging.info("Lambda Target Total: %d %s", i, LambdaNameList)
-
-# *************Inicializa cada CodeBuid target***************************
-CodeBuildMaxNumber = 0
-CodeBuildNameList = []
-i = 0
-while True:
-    Name = os.getenv(f"aws_codebuild_project_Target_Name_{str(i)}")
-    Region = os.getenv(f"aws_codebuild_project_Target_Region_{str(i)}")
-    Account = os.getenv(f"aws_codebuild_project_Target_Name_Account_{str(i)}")
-    if Name != None:
-        CodeBuildNameList.append(Name)
-        CodeBuildMaxNumber = i
-    else:
-        break
-    i += 1
-logging.info("CodeBuild Target Total: %d %s", i, CodeBuildNameList)
-
-# **********Identifica cada S3 target **************************
-S3TargetMaxNumber = 0
-S3BucketTargetName = []
-i = 0
-while True:
-    Name = os.getenv(f"aws_s3_bucket_Target_Name_{str(i)}")
-    Region = os.getenv(f"aws_s3_bucket_Target_Region_{str(i)}")
-    Account = os.getenv(f"aws_s3_bucket_Target_Account_{str(i)}")
-    if Name != None:
-        S3BucketTargetName.append(Name)
-    else:
-        S3TargetMaxNumber = i
-        break
-    i += 1
-logging.info("S3 Target Total: %d %s", i, S3BucketTargetName)
-
-# **********Identifica EC2 target **************************
-
-
-def find_ec2_dns_by_tag(tag_key, tag_value, region_name):
-    ec2 = boto3.client('ec2', region_name=region_name)
-    response = ec2.describe_instances(
-        Filters=[{'Name': f'tag:{tag_key}', 'Values': [tag_value]}])
-    public_dns = None
-    private_dns = None
-    for reservation in response['Reservations']:
-        for instance in reservation['Instances']:
-            if instance.get('PublicDnsName'):
-                public_dns = instance['PublicDnsName']
-            if instance.get('PrivateDnsName'):
-                private_dns = instance['PrivateDnsName']
-    return public_dns, private_dns
-
-
-EC2TargetDNS = []
-EC2TargetName = []
-i = 0
-while True:
-    Name = os.getenv(f"aws_instance_Target_Name_{str(i)}")
-    Region = os.getenv(f"aws_instance_Target_Region_{str(i)}")
-    if Name != None:
-        public_dns, private_dns = find_ec2_dns_by_tag('Name', Name, Region)
-        EC2TargetName.append(Name)
-        if public_dns != None:
-            EC2TargetDNS.append(public_dns)
-            logging.info("Achou DNS público")
-        else:
-            EC2TargetDNS.append(private_dns)
-            logging.info("Achou DNS privado")
-    else:
-        break
-    i += 1
-logging.info("EC2 Target Total: %d %s", i, EC2TargetName)
-
-# **************Inicializa EFS*********************************
-EFSList = []
-EFSNameList = []
-i = 0
-while True:
-    Name = os.getenv(f"aws_efs_file_system_Target_Name_{str(i)}")
-    if Name != None:
-        Path = os.getenv(f"aws_efs_access_point_Target_Path_{str(i)}")
-        EFSList.append(Path)
-        EFSNameList.append(Name)
-    else:
-        EFSMaxNumber = i
-        break
-    i += 1
-logging.info("EFS Target Total: %d %s", i, EFSNameList)
-
-# **************Inicializa SSM Parameter*********************************
-SSMParameterTargetName = []
-SSMParameterTargetRegion = []
-i = 0
-while True:
-    Name = os.getenv(f"aws_ssm_parameter_Target_Name_{str(i)}")
-    Region = os.getenv(f"aws_ssm_parameter_Target_Region_{str(i)}")
-    if Name is not None and Region is not None:
-        SSMParameterTargetName.append(Name)
-        SSMParameterTargetRegion.append(Region)
-    else:
-        SSMParameterMaxNumber = i
-        break
-    i += 1
-logging.info("SSM Parameter Target Total: %d %s", i, SSMParameterTargetName)
+# Cada target é um sink de cloudman_hub.sinks, criado abaixo (depois das credenciais dos bancos RDS).
+# Com CODEBUILD_COALESCE_WINDOW > 0 os disparos de uma janela iniciam um único build.
+Coalescer = None
+if targets("CodeBuildTarget") and coalescing_enabled():
+    Coalescer = BuildCoalescer(Region)
 
 # ***************************Resources Source***********************************
 
 # *****************Identifica a URL de cada SQS Source*************************
-SQSSourceMaxNumber = 4
-SQSSourceName = []
-i = 0
-while True:
-    Name = os.getenv(f"aws_sqs_queue_Source_Name_{str(i)}")
-    Region = os.getenv(f"aws_sqs_queue_Source_Region_{str(i)}")
-    SQSURL = os.getenv(f"aws_sqs_queue_Source_URL_0{str(i)}")
-    if Name != None:
-        SQSSourceName.append(Name)
-    else:
-        SQSSourceMaxNumber = i
-        break
-    i += 1
-logging.info("SQS Source Total: %d %s", i, SQSSourceName)
+SQSSourceName = [Target["Name"] for Target in targets("SQSSource")]
+SQSSourceMaxNumber = len(SQSSourceName)
+logging.info("SQS Source Total: %d %s", SQSSourceMaxNumber, SQSSourceName)
 
 # **********Identifica a ARN Source de cada SNS Source**************************
-SNSSourceMaxNumber = 4
-SNSSourceName = []
-i = 0
-while True:
-    Name = os.getenv(f"aws_sns_topic_Source_Name_{str(i)}")
-    Region = os.getenv(f"aws_sns_topic_Source_Region_{str(i)}")
-    Account = os.getenv(f"aws_sns_topic_Source_Account_{str(i)}")
-    if Name != None:
-        SNSTargetName.append(Name)
-    else:
-        SNSSourceMaxNumber = i
-        break
-    i += 1
-logging.info("SNS Source Total: %d %s", i, SNSSourceName)
+SNSSourceName = [Target["Name"] for Target in targets("SNSSource")]
+SNSSourceMaxNumber = len(SNSSourceName)
+logging.info("SNS Source Total: %d %s", SNSSourceMaxNumber, SNSSourceName)
 
 # **********Identifica cada S3 source **************************
-S3SourceMaxNumber = 4
-S3BucketSourceName = []
-i = 0
-while True:
-    Name = os.getenv(f"aws_s3_bucket_Source_Name_{str(i)}")
-    if Name != None:
-        S3BucketSourceName.append(Name)
-    else:
-        S3SourceMaxNumber = i
-        break
-    i += 1
-logging.info("S3 Notification Source Total: %d %s", i, S3BucketSourceName)
+S3BucketSourceName = [Target["Name"] for Target in targets("S3Source")]
+S3SourceMaxNumber = len(S3BucketSourceName)
+logging.info("S3 Notification Source Total: %d %s", S3SourceMaxNumber, S3BucketSourceName)
 
 # ********* Lista para armazenar informações de username e password de cada secret
 SecretsCredentials = []
 SecretNameList = []
-i = 0
-while True:
-    SecretName = os.getenv(
-        f"aws_secretsmanager_secret_version_Source_Name_{i}")
-    SecretARN = os.getenv(f"aws_secretsmanager_secret_version_Source_ARN_{i}")
-    if SecretName is not None:
-        client = boto3.client('secretsmanager', region_name=Region)
-        response = client.get_secret_value(SecretId=SecretARN)
-        secret = json.loads(response['SecretString'])
-        username = secret['username']
-        password = secret['password']
-        SecretsCredentials.append([SecretName, username, password])
-        SecretNameList.append(SecretName)
-    else:
-        break
-    i += 1
-logging.info("Secret Source Total: %d %s", i, SecretNameList)
+for Target in targets("SecretSource"):
+    client = get_client('secretsmanager', Region)
+    response = client.get_secret_value(SecretId=Target["ARN"])
+    secret = json.loads(response['SecretString'])
+    SecretsCredentials.append([Target["Name"], secret['username'], secret['password']])
+    SecretNameList.append(Target["Name"])
+logging.info("Secret Source Total: %d %s", len(SecretNameList), SecretNameList)
 
-# Funções para conectar e executar queries no MySQL
+# ******************* Sinks RDS (a conexão é aberta no primeiro uso e reaberta se cair).
+RDSSinks = {}
 
 
-def create_connection(host_name, user_name, user_password, db_name):
-    connection = None
-    try:
-        connection = pymysql.connect(
-            host=host_name,
-            user=user_name,
-            password=user_password,
-            database=db_name,
-            charset='utf8mb4',
-            cursorclass=pymysql.cursors.DictCursor
-        )
-        logging.info("Conexão ao MySQL DB bem-sucedida")
-    except MySQLError as e:
-        logging.error("O erro '%s' ocorreu", e)
-    return connection
-
-
-def execute_query(connection, query, values=None):
-    with connection.cursor() as cursor:
-        try:
-            if values:
-                cursor.execute(query, values)
-            else:
-                cursor.execute(query)
-            connection.commit()
-            logging.info("Query executada com sucesso")
-        except MySQLError as e:
-            logging.error("O erro '%s' ocorreu", e)
-
-
-# ******************* Inicializa lista para armazenar as conexões RDS e criação de tabela.
-RDSConnections = []
-i = 0
-if MySQLEnabled:
-    while True:
-        database = os.getenv(f"aws_db_instance_Target_Name_{i}")
-        if database is not None:
-            EndPoint = os.getenv(f"aws_db_instance_Target_Endpoint_{i}")
-            Host = EndPoint.split(":")[0]
-            FoundSecret = False
-            if len(SecretsCredentials) > 0:
-                for j in range(len(SecretsCredentials)):
-                    if database in SecretsCredentials[j][0]:
-                        username = SecretsCredentials[j][1]
-                        password = SecretsCredentials[j][2]
-                        FoundSecret = True
-                        break
-                if not FoundSecret:
-                    username = SecretsCredentials[0][1]
-                    password = SecretsCredentials[0][2]
-            else:
-                username = "TypeNewUserName"
-                password = "TypeNewPassword"
-            logging.info("Database e endpoint %d : %s, %s, %s",
-                         i, database, Host, username)
-            # Estabeleça a conexão e crie a tabela
-            connection = create_connection(Host, username, password, database)
-            if connection is not None:
-                RDSConnections.append([connection, database])
-                create_table_query = """
-                    CREATE TABLE IF NOT EXISTS exemplo (
-                        id INT AUTO_INCREMENT, 
-                        texto VARCHAR(4000) NOT NULL, 
-                        PRIMARY KEY (id)
-                    )
-                """
-                execute_query(connection, create_table_query)
-                logging.info("Tabela 'exemplo' criada")
-        else:
-            logging.info("Total RDS Targets: %d", i)
-            break
-        i += 1
+def get_rds_sink(database, Host):
+    """Sink RDS de um banco, criado no primeiro uso; a tabela é criada a cada nova conexão."""
+    if database not in RDSSinks:
+        username, password = match_credentials(database, SecretsCredentials)
+        logging.info("Database e endpoint: %s, %s", database, Host)
+        RDSSinks[database] = RDSSink(
+            lambda: connect_database(Host, username, password, database), database)
+    return RDSSinks[database]
+
+
+# ******************* Sinks de todos os targets
+Sinks = build_sinks(CodeBuildName, Region, AccountID,
+                    owner_attribute="CodeBuildName", rds_sink=get_rds_sink if mysql_enabled() else None,
+                    coalescer=Coalescer)
 
 # ******************************************************************************
 
 if __name__ == "__main__":
-    # Ler o evento da variável de ambiente
+    # Ler o evento da variável de ambiente (ou do artefato de uma janela de coalescência)
     event = os.getenv('EVENT')
-    if event:
+    EventArtifact = os.getenv('EVENT_ARTIFACT')
+    if EventArtifact:
+        event = {'Coalesced': read_artifact(EventArtifact)}
+    elif event:
         # Converter o evento de string JSON para dicionário
         try:
             event = json.loads(event)
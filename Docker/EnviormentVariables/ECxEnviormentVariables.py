@@ -1,25 +1,42 @@
 # Importações
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 import boto3
 import json
 import os
 import logging
 import watchtower
 import datetime
+import time
 from dotenv import load_dotenv
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
-from threading import Semaphore
-from threading import Lock
+from threading import Lock, BoundedSemaphore
 import requests
-database = os.getenv(f"aws_db_instance_Target_Name_0")
-if database is not None:
-    import mysql.connector
-    from mysql.connector import Error
-    import pymysql
+# Código compartilhado dos hubs (pasta python/ do Lambda Layer cloudman_hub)
+from cloudman_hub import get_client, set_log_function
+from cloudman_hub.fanout import FanOut
+from cloudman_hub.http_pool import HTTPConnectTimeout, HTTPReadTimeout
+from cloudman_hub.envelope import forward
+from cloudman_hub.codec import quoted
+from cloudman_hub.metrics import get_hop_metrics, flush_metrics
+from cloudman_hub.hubconfig import targets, resolved
+from cloudman_hub.rds import RDSSink, connect_database, match_credentials, mysql_enabled
+from cloudman_hub.batch import send_each
+from cloudman_hub.sinks import build_sinks, dispatch, get_sink_executor
+from cloudman_hub.sqs_consumer import SQSConsumer
+from cloudman_hub.discovery import get_discovery_cache
+from cloudman_hub.xray import set_recorder, get_recorder, execute_with_xray
 # Carregar as variáveis de ambiente do arquivo .env e habilitar o patch automático
 load_dotenv()
 
+# Workers que executam o fan-out das requisições HTTP, fora do event loop.
+RequestMaxWorkers = int(os.getenv("REQUEST_MAX_WORKERS", str(max(8, 4 * (os.cpu_count() or 1)))))
+# ACCEPT_ASYNC=True: a mensagem é enfileirada e a requisição recebe 202 sem esperar os targets;
+# com ACCEPT_QUEUE_SIZE mensagens pendentes as novas requisições recebem 503.
+AcceptAsync = os.getenv("ACCEPT_ASYNC", "False") == "True"
+AcceptQueueSize = int(os.getenv("ACCEPT_QUEUE_SIZE", "1000"))
+
 ClaudMapNamespaceName = os.environ.get('aws_service_discovery_service_Target_Name_0','')
 ClaudMapServiceRegion = os.environ.get('aws_service_discovery_service_Target_Region_0')
 if ClaudMapNamespaceName != "":
@@ -59,6 +76,9 @@ def LogMessage(Msg):
     if StatusLogsEnabled:
         logger.info(Msg)
 
+# As mensagens do código compartilhado (cloudman_hub) vão para o mesmo log.
+set_log_function(LogMessage)
+
 LogMessage(f"Inicio")
 
 XRay = os.getenv('XRay_Enabled',"False")
@@ -71,6 +91,8 @@ if XRay == "True":
 else:
 
     XRayEnabled = False
+# As chamadas aos targets do código compartilhado ficam em subsegmentos quando o X-Ray está habilitado.
+set_recorder(xray_recorder if XRayEnabled else None)
 
 # Função para listar todos os serviços em um namespace
 def list_services_in_namespace(client, namespace_id):
@@ -110,9 +132,19 @@ def resolve_srv_record(service_name):
    #     LogMessage(f"Erro ao resolver SRV para {service_name}: {e}")
         return None, None
     
-ClientService = boto3.client('servicediscovery', region_name=ClaudMapServiceRegion)
+# O namespace resolvido na geração da configuração do hub dispensa as chamadas ao Cloud Map.
+ResolvedNamespace = resolved("CloudMap", ClaudMapNamespaceName) if ClaudMapNamespaceName != "" else None
+if ResolvedNamespace is not None:
+    LogMessage(f"Cloud Map Namespace ID (configuração): {ResolvedNamespace['Id']}")
+    for service in ResolvedNamespace['Services']:
+        LogMessage(f"Service: {service['Name']} (ID: {service['Id']})")
+        for instance in service['Instances']:
+            LogMessage(f"InstanceId: {instance['Id']}")
+            for key, value in instance['Attributes'].items():
+                LogMessage(f"  {key}: {value}")
 # Encontrar o ID do namespace
-if ClaudMapNamespaceName != "":
+elif ClaudMapNamespaceName != "":
+    ClientService = get_client('servicediscovery', ClaudMapServiceRegion)
     if XRayEnabled:
             xray_recorder.begin_segment(SegmentName)
     ClaudMapNamespaceID = find_namespace_id_by_name(ClientService, ClaudMapNamespaceName)
@@ -153,12 +185,10 @@ def generate_primes(n):
     #LogMessage(f"Primes Number generated: {num}")
     return primes
 
-def execute_with_xray(segment_name, function, *args, **kwargs):
-    if XRayEnabled:
-        with xray_recorder.in_subsegment(segment_name):
-            return function(*args, **kwargs)
-    else:
-        return function(*args, **kwargs)
+# Timeouts (conexão, leitura) dos POST/GET para os ALBs e Tasks, os mesmos do pool HTTP: abaixo do
+# FANOUT_TARGET_TIMEOUT, a chamada não segue rodando muito depois de o target dar TIMEOUT.
+RequestTimeout = (HTTPConnectTimeout, HTTPReadTimeout)
+
 
 def send_request(Name, URL, Method, message_body=None):
     """
@@ -167,15 +197,17 @@ def send_request(Name, URL, Method, message_body=None):
     :param URL: URL para enviar a requisição.
     :param Method: Método HTTP ('GET' ou 'POST').
     :param message_body: Corpo da mensagem para requisições POST (opcional).
-    :return: None
+    :return: True quando o destino respondeu 200.
     """
     UnknownMethod = False
     try:
         headers = {'Content-Type': 'application/json'}
         def post_request():
-            return requests.post(URL, data=json.dumps({"MSG Data": message_body}), headers=headers)
+            # A mensagem já é JSON: entra como texto no corpo sem ser serializada de novo.
+            return requests.post(URL, data='{"MSG Data":' + quoted(message_body) + '}', headers=headers,
+                                 timeout=RequestTimeout)
         def get_request():
-            return requests.get(URL, headers=headers)
+            return requests.get(URL, headers=headers, timeout=RequestTimeout)
         LogMessage(f"Target Name {Name}")
         if Method == "POST":
             response = execute_with_xray(Name, post_request)
@@ -186,7 +218,7 @@ def send_request(Name, URL, Method, message_body=None):
         if not UnknownMethod:
             if response.status_code == 200:
                 #LogMessage(f"Send Message to {name}: {URL}")
-                pass
+                return True
             else:
                 LogMessage(f"Erro ao enviar para {Name} em {URL}: Status Code {response.status_code}")
         else:
@@ -194,33 +226,7 @@ def send_request(Name, URL, Method, message_body=None):
 
     except requests.exceptions.RequestException as e:
         LogMessage(f"Exceção ao enviar para {Name} em {URL}: {e}")
-
-# Funções para conectar e executar queries no MySQL
-def create_connection(host_name, user_name, user_password, db_name):
-    connection = None
-    try:
-        connection = mysql.connector.connect(
-            host=host_name,
-            user=user_name,
-            passwd=user_password,
-            database=db_name
-        )
-        LogMessage("Conexão ao MySQL DB bem-sucedida")
-    except Error as e:
-        LogMessage(f"O erro '{e}' ocorreu")
-    return connection
-
-def execute_query(connection, query, values=None):
-    cursor = connection.cursor()
-    LogMessage(f"Passou aqui B")
-    try:
-        if values:
-            cursor.execute(query, values)
-        else:
-            cursor.execute(query)
-        connection.commit()
-    except Error as e:
-        LogMessage(f"O erro '{e}' ocorreu")
+    return False
 
 def fetch_query(connection, query):
     try:
@@ -234,359 +240,135 @@ def fetch_query(connection, query):
     
 #Identificação dos dos recursos conectados
     
-# Identifica a URL e o cliente de cada SQS Target
-SQSTargetClients = []  # Lista para armazenar pares de clientes SQS e URLs de fila
-SQSNameList = []
-i = 0
-while True:
-    Name = os.getenv(f"aws_sqs_queue_Target_Name_{i}")
-    Region = os.getenv(f"aws_sqs_queue_Target_Region_{i}")
-    Account = os.getenv(f"aws_sqs_queue_Target_Account_{i}")
-    if Name is not None:
-        sqs_client = boto3.client('sqs', region_name=Region)
-        URL = f"https://sqs.{Region}.amazonaws.com/{Account}/{Name}"
-        SQSTargetClients.append((sqs_client, URL,Name))
-        SQSNameList.append(Name)
-    else:
-        break
-    i += 1
-logger.info(f"SQS Target Total: {i} {SQSNameList}")
-
-# Identifica a ARN e o cliente de cada SNS Target
-SNSTargetClients = []  # Lista para armazenar pares de clientes SNS e ARNs de tópicos
-SNSNameList =[]
-i = 0
-while True:
-    Name = os.getenv(f"aws_sns_topic_Target_Name_{i}")
-    Region = os.getenv(f"aws_sns_topic_Target_Region_{i}")
-    Account = os.getenv(f"aws_sns_topic_Target_Account_{i}")
-    if Name is not None:
-        sns_client = boto3.client('sns', region_name=Region)
-        ARN = f"arn:aws:sns:{Region}:{Account}:{Name}"
-        SNSTargetClients.append((sns_client, ARN, Name))
-        SNSNameList.append(Name)
-    else:
-        break
-    i += 1
-logger.info(f"SNS Target Total: {i} {SNSNameList}")
-
-def init_table(table_resource, TableName):
-    if XRayEnabled:
-            xray_recorder.begin_segment(SegmentName)
-    try:
-        response = execute_with_xray(TableName, table_resource.get_item, Key={'ID': "1"})
-        if 'Item' not in response:
-            ItemData = f"Criado por {InstanceName}"
-            execute_with_xray(TableName, table_resource.put_item, Item={'ID': "1", "InstanceName": ItemData, 'Cont': 0})
-    except Exception as e:
-        LogMessage(f"Erro ao iniciar a tabela {TableName}: {e}")
-    finally:
-        if XRayEnabled:
-            xray_recorder.end_segment()
-
-DynamoDBTargetList = []
-DynamoNameList = []
-i = 0
-while True:
-    TableName = os.getenv(f"aws_dynamodb_table_Target_Name_{i}")
-    Region = os.getenv(f"aws_dynamodb_table_Target_Region_{i}") 
-    if TableName:
-        dynamodb = boto3.resource('dynamodb', region_name=Region)
-        table_resource = dynamodb.Table(TableName)
-        DynamoDBTargetList.append((dynamodb, table_resource,TableName ))
-        DynamoNameList.append(TableName)
-        init_table(table_resource, TableName)
-    else:
-        break
-    i += 1
-logger.info(f"DynamoDB Target Total: {i} {DynamoNameList}")
-
-# Identifica cada S3 target
-S3TargetList = []  # Lista para armazenar pares de clientes S3 e nomes de buckets
-S3NameList = []
-i = 0
-while True:
-    Name = os.getenv(f"aws_s3_bucket_Target_Name_{i}")
-    Region = os.getenv(f"aws_s3_bucket_Target_Region_{i}")
-    if Name is not None:
-        s3_client = boto3.client('s3', region_name=Region)
-        S3TargetList.append((s3_client, Name))
-        S3NameList.append(Name)
-    else:
-        S3TargetMaxNumber = i
-        break
-    i += 1
-logger.info(f"S3 Target Total: {i} {S3NameList}")
-
-# Identifica cada EFS target
-EFSTargetList = []  # Lista para armazenar os nomes dos sistemas de arquivos EFS
-EFSNameList = []
-i = 0
-while True:
-    Name = os.getenv(f"aws_efs_file_system_Target_Name_{i}")
-    Path = os.getenv(f"aws_efs_access_point_Target_Path_{i}")
-    if Name is not None:
-        # Aqui você poderia inicializar um cliente EFS se necessário, 
-        # mas para a montagem, normalmente usamos apenas o nome/identificador
-        EFSTargetList.append([Name,Path])
-        EFSNameList.append(Name)
-    else:
-        EFSTargetMaxNumber = i
-        break
-    i += 1
-logger.info(f"EFS Target Total: {i} {EFSNameList}")
-
-# Identifica cada Lambda target
-LambdaTargetList = []  # Lista para armazenar nomes de funções Lambda
-LambdaNameList = []
-i = 0
-while True:
-    FunctionName = os.getenv(f"aws_lambda_function_Target_Name_{i}")
-    Region = os.getenv(f"aws_lambda_function_Target_Region_{i}")
-    if FunctionName is not None:
-        lambda_client = boto3.client('lambda', region_name=Region)
-        LambdaTargetList.append((lambda_client, FunctionName))
-        LambdaNameList.append(FunctionName)
-    else:
-        LambdaTargetMaxNumber = i
-        break
-    i += 1
-logger.info(f"Lambda Target Total: {i} {LambdaNameList}")
+# Os targets vêm da configuração pré-compilada do hub (HUB_CONFIG_FILE) quando ela acompanha
+# o container, senão das variáveis de ambiente aws_*_Target_*_{i} (ver cloudman_hub.hubconfig).
 
 # Identifica a URL de cada ALB Target
-ALBTargetURLs = []  # Lista para armazenar os nomes e URLs dos ALBs
-ALBNameList = []
-i = 0 
-while True:
-    URL = os.getenv(f"aws_lb_DNS_Name_{i}")
-    ALBName = os.getenv(f"aws_lb_Name_{i}")
-    if URL is not None:
-        ALBTargetURLs.append([ALBName, URL])
-        ALBNameList.append(ALBName)
-    else:
-        break
-    i += 1 
-logger.info(f"ALB Target Total: {i} {ALBNameList}")
+ALBTargetURLs = [[Target["Name"], Target["URL"]] for Target in targets("ALBTarget")]
+ALBNameList = [Target["Name"] for Target in targets("ALBTarget")]
+logger.info(f"ALB Target Total: {len(ALBNameList)} {ALBNameList}")
 
 # Identifica Nomes dos containers target
-ContainerTargetList = []  # Lista para armazenar os nomes e URLs dos ALBs
+ContainerTargetList = []  # Lista para armazenar os nomes e regiões dos containers
 ContainerNameList = []
 if ClaudMapNamespaceName != "":
-    i = 0 
-    while True:
-        ContainerName = os.getenv(f"Container_Target_Name_{i}")
-        ContainerRegion = os.getenv(f"Container_Target_Region_{i}")
-        if ContainerName is not None:
-            ContainerTargetList.append([ContainerName,ContainerRegion])
-            ContainerNameList.append(ContainerName)
-        else:
-            break
-        i += 1  
-logger.info(f"Containers Target Total: {i} {ContainerNameList}")
+    ContainerTargetList = [[Target["Name"], Target["Region"]] for Target in targets("ContainerTarget")]
+    ContainerNameList = [Target["Name"] for Target in targets("ContainerTarget")]
+logger.info(f"Containers Target Total: {len(ContainerNameList)} {ContainerNameList}")
 
 # Identifica a URL e o cliente de cada SQS Source
 SQSSourceList = []
 SQSNameList = []  # Lista para armazenar pares de clientes SQS e URLs de fila
-i = 0
-while True:
-    Name = os.getenv(f"aws_sqs_queue_Source_Name_{i}")
-    Region = os.getenv(f"aws_sqs_queue_Source_Region_{i}")
-    Account = os.getenv(f"aws_sqs_queue_Source_Account_{i}")
-    if Name is not None:
-        sqs_client = boto3.client('sqs', region_name=Region)
-        URL = f"https://sqs.{Region}.amazonaws.com/{Account}/{Name}"
-        SQSSourceList.append((sqs_client, URL,Name))
-        SQSNameList.append(Name)
-    else:
-        SQSSourceMaxNumber = i
-        break
-    i += 1
-logger.info(f"SQS Queue Total: {i} {SQSNameList}")
+for Target in targets("SQSSource"):
+    sqs_client = get_client('sqs', Target["Region"])
+    URL = f"https://sqs.{Target['Region']}.amazonaws.com/{Target['Account']}/{Target['Name']}"
+    SQSSourceList.append((sqs_client, URL, Target["Name"]))
+    SQSNameList.append(Target["Name"])
+logger.info(f"SQS Queue Total: {len(SQSNameList)} {SQSNameList}")
 
 
 
 # Lista para armazenar informações de username e password de cada secret
 SecretsCredentials = []
 SecretNameList = []
-i = 0
-while True:
-    SecretName = os.getenv(f"aws_secretsmanager_secret_version_Source_Name_{i}")
-    SecretARN = os.getenv(f"aws_secretsmanager_secret_version_Source_ARN_{i}")
-    if SecretName is not None:
-        client = boto3.client('secretsmanager', region_name=Region)
-        response = client.get_secret_value(SecretId=SecretARN)
-        secret = json.loads(response['SecretString'])
-        username = secret['username']
-        password = secret['password']
-        SecretsCredentials.append([SecretName,username, password])
-        SecretNameList.append(SecretName)
-    else:
-        break
-    i += 1
-logger.info(f"Secrets Target Total: {i} {SecretNameList}")
-
-# inicializa Lista para armazenar as conexões RDS e criação de tabela.
-RDSConnections = []
-DataBaseList = []
-i = 0
-while True:
-    database = os.getenv(f"aws_db_instance_Target_Name_{i}")
-    if database is not None:
-        # Inicie um segmento X-Ray para a conexão RDS
-        if XRayEnabled:
-            xray_recorder.begin_segment(SegmentName)
-        EndPoint = os.getenv(f"aws_db_instance_Target_Endpoint_{i}")
-        Host = EndPoint.split(":")[0]
-        FoundSecret = False
-        if len(SecretsCredentials) > 0:
-            for j in range(len(SecretsCredentials)):
-                if database in SecretsCredentials[j][0]:
-                    username = SecretsCredentials[j][1]
-                    password = SecretsCredentials[j][2]
-                    FoundSecret = True
-                    break
-            if not FoundSecret:
-                username = SecretsCredentials[0][1]
-                password = SecretsCredentials[0][2]
-        else:
-            username = "TypeNewUserName"
-            password = "TypeNewPassword"
-        # Estabeleça a conexão e crie a tabela
-        connection = create_connection(Host, username, password, database)
-        if connection is not None:
-            RDSConnections.append([connection, database])
-            DataBaseList.append(database)
-            create_table_query = """
-                CREATE TABLE IF NOT EXISTS exemplo (
-                    id INT AUTO_INCREMENT, 
-                    texto VARCHAR(4000) NOT NULL, 
-                    PRIMARY KEY (id)
-                )
-            """
-            execute_query(connection, create_table_query)
-            LogMessage(f"Passou aqui A")
-        if XRayEnabled:
-            xray_recorder.end_segment()
-    else:
-        break
-    i += 1
-logger.info(f"RDS Target Total: {i} {DataBaseList}")
-
-#*************Inicia SSM PArameter*************************
-SSMParameterTargetName = []
-SSMParameterTargetRegion = []
-i = 0
-while True:
-    Name = os.getenv(f"aws_ssm_parameter_Target_Name_{str(i)}")
-    Region = os.getenv(f"aws_ssm_parameter_Target_Region_{str(i)}")
-    if Name is not None and Region is not None:
-        SSMParameterTargetName.append(Name)
-        SSMParameterTargetRegion.append(Region)
-    else:
-        SSMParameterMaxNumber = i
-        break
-    i += 1
-logger.info(f"SSM Parameter Target Total: {i} {SSMParameterTargetName}")
-
-
+for Target in targets("SecretSource"):
+    client = get_client('secretsmanager', Region)
+    response = client.get_secret_value(SecretId=Target["ARN"])
+    secret = json.loads(response['SecretString'])
+    SecretsCredentials.append([Target["Name"], secret['username'], secret['password']])
+    SecretNameList.append(Target["Name"])
+logger.info(f"Secrets Target Total: {len(SecretNameList)} {SecretNameList}")
+
+# Sinks RDS: a conexão é aberta no primeiro uso (e reaberta se cair) e a tabela é criada a cada nova conexão.
+# Requisições e consumidores SQS chamam get_rds_sink ao mesmo tempo: um único sink por banco.
+RDSSinks = {}
+RDSSinksLock = Lock()
+def get_rds_sink(database, Host):
+    with RDSSinksLock:
+        if database not in RDSSinks:
+            username, password = match_credentials(database, SecretsCredentials)
+            RDSSinks[database] = RDSSink(lambda: connect_database(Host, username, password, database), database)
+        return RDSSinks[database]
+
+# Os demais targets são sinks de cloudman_hub.sinks (ALB e Container continuam abaixo, próprios deste hub).
+Sinks = build_sinks(InstanceName, Region, AccountID,
+                    kinds=("SQSTarget", "SNSTarget", "DynamoDBTarget", "S3Target", "EFSTarget",
+                           "LambdaTarget", "RDSTarget", "SSMParameterTarget"),
+                    lambda_source="aws:ec2", owner_attribute="InstanceName",
+                    rds_sink=get_rds_sink if mysql_enabled() else None)
+
+
+
+def send_batch_to_all_outputs(Inputs, URLPath="", Method="GET", EventSource = ""):
+    """
+    Encaminha um lote de mensagens com um único fan-out.
+    :param Inputs: Lista de (RecordID, corpo da mensagem); RecordID é o MessageId SQS ou None.
+    :return: RecordIDs das mensagens que algum target não recebeu.
+    """
+    # Momento do recebimento, gravado no hop para as métricas de latência.
+    Received = time.time()
+    LogMessage(f"Event Source: {EventSource} Messages: {len(Inputs)}")
+    # Messages: um (RecordID, NewMessage, Stamp) por mensagem a ser encaminhada.
+    Messages = []
+    for n, (RecordID, message_body) in enumerate(Inputs):
+        Agora = datetime.datetime.now()
+        # O payload segue inalterado no envelope; esta instância apenas se acrescenta à lista de hops.
+        Envelope, NewMessage = forward(message_body, InstanceName, received=Received)
+        if NewMessage is None:
+            LogMessage(f"Loop encontrado! {Envelope.get('Hops')}")
+            continue
+        # Os histogramas são gravados a cada METRICS_FLUSH_INTERVAL segundos.
+        get_hop_metrics().record(Envelope)
+        LogMessage(f"Message to be sent: {NewMessage}")
+        # Stamp torna únicos os IDs do DynamoDB e os nomes de arquivo dentro de um lote.
+        Stamp = str(Agora) if len(Inputs) == 1 else f"{Agora}-{n}"
+        Messages.append((RecordID, NewMessage, Stamp))
+    if not Messages:
+        return []
+    # Sem trava global: cada sink limita os próprios envios (SINK_CONCURRENCY, ver cloudman_hub.sinks).
+    return execute_with_xray('send_to_all_outputs', _send_to_all_outputs_helper, Messages, URLPath, Method)
 
-send_to_all_outputs_semaphore = Semaphore(1)
 def send_to_all_outputs(message_body, URLPath="", Method="GET", EventSource = ""):
-    LogMessage(f"Event Source: {EventSource}")
-    Agora = datetime.datetime.now()
-    NewMessage = f"Instance: {InstanceName}. Source: {Method}. Date/Time: {str(Agora)}. <- {message_body}"
-    LogMessage(f"Message to be sent: {NewMessage}")
-    with send_to_all_outputs_semaphore:
-        execute_with_xray('send_to_all_outputs', _send_to_all_outputs_helper, NewMessage, URLPath, Method, Agora)
-
-def _send_to_all_outputs_helper(message_body, URLPath, Method, Agora):
-    for sqs_client, queue_url, Name in SQSTargetClients:
-        execute_with_xray(Name, sqs_client.send_message, QueueUrl=queue_url, MessageBody=message_body)
-        LogMessage(f"Send message to SQS: {Name}")
-        
-    for sns_client, topic_arn, Name in SNSTargetClients:
-        execute_with_xray(Name, sns_client.publish, TopicArn=topic_arn, Message=message_body)
-        LogMessage(f"Send message to SNS: {Name}")
-    
-    for dynamodb, Table, TableName in DynamoDBTargetList:
-        response = execute_with_xray(TableName, Table.get_item, Key={'ID': "1"})
-        if 'Item' in response:
-            item = response['Item']
-            cont = item['Cont'] + 1
-            execute_with_xray(TableName, Table.update_item, Key={'ID': "1"}, UpdateExpression='SET Cont = :val1', ExpressionAttributeValues={':val1': cont})
-            ID = InstanceName + ":" + str(Agora)
-            execute_with_xray(TableName, Table.put_item, Item={'ID': ID, "Message": message_body})
-            LogMessage(f"Put Item: {TableName}")
-        else:
-            LogMessage(f"Sem Item {TableName}")
-    
-    for s3_client, bucket_name in S3TargetList:
-        folder_name = InstanceName + "/"
-        file_name = InstanceName + ":" + str(Agora) + ".txt"
-        file_path = folder_name + file_name
-        execute_with_xray(bucket_name, s3_client.put_object, Bucket=bucket_name, Key=file_path, Body=message_body)
-        LogMessage(f"Put Object: {bucket_name}")
-
-    for EFSName, mount_path in EFSTargetList:
-        if not os.path.exists(mount_path):
-            os.makedirs(mount_path)
-        file_name = f"{EFSName}-{Agora.strftime('%Y%m%d%H%M%S')}.txt"
-        file_path = os.path.join(mount_path, file_name)
-        with open(file_path, 'w') as file:
-            file.write(message_body)
-        LogMessage(f"Save Message EFS: {EFSName}: {mount_path} : {file_name}")
-
+    send_batch_to_all_outputs([(None, message_body)], URLPath, Method, EventSource)
+
+def post_alb(ALBName, URL, Method, Messages):
+    def post_message(message):
+        if not send_request(ALBName, URL, Method, message_body=message[1]):
+            raise RuntimeError(f"ALB {ALBName} não respondeu 200")
+    failed = send_each(post_message, Messages, get_sink_executor())
+    if len(failed) == len(Messages):
+        raise RuntimeError(f"ALB {ALBName} não respondeu 200")
+    LogMessage(f"Call ALB : {ALBName}: {URL}")
+    return failed
+
+def post_container(ContainerName, RegionName, Messages):
+    # As instâncias vêm do cache de descoberta (renovado em segundo plano); cada mensagem vai para
+    # a instância escolhida pelo seletor DISCOVERY_SELECTOR (ver cloudman_hub.discovery).
+    def post_message(message):
+        with get_discovery_cache().instance(ClaudMapNamespaceName, ContainerName, RegionName) as instance:
+            if instance is None:
+                return
+            URL = f"http://{instance['Host']}:{instance['Port']}/{ContainerName}"
+            if not send_request(ContainerName, URL, "POST", message_body=message[1]):
+                raise RuntimeError(f"Container {ContainerName} não respondeu 200")
+    failed = send_each(post_message, Messages, get_sink_executor())
+    if len(failed) == len(Messages):
+        raise RuntimeError(f"Container {ContainerName} não respondeu 200")
+    return failed
+
+def _send_to_all_outputs_helper(Messages, URLPath, Method):
+    # Todos os targets são disparados em paralelo (ver cloudman_hub.sinks.dispatch).
+    fan_out = FanOut(recorder=get_recorder())
     for ALBName, URL in ALBTargetURLs:
-        URL = "http://" + URL + "/" + URLPath
-        send_request(ALBName, URL, Method, message_body=message_body)
-        LogMessage(f"Call ALB : {ALBName}: {URL}")
-    
-    for ContainerName,RegionName in ContainerTargetList:
-        def discover_service_instances(service_name, namespace_name):
-            client = boto3.client('servicediscovery', region_name=RegionName)
-            response = client.discover_instances(NamespaceName=namespace_name, ServiceName=service_name)
-            return response
-        response = execute_with_xray("DiscoverInstances", discover_service_instances, ContainerName, ClaudMapNamespaceName)
-        if response['Instances'] and len(response['Instances']) > 0:
-            instance = response['Instances'][0]
-            Host = instance['Attributes']['AWS_INSTANCE_IPV4']
-            Port = instance['Attributes']['AWS_INSTANCE_PORT']
-            if Host and Port:
-                URL = f"http://{Host}:{Port}/{ContainerName}"
-                LogMessage(f"Send message to container with URL: {URL}")
-                send_request(ContainerName, URL, "POST", message_body=message_body)
-        
-
-    for lambda_client, function_name in LambdaTargetList:
-        payload = json.dumps({'message': message_body, "source" : "aws:ec2"})
-        execute_with_xray(function_name, lambda_client.invoke, FunctionName=function_name, InvocationType='Event', Payload=payload)
-        LogMessage(f"Invoke lambda: {function_name}")
-
-    for connection, db_name in RDSConnections:
-        # Supondo que a tabela e a coluna que você deseja inserir são 'exemplo' e 'texto'
-        insert_query = "INSERT INTO exemplo (texto) VALUES (%s)"
-        try:
-            Data = json.dumps(message_body)
-            execute_query(connection, insert_query, (Data,))
-            LogMessage(f"Item inserido na tabela 'exemplo' do banco de dados '{db_name} com msg {message_body}'")
-        except Error as e:
-            LogMessage(f"Erro ao inserir item no banco de dados '{db_name}': {e}")
-
-    for Name, region in zip(SSMParameterTargetName, SSMParameterTargetRegion):
-        ssm_client = boto3.client('ssm', region_name=region)
-        try:
-            response = execute_with_xray(Name, ssm_client.get_parameter, Name=Name, WithDecryption=True)
-            current_value = response['Parameter']['Value']
-            new_value = '0'
-            int_value = int(current_value)
-            new_value = str(int_value + 1)
-            execute_with_xray(Name, ssm_client.put_parameter, Name=Name, Value=new_value, Type='String',Overwrite=True)
-            LogMessage(f"Parameter {Name} updated with {new_value}'")
-        except Exception as e:
-            LogMessage(f"Error processing the parameter {Name} in the region {region}: {e}")
-
-
-    generate_primes(PrimesCount)
+        fan_out.add(ALBName, "ALB", post_alb, ALBName, "http://" + URL + "/" + URLPath, Method, Messages)
+    for ContainerName, RegionName in ContainerTargetList:
+        fan_out.add(ContainerName, "Container", post_container, ContainerName, RegionName, Messages)
+    FanOutResult, failed = dispatch(Sinks, Messages, InstanceName, fan_out)
+    LogMessage(f"Fan-out result: {json.dumps(FanOutResult)}")
+
+    for message in Messages:
+        generate_primes(PrimesCount)
+    return failed
 
 
 #Retorna a rota "/health" para o health check do target group
@@ -595,89 +377,98 @@ async def health_check():
     LogMessage("Health Check")
     return {"status": "healthy"}
 
+# O fan-out (boto3, requests, primos) bloqueia: roda neste pool, para que um target lento não
+# trave o event loop, as demais requisições e o /health.
+RequestExecutor = ThreadPoolExecutor(max_workers=RequestMaxWorkers, thread_name_prefix="request")
+AcceptSlots = BoundedSemaphore(AcceptQueueSize)
+
+def process_request(Message, full_path, Method, EventSource):
+    # O segmento X-Ray é aberto na thread que faz as chamadas aos targets.
+    if XRayEnabled:
+        xray_recorder.begin_segment(SegmentName)
+    try:
+        send_to_all_outputs(Message, full_path, Method, EventSource)
+    finally:
+        if XRayEnabled:
+            xray_recorder.end_segment()
+
+def process_accepted_request(Message, full_path, Method, EventSource):
+    try:
+        process_request(Message, full_path, Method, EventSource)
+    except Exception as e:
+        LogMessage(f"Erro ao processar requisição {Method} aceita: {e}")
+    finally:
+        AcceptSlots.release()
+
+async def handle_request(Message, full_path, Method, EventSource):
+    """Executa o fan-out no pool, ou o enfileira e responde 202 com ACCEPT_ASYNC."""
+    if AcceptAsync:
+        if not AcceptSlots.acquire(blocking=False):
+            return JSONResponse({"status": "Busy", "message": f"{AcceptQueueSize} mensagens pendentes"},
+                                status_code=503)
+        RequestExecutor.submit(process_accepted_request, Message, full_path, Method, EventSource)
+        return JSONResponse({"status": f"{Method} accepted. Instance: {InstanceName} path: /{full_path}"},
+                            status_code=202)
+    await asyncio.get_running_loop().run_in_executor(
+        RequestExecutor, process_request, Message, full_path, Method, EventSource)
+    return None
+
 @app.api_route("/{full_path:path}", methods=["GET"])
 async def catch_all_get(full_path: str, request: Request):
     Agora = datetime.datetime.now()
-    xray_trace_id = request.headers.get('X-Amzn-Trace-Id')
-    if XRayEnabled:
-        segment = xray_recorder.begin_segment(SegmentName)
     try:
         Message = f"Source: HTTP GET @{Agora}"
         LogMessage(Message)
-        EventSource = "HTTP GET"
-        send_to_all_outputs(Message, full_path, "GET", EventSource)
-    finally:
-        if XRayEnabled:
-            xray_recorder.end_segment()
+        response = await handle_request(Message, full_path, "GET", "HTTP GET")
+        if response is not None:
+            return response
+    except Exception as e:
+        LogMessage(f"Erro ao processar requisição GET: {e}")
+        return JSONResponse({"status": "Error", "message": "Erro interno ao processar a requisição"}, status_code=500)
     GetMessage = f"GET received. Instance: {InstanceName} path: /{full_path}"
     return {"message": GetMessage}
 
 @app.api_route("/{full_path:path}", methods=["POST"])
 async def catch_all_post(full_path: str, request: Request):
-    Agora = datetime.datetime.now()
     try:
-        body = await request.json()
-        message_body = str(body)
-        if XRayEnabled:
-            segment = xray_recorder.begin_segment(SegmentName)
-        LogMessage(message_body)
-        EventSource = "HTTP Post"
-        send_to_all_outputs(message_body, full_path, "POST", EventSource)
-        if XRayEnabled:
-            xray_recorder.end_segment()
+        # O corpo é decodificado uma única vez, por forward (JSON ou texto).
+        message_body = await request.body()
+        LogMessage(message_body.decode('utf-8', errors='replace'))
+        response = await handle_request(message_body, full_path, "POST", "HTTP Post")
+        if response is not None:
+            return response
     except Exception as e:
         LogMessage(f"Erro ao processar requisição POST: {e}")
-        return {"status": "Error", "message": str(e)}, 500
+        return JSONResponse({"status": "Error", "message": "Erro interno ao processar a requisição"}, status_code=500)
     PostMessage = f"POST received. Instance: {InstanceName} path: /{full_path}"
     return {"status": PostMessage}
 
 # Evento de inicialização da aplicação para iniciar o processamento das mensagens SQS
 @app.on_event("startup")
 async def startup_event():
-    asyncio.create_task(process_sqs_messages())
-
-# Tarefa assíncrona para processar mensagens SQS
-# Variável global e um lock para segurança em ambientes multithread
-Count = 0
-count_lock = Lock()
-async def process_sqs_messages():
-    if len(SQSSourceList)>0:
-        global Count
-        with count_lock:  # Garante que apenas uma thread modifique Count por vez
-            Count += 1
-            LogMessage(f"LoopMain {Count} {InstanceName}")
-        with ThreadPoolExecutor(max_workers=len(SQSSourceList)) as executor:
-            loop = asyncio.get_event_loop()
-            tasks = []
-            for sqs_client, queue_url, SQSNAme in SQSSourceList:
-                task = loop.run_in_executor(executor, process_messages_from_queue, sqs_client, queue_url, SQSNAme)
-                tasks.append(task)
-            await asyncio.gather(*tasks)
-
-
-def process_messages_from_queue(sqs_client, queue_url,SQSName):
-    while True:
-        # Inicie um segmento do X-Ray no início do processamento
-        if XRayEnabled:
-            xray_recorder.begin_segment(SegmentName)
-        try:
-            def receive_messages():
-                return sqs_client.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=1, WaitTimeSeconds=20)  # Long polling
-            def delete_message(receipt_handle):
-                return sqs_client.delete_message(QueueUrl=queue_url,ReceiptHandle=receipt_handle)
-            messages = execute_with_xray(SQSName, receive_messages)
-            if 'Messages' in messages:
-                for message in messages['Messages']:
-                    EventSource = f"SQS {SQSName}"
-                    send_to_all_outputs(message['Body'],"","SQS", EventSource)
-                    execute_with_xray(SQSName, delete_message, message['ReceiptHandle'])
-                    LogMessage(f"Mensagem deletada da fila: {SQSName} {message['Body']}")
-        except Exception as e:
-            LogMessage(f"Erro ao processar mensagem da fila {queue_url}: {e}")
-        finally:
-            if XRayEnabled:
-                xray_recorder.end_segment()
-
-
-
-
+    for consumer in SQSConsumers:
+        consumer.start()
+
+# Grava as métricas ainda pendentes no encerramento
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Os consumidores SQS terminam o lote em andamento (as mensagens não confirmadas voltam à fila)
+    for consumer in SQSConsumers:
+        consumer.stop()
+    for consumer in SQSConsumers:
+        await asyncio.get_running_loop().run_in_executor(None, consumer.join)
+    # Termina as requisições em andamento e as mensagens aceitas (202) ainda na fila
+    await asyncio.get_running_loop().run_in_executor(None, RequestExecutor.shutdown)
+    flush_metrics()
+
+# Cada fila SQS tem workers que recebem lotes de até 10 mensagens, encaminham o lote com um único
+# fan-out e o confirmam com DeleteMessageBatch. Com SQS_AUTOSCALE=True o número de workers acompanha
+# a profundidade da fila, entre SQS_MIN_WORKERS e SQS_MAX_WORKERS e limitado pela CPU (ver
+# cloudman_hub.sqs_consumer); sem ele ficam SQS_CONSUMER_WORKERS workers por fila.
+# O corpo da mensagem segue como POST para os ALBs; as mensagens que algum target não recebeu
+# ficam na fila e são entregues de novo.
+SQSConsumers = [
+    SQSConsumer(sqs_client, queue_url, SQSName,
+                lambda Inputs, SQSName=SQSName: send_batch_to_all_outputs(Inputs, "", "POST", f"SQS {SQSName}"),
+                segment=SegmentName)
+    for sqs_client, queue_url, SQSName in SQSSourceList]
@@ -1,5 +1,6 @@
 # Importações
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 import boto3
 from botocore.exceptions import ClientError
 import json
@@ -10,9 +11,23 @@ from dotenv import load_dotenv
 import asyncio
 from contextlib import asynccontextmanager
 from concurrent.futures import ThreadPoolExecutor
-from threading import Semaphore
-from threading import Lock
+from threading import Lock, BoundedSemaphore
 import requests
+# Código compartilhado dos hubs (pasta python/ do Lambda Layer cloudman_hub)
+from cloudman_hub import get_client, set_log_function
+from cloudman_hub.fanout import FanOut
+from cloudman_hub.http_pool import HTTPConnectTimeout, HTTPReadTimeout
+from cloudman_hub.envelope import forward
+from cloudman_hub.codec import quoted
+from cloudman_hub.metrics import get_hop_metrics, flush_metrics
+from cloudman_hub.rds import RDSSink, connect_database, match_credentials, mysql_enabled
+from cloudman_hub.batch import send_each
+from cloudman_hub.sinks import build_sinks, dispatch, get_sink_executor
+from cloudman_hub.sqs_consumer import SQSConsumer
+from cloudman_hub.discovery import get_discovery_cache
+from cloudman_hub.xray import set_recorder, get_recorder, execute_with_xray
+from cloudman_hub.ssm import get_ssm_counter, SSMFlushInterval
+from cloudman_hub.hubconfig import targets, resolved
 import random
 import uuid
 import time # Importar time para a lógica de espera
@@ -25,14 +40,6 @@ try:
 except ImportError:
     watchtower = None
 
-database = os.getenv(f"AWS_DB_INSTANCE_TARGET_NAME_0")
-if database is not None:
-    try:
-        import mysql.connector
-        from mysql.connector import Error
-        import pymysql
-    except ImportError:
-        mysql = None
 load_dotenv()
 
 ClaudMapNamespaceName = os.environ.get(
@@ -62,11 +69,18 @@ StatusLogsEnabled = VarLogs == "True" and CloudWatchName != ""
 # Se a variável não estiver definida, os.getenv retorna 'false', resultando em False.
 enable_custom_health_check = os.getenv('CLOUDMAP_CUSTOM_HEALTHCHECK', 'false').lower() == 'true'
 
+# Workers que executam o fan-out das requisições HTTP, fora do event loop.
+RequestMaxWorkers = int(os.getenv("REQUEST_MAX_WORKERS", str(max(8, 4 * (os.cpu_count() or 1)))))
+# ACCEPT_ASYNC=True: a mensagem é enfileirada e a requisição recebe 202 sem esperar os targets;
+# com ACCEPT_QUEUE_SIZE mensagens pendentes as novas requisições recebem 503.
+AcceptAsync = os.getenv("ACCEPT_ASYNC", "False") == "True"
+AcceptQueueSize = int(os.getenv("ACCEPT_QUEUE_SIZE", "1000"))
+
 
 if Region:
     boto3.setup_default_session(region_name=Region)
 
-APP_LOG_PATH = "/var/log/ec2hub/EC2Hub.log"
+APP_LOG_PATH = os.getenv("EC2HUB_LOG_PATH", "/var/log/ec2hub/EC2Hub.log")
 
 # Configura o logging para escrever no arquivo
 logging.basicConfig(
@@ -96,6 +110,10 @@ def LogMessage(Msg):
     if StatusLogsEnabled:
         logger.info(Msg)
 
+
+# As mensagens do código compartilhado (cloudman_hub) vão para o mesmo log.
+set_log_function(LogMessage)
+
 LogMessage(f"Módulo Python carregado. Inicio {PrimesFloor}, {PrimesCeil}")
 # Loga o status do health check customizado
 LogMessage(f"Cloud Map Custom Health Check ativado: {enable_custom_health_check}")
@@ -111,17 +129,31 @@ if XRay == "True":
         LogMessage("AVISO: XRay SDK não encontrado. XRay desabilitado.")
 else:
     XRayEnabled = False
+# As chamadas aos targets do código compartilhado ficam em subsegmentos quando o X-Ray está habilitado.
+set_recorder(xray_recorder if XRayEnabled else None)
 
 # ==============================================================================
 # ---> INÍCIO DA SEÇÃO COM A SOLUÇÃO FINAL (LÓGICA DE REPETIÇÃO) <---
 #
 CLOUD_MAP_REGISTRATIONS = []
 health_check_task = None
+ssm_flush_task = None
+
+
+async def flush_ssm_counters_task():
+    """Grava periodicamente os incrementos SSM acumulados, mesmo sem novas mensagens."""
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(SSMFlushInterval)
+        try:
+            await loop.run_in_executor(None, get_ssm_counter().flush)
+        except Exception as e:
+            LogMessage(f"SSM: erro ao gravar contadores: {e}")
 
 
 def register_instance_in_cloud_map():
     """Registra a instância nos serviços Cloud Map configurados."""
-    servicediscovery_client = boto3.client('servicediscovery')
+    servicediscovery_client = get_client('servicediscovery')
     for i in range(10):
         service_arn_var = f"AWS_SERVICE_DISCOVERY_SERVICE_TARGET_ARN_REG_{i}"
         service_arn = os.getenv(service_arn_var)
@@ -158,7 +190,7 @@ def deregister_instance_from_cloud_map():
     if not CLOUD_MAP_REGISTRATIONS:
         return
     LogMessage("Cloud Map [Desregistro]: Iniciando desregistro...")
-    servicediscovery_client = boto3.client('servicediscovery')
+    servicediscovery_client = get_client('servicediscovery')
     for reg in CLOUD_MAP_REGISTRATIONS:
         try:
             servicediscovery_client.deregister_instance(
@@ -172,7 +204,7 @@ def deregister_instance_from_cloud_map():
 async def update_custom_health_status_task():
     """Tarefa em background que envia atualizações de status 'HEALTHY' com lógica de repetição."""
     LogMessage("Cloud Map [Health Check]: Iniciando tarefa de health check customizado com lógica de repetição.")
-    servicediscovery_client = boto3.client('servicediscovery')
+    servicediscovery_client = get_client('servicediscovery')
     
     # Aguarda um pouco antes da primeira tentativa para dar tempo de propagação
     await asyncio.sleep(5) 
@@ -222,10 +254,12 @@ async def update_custom_health_status_task():
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # --- LÓGICA DE STARTUP ---
-    global health_check_task
+    global health_check_task, ssm_flush_task
     LogMessage("Iniciando ciclo de vida da aplicação (lifespan)...")
-    if SQSSourceList:
-        asyncio.create_task(process_sqs_messages())
+    for consumer in SQSConsumers:
+        consumer.start()
+    if targets("SSMParameterTarget"):
+        ssm_flush_task = asyncio.create_task(flush_ssm_counters_task())
     if EC2_INSTANCE_ID and EC2_INSTANCE_IPV4:
         register_instance_in_cloud_map()
         # --- ALTERAÇÃO: Verificação da variável para iniciar o health check ---
@@ -246,6 +280,18 @@ async def lifespan(app: FastAPI):
         health_check_task.cancel()
         await asyncio.sleep(1)
     deregister_instance_from_cloud_map()
+    if ssm_flush_task:
+        ssm_flush_task.cancel()
+    # Os consumidores SQS terminam o lote em andamento (as mensagens não confirmadas voltam à fila)
+    for consumer in SQSConsumers:
+        consumer.stop()
+    for consumer in SQSConsumers:
+        await asyncio.get_running_loop().run_in_executor(None, consumer.join)
+    # Termina as requisições em andamento e as mensagens aceitas (202) ainda na fila
+    await asyncio.get_running_loop().run_in_executor(None, RequestExecutor.shutdown)
+    # Grava os incrementos SSM e as métricas ainda pendentes
+    get_ssm_counter().flush()
+    flush_metrics()
     LogMessage("Encerramento da aplicação concluído.")
 #
 # ---> FIM DA SEÇÃO COM A SOLUÇÃO FINAL <---
@@ -281,10 +327,21 @@ def list_instances_of_service(client, service_id):
     return instances
 
 
-if ClaudMapNamespaceName != "" and dns:
+# O namespace resolvido na geração da configuração do hub dispensa as chamadas ao Cloud Map.
+ResolvedNamespace = resolved("CloudMap", ClaudMapNamespaceName) if ClaudMapNamespaceName else None
+if ResolvedNamespace is not None:
+    LogMessage(
+        f"Cloud Map [Configuração]: Namespace ID: {ResolvedNamespace['Id']}")
+    for service in ResolvedNamespace['Services']:
+        LogMessage(
+            f"Cloud Map [Configuração]: Serviço: {service['Name']} (ID: {service['Id']})")
+        for instance in service['Instances']:
+            LogMessage(f"  -> Instância: {instance['Id']}")
+            for key, value in instance['Attributes'].items():
+                LogMessage(f"     {key}: {value}")
+elif ClaudMapNamespaceName != "" and dns:
     try:
-        ClientService = boto3.client(
-            'servicediscovery', region_name=ClaudMapServiceRegion)
+        ClientService = get_client('servicediscovery', ClaudMapServiceRegion)
         if XRayEnabled:
             xray_recorder.begin_segment(SegmentName)
         ClaudMapNamespaceID = find_namespace_id_by_name(
@@ -334,352 +391,166 @@ def generate_primes(floor, ceil):
     return f" Primes Generated: {len(primes)}"
 
 
-def execute_with_xray(segment_name, function, *args, **kwargs):
-    if XRayEnabled:
-        with xray_recorder.in_subsegment(segment_name):
-            return function(*args, **kwargs)
-    return function(*args, **kwargs)
+# Timeouts (conexão, leitura) dos POST/GET para os ALBs e Tasks, os mesmos do pool HTTP: abaixo do
+# FANOUT_TARGET_TIMEOUT, a chamada não segue rodando muito depois de o target dar TIMEOUT.
+RequestTimeout = (HTTPConnectTimeout, HTTPReadTimeout)
 
 
 def send_request(Name, URL, Method, message_body=None):
+    """Retorna True quando o destino respondeu 200."""
     try:
         headers = {'Content-Type': 'application/json'}
+        # A mensagem já é JSON: entra como texto no corpo sem ser serializada de novo.
         def post_request(): return requests.post(
-            URL, data=json.dumps({"MSG Data": message_body}), headers=headers)
+            URL, data='{"MSG Data":' + quoted(message_body) + '}', headers=headers, timeout=RequestTimeout)
 
-        def get_request(): return requests.get(URL, headers=headers)
+        def get_request(): return requests.get(URL, headers=headers, timeout=RequestTimeout)
         if Method == "POST":
             response = execute_with_xray(Name, post_request)
         elif Method == "GET":
             response = execute_with_xray(Name, get_request)
         else:
             LogMessage("Unknown Method")
-            return
+            return False
         if response.status_code != 200:
             LogMessage(
                 f"Erro ao enviar para {Name} em {URL}: Status Code {response.status_code}")
+        return response.status_code == 200
     except requests.exceptions.RequestException as e:
         LogMessage(f"Exceção ao enviar para {Name} em {URL}: {e}")
+        return False
 
 
-def create_connection(host_name, user_name, user_password, db_name):
-    if not mysql:
-        LogMessage(
-            "AVISO: Módulo MySQL não está instalado. Pulando conexão com RDS.")
-        return None
-    connection = None
-    try:
-        connection = mysql.connector.connect(
-            host=host_name, user=user_name, passwd=user_password, database=db_name)
-        LogMessage(f"Conexão ao MySQL DB '{db_name}' bem-sucedida")
-    except Error as e:
-        LogMessage(f"O erro '{e}' ocorreu ao conectar no MySQL '{db_name}'")
-    return connection
-
-
-def execute_query(connection, query, values=None):
-    if not connection:
-        return
-    cursor = connection.cursor()
-    try:
-        if values:
-            cursor.execute(query, values)
-        else:
-            cursor.execute(query)
-        connection.commit()
-    except Error as e:
-        LogMessage(f"O erro '{e}' ocorreu ao executar query")
-
-
-def init_table(table_resource, TableName):
-    if XRayEnabled:
-        xray_recorder.begin_segment(SegmentName)
-    try:
-        response = execute_with_xray(
-            TableName, table_resource.get_item, Key={'ID': "1"})
-        if 'Item' not in response:
-            ItemData = f"Criado por {InstanceName}"
-            execute_with_xray(TableName, table_resource.put_item, Item={
-                              'ID': "1", "InstanceName": ItemData, 'Cont': 0})
-    except Exception as e:
-        LogMessage(f"Erro ao iniciar a tabela {TableName}: {e}")
-    finally:
-        if XRayEnabled:
-            xray_recorder.end_segment()
-
-
-SQSTargetClients, SQSNameList = [], []
-i = 0
-while True:
-    Name, R, URL = (os.getenv(f"AWS_SQS_QUEUE_TARGET_NAME_{i}"), os.getenv(
-        f"AWS_SQS_QUEUE_TARGET_REGION_{i}"), os.getenv(f"AWS_SQS_QUEUE_TARGET_URL_{str(i)}"))
-    if Name:
-        SQSTargetClients.append(
-            (boto3.client('sqs', region_name=R), URL, Name))
-        SQSNameList.append(Name)
-    else:
-        break
-    i += 1
-LogMessage(f"SQS Target Total: {i} {SQSNameList}")
-
-SNSTargetClients, SNSNameList = [], []
-i = 0
-while True:
-    Name, R, ARN = (os.getenv(f"AWS_SNS_TOPIC_TARGET_NAME_{i}"), os.getenv(
-        f"AWS_SNS_TOPIC_TARGET_REGION_{i}"), os.getenv(f"AWS_SNS_TOPIC_TARGET_ARN_{str(i)}"))
-    if Name:
-        SNSTargetClients.append(
-            (boto3.client('sns', region_name=R), ARN, Name))
-        SNSNameList.append(Name)
-    else:
-        break
-    i += 1
-LogMessage(f"SNS Target Total: {i} {SNSNameList}")
-
-DynamoDBTargetList, DynamoNameList = [], []
-i = 0
-while True:
-    TableName, R = (os.getenv(f"AWS_DYNAMODB_TABLE_TARGET_NAME_{i}"), os.getenv(
-        f"AWS_DYNAMODB_TABLE_TARGET_REGION_{i}"))
-    if TableName:
-        dynamodb = boto3.resource('dynamodb', region_name=R)
-        table_resource = dynamodb.Table(TableName)
-        DynamoDBTargetList.append((dynamodb, table_resource, TableName))
-        DynamoNameList.append(TableName)
-        init_table(table_resource, TableName)
-    else:
-        break
-    i += 1
-LogMessage(f"DynamoDB Target Total: {i} {DynamoNameList}")
-
-S3TargetList, S3NameList = [], []
-i = 0
-while True:
-    Name, R = (os.getenv(f"AWS_S3_BUCKET_TARGET_NAME_{i}"), os.getenv(
-        f"AWS_S3_BUCKET_TARGET_REGION_{i}"))
-    if Name:
-        S3TargetList.append((boto3.client('s3', region_name=R), Name))
-        S3NameList.append(Name)
-    else:
-        break
-    i += 1
-LogMessage(f"S3 Target Total: {i} {S3NameList}")
-
-EFSTargetList, EFSNameList = [], []
-i = 0
-while True:
-    Name, Path = (os.getenv(f"AWS_EFS_FILE_SYSTEM_TARGET_NAME_{i}"), os.getenv(
-        f"AWS_EFS_ACCESS_POINT_TARGET_PATH_{i}"))
-    if Name:
-        EFSTargetList.append([Name, Path])
-        EFSNameList.append(Name)
-    else:
-        break
-    i += 1
-LogMessage(f"EFS Target Total: {i} {EFSNameList}")
-
-LambdaTargetList, LambdaNameList = [], []
-i = 0
-while True:
-    FunctionName, R = (os.getenv(f"AWS_LAMBDA_FUNCTION_TARGET_NAME_{i}"), os.getenv(
-        f"AWS_LAMBDA_FUNCTION_TARGET_REGION_{i}"))
-    if FunctionName:
-        LambdaTargetList.append(
-            (boto3.client('lambda', region_name=R), FunctionName))
-        LambdaNameList.append(FunctionName)
-    else:
-        break
-    i += 1
-LogMessage(f"Lambda Target Total: {i} {LambdaNameList}")
-
-ALBTargetURLs, ALBNameList = [], []
-i = 0
-while True:
-    URL, ALBName = (
-        os.getenv(f"AWS_LB_DNS_NAME_{i}"), os.getenv(f"AWS_LB_NAME_{i}"))
-    if URL:
-        ALBTargetURLs.append([ALBName, URL])
-        ALBNameList.append(ALBName)
-    else:
-        break
-    i += 1
-LogMessage(f"ALB Target Total: {i} {ALBNameList}")
+# Os targets vêm da configuração pré-compilada do hub (HUB_CONFIG_FILE) quando ela acompanha
+# o container, senão das variáveis de ambiente AWS_*_TARGET_*_{i} (ver cloudman_hub.hubconfig).
+ALBTargetURLs = [[Target["Name"], Target["URL"]] for Target in targets("ALBTarget")]
+ALBNameList = [Target["Name"] for Target in targets("ALBTarget")]
+LogMessage(f"ALB Target Total: {len(ALBNameList)} {ALBNameList}")
 
 ContainerTargetList, ContainerNameList = [], []
 if ClaudMapNamespaceName:
-    i = 0
-    while True:
-        ContainerName, R = (os.getenv(f"CONTAINER_TARGET_NAME_{i}"), os.getenv(
-            f"CONTAINER_TARGET_REGION_{i}"))
-        if ContainerName:
-            ContainerTargetList.append([ContainerName, R])
-            ContainerNameList.append(ContainerName)
-        else:
-            break
-        i += 1
-    LogMessage(f"Containers Target Total: {i} {ContainerNameList}")
+    ContainerTargetList = [[Target["Name"], Target["Region"]] for Target in targets("ContainerTarget")]
+    ContainerNameList = [Target["Name"] for Target in targets("ContainerTarget")]
+    LogMessage(f"Containers Target Total: {len(ContainerNameList)} {ContainerNameList}")
 
 SQSSourceList, SQSNameList_Source = [], []
-i = 0
-while True:
-    Name, R, URL = (os.getenv(f"AWS_SQS_QUEUE_SOURCE_NAME_{i}"), os.getenv(
-        f"AWS_SQS_QUEUE_SOURCE_REGION_{i}"), os.getenv(f"AWS_SQS_QUEUE_SOURCE_URL_{str(i)}"))
-    if Name:
-        SQSSourceList.append((boto3.client('sqs', region_name=R), URL, Name))
-        SQSNameList_Source.append(Name)
-    else:
-        break
-    i += 1
-LogMessage(f"SQS Queue Source Total: {i} {SQSNameList_Source}")
+for Target in targets("SQSSource"):
+    SQSSourceList.append((get_client('sqs', Target["Region"]), Target["URL"], Target["Name"]))
+    SQSNameList_Source.append(Target["Name"])
+LogMessage(f"SQS Queue Source Total: {len(SQSNameList_Source)} {SQSNameList_Source}")
 
 SecretsCredentials, SecretNameList = [], []
-i = 0
-while True:
-    SecretName, SecretARN = (os.getenv(f"AWS_SECRETSMANAGER_SECRET_VERSION_SOURCE_NAME_{i}"), os.getenv(
-        f"AWS_SECRETSMANAGER_SECRET_VERSION_SOURCE_ARN_{i}"))
-    if SecretName:
-        try:
-            client = boto3.client('secretsmanager', region_name=Region)
-            response = client.get_secret_value(SecretId=SecretARN)
-            secret = json.loads(response['SecretString'])
-            SecretsCredentials.append(
-                [SecretName, secret['username'], secret['password']])
-            SecretNameList.append(SecretName)
-        except Exception as e:
-            LogMessage(f"Erro ao obter o segredo '{SecretName}': {e}")
-    else:
-        break
-    i += 1
-LogMessage(f"Secrets Target Total: {i} {SecretNameList}")
-
-RDSConnections, DataBaseList = [], []
-i = 0
-while True:
-    database_name = os.getenv(f"AWS_DB_INSTANCE_TARGET_NAME_{i}")
-    if database_name:
-        if XRayEnabled:
-            xray_recorder.begin_segment(SegmentName)
-        EndPoint = os.getenv(f"AWS_DB_INSTANCE_TARGET_ENDPOINT_{i}")
-        Host = EndPoint.split(":")[0]
-        username, password = "default_user", "default_pass"
-        for secret_info in SecretsCredentials:
-            if database_name in secret_info[0]:
-                username, password = secret_info[1], secret_info[2]
-                break
-        connection = create_connection(Host, username, password, database_name)
-        if connection:
-            RDSConnections.append([connection, database_name])
-            DataBaseList.append(database_name)
-            create_table_query = "CREATE TABLE IF NOT EXISTS exemplo (id INT AUTO_INCREMENT, texto VARCHAR(4000) NOT NULL, PRIMARY KEY (id))"
-            execute_query(connection, create_table_query)
-        if XRayEnabled:
-            xray_recorder.end_segment()
-    else:
-        break
-    i += 1
-LogMessage(f"RDS Target Total: {i} {DataBaseList}")
-
-SSMParameterTargetName, SSMParameterTargetRegion = [], []
-i = 0
-while True:
-    Name, R = (os.getenv(f"AWS_SSM_PARAMETER_TARGET_NAME_{str(i)}"), os.getenv(
-        f"AWS_SSM_PARAMETER_TARGET_REGION_{str(i)}"))
-    if Name and R:
-        SSMParameterTargetName.append(Name)
-        SSMParameterTargetRegion.append(R)
-    else:
-        break
-    i += 1
-LogMessage(f"SSM Parameter Target Total: {i} {SSMParameterTargetName}")
-
-send_to_all_outputs_semaphore = Semaphore(1)
-
-
-def _send_to_all_outputs_helper(message_body, URLPath, Method, Agora):
-    for sqs_client, queue_url, Name in SQSTargetClients:
-        execute_with_xray(Name, sqs_client.send_message,
-                          QueueUrl=queue_url, MessageBody=message_body)
-        LogMessage(f"Send message to SQS: {Name}")
-    for sns_client, topic_arn, Name in SNSTargetClients:
-        execute_with_xray(Name, sns_client.publish,
-                          TopicArn=topic_arn, Message=message_body)
-        LogMessage(f"Send message to SNS: {Name}")
-    for dynamodb, Table, TableName in DynamoDBTargetList:
-        response = execute_with_xray(
-            TableName, Table.get_item, Key={'ID': "1"})
-        if 'Item' in response:
-            item = response['Item']
-            cont = item.get('Cont', 0) + 1
-            execute_with_xray(TableName, Table.update_item, Key={
-                              'ID': "1"}, UpdateExpression='SET Cont = :val1', ExpressionAttributeValues={':val1': cont})
-            ID = f"{InstanceName}:{Agora.isoformat()}"
-            execute_with_xray(TableName, Table.put_item, Item={
-                              'ID': ID, "Message": message_body})
-            LogMessage(f"Put Item: {TableName}")
-    for s3_client, bucket_name in S3TargetList:
-        file_path = f"{InstanceName}/{InstanceName}:{Agora.isoformat()}.txt"
-        execute_with_xray(bucket_name, s3_client.put_object,
-                          Bucket=bucket_name, Key=file_path, Body=message_body)
-        LogMessage(f"Put Object: {bucket_name}")
-    for EFSName, mount_path in EFSTargetList:
-        try:
-            if not os.path.exists(mount_path):
-                os.makedirs(mount_path)
-            file_path = os.path.join(
-                mount_path, f"{EFSName}-{Agora.strftime('%Y%m%d%H%M%S')}.txt")
-            with open(file_path, 'w') as file:
-                file.write(message_body)
-            LogMessage(f"Save Message EFS: {EFSName}: {mount_path}")
-        except Exception as e:
-            LogMessage(f"Erro ao escrever no EFS {EFSName}: {e}")
+for Target in targets("SecretSource"):
+    SecretName = Target["Name"]
+    try:
+        client = get_client('secretsmanager', Region)
+        response = client.get_secret_value(SecretId=Target["ARN"])
+        secret = json.loads(response['SecretString'])
+        SecretsCredentials.append(
+            [SecretName, secret['username'], secret['password']])
+        SecretNameList.append(SecretName)
+    except Exception as e:
+        LogMessage(f"Erro ao obter o segredo '{SecretName}': {e}")
+LogMessage(f"Secrets Target Total: {len(targets('SecretSource'))} {SecretNameList}")
+
+# Sinks RDS: a conexão é aberta no primeiro uso (e reaberta se cair) e a tabela é criada a cada nova conexão.
+# Requisições e consumidores SQS chamam get_rds_sink ao mesmo tempo: um único sink por banco.
+RDSSinks = {}
+RDSSinksLock = Lock()
+
+
+def get_rds_sink(database_name, Host):
+    with RDSSinksLock:
+        if database_name not in RDSSinks:
+            username, password = match_credentials(database_name, SecretsCredentials)
+            RDSSinks[database_name] = RDSSink(
+                lambda: connect_database(Host, username, password, database_name), database_name)
+        return RDSSinks[database_name]
+
+
+# Os demais targets são sinks de cloudman_hub.sinks (ALB e Container continuam abaixo, próprios deste hub).
+# Os incrementos SSM são gravados por tamanho/tempo (ver flush_ssm_counters_task).
+Sinks = build_sinks(InstanceName, Region, AccountID,
+                    kinds=("SQSTarget", "SNSTarget", "DynamoDBTarget", "S3Target", "EFSTarget",
+                           "LambdaTarget", "RDSTarget", "SSMParameterTarget"),
+                    lambda_source="AWS:EC2", owner_attribute="InstanceName",
+                    rds_sink=get_rds_sink if mysql_enabled() else None, ssm_flush=False)
+
+
+def post_alb(ALBName, URL, Method, Messages):
+    def post_message(message):
+        if not send_request(ALBName, URL, Method, message_body=message[1]):
+            raise RuntimeError(f"ALB {ALBName} não respondeu 200")
+    failed = send_each(post_message, Messages, get_sink_executor())
+    if len(failed) == len(Messages):
+        raise RuntimeError(f"ALB {ALBName} não respondeu 200")
+    LogMessage(f"Call ALB : {ALBName}")
+    return failed
+
+
+def post_container(ContainerName, RegionName, Messages):
+    # As instâncias vêm do cache de descoberta (renovado em segundo plano); cada mensagem vai para
+    # a instância escolhida pelo seletor DISCOVERY_SELECTOR (ver cloudman_hub.discovery).
+    def post_message(message):
+        with get_discovery_cache().instance(ClaudMapNamespaceName, ContainerName, RegionName) as instance:
+            if instance is None:
+                return
+            if not send_request(ContainerName, f"http://{instance['Host']}:{instance['Port']}/{ContainerName}",
+                                "POST", message_body=message[1]):
+                raise RuntimeError(f"Container {ContainerName} não respondeu 200")
+    failed = send_each(post_message, Messages, get_sink_executor())
+    if len(failed) == len(Messages):
+        raise RuntimeError(f"Container {ContainerName} não respondeu 200")
+    return failed
+
+
+def _send_to_all_outputs_helper(Messages, URLPath, Method):
+    # Todos os targets são disparados em paralelo; duração, bytes e resultado de cada um são
+    # agregados por target e gravados como linhas EMF (ver cloudman_hub.sinks.dispatch).
+    fan_out = FanOut(recorder=get_recorder())
     for ALBName, URL in ALBTargetURLs:
-        send_request(ALBName, f"http://{URL}/{URLPath}",
-                     Method, message_body=message_body)
-        LogMessage(f"Call ALB : {ALBName}")
+        fan_out.add(ALBName, "ALB", post_alb, ALBName, f"http://{URL}/{URLPath}", Method, Messages)
     for ContainerName, RegionName in ContainerTargetList:
-        def discover_service_instances(service_name, namespace_name): return boto3.client(
-            'servicediscovery', region_name=RegionName).discover_instances(NamespaceName=namespace_name, ServiceName=service_name)
-        response = execute_with_xray(
-            "DiscoverInstances", discover_service_instances, ContainerName, ClaudMapNamespaceName)
-        if response.get('Instances'):
-            instance = random.choice(response['Instances'])
-            Host = instance['Attributes'].get('AWS_INSTANCE_IPV4')
-            Port = instance['Attributes'].get('AWS_INSTANCE_PORT')
-            if Host and Port:
-                URL = f"http://{Host}:{Port}/{ContainerName}"
-                send_request(ContainerName, URL, "POST",
-                             message_body=message_body)
-    for lambda_client, function_name in LambdaTargetList:
-        payload = json.dumps({'message': message_body, "source": "AWS:EC2"})
-        execute_with_xray(function_name, lambda_client.invoke,
-                          FunctionName=function_name, InvocationType='Event', Payload=payload)
-        LogMessage(f"Invoke lambda: {function_name}")
-    for connection, db_name in RDSConnections:
-        insert_query = "INSERT INTO exemplo (texto) VALUES (%s)"
-        execute_query(connection, insert_query, (json.dumps(message_body),))
-        LogMessage(f"Item inserido no banco de dados '{db_name}'")
-    for Name, region in zip(SSMParameterTargetName, SSMParameterTargetRegion):
-        ssm_client = boto3.client('ssm', region_name=region)
-        try:
-            response = execute_with_xray(
-                Name, ssm_client.get_parameter, Name=Name, WithDecryption=True)
-            new_value = str(int(response['Parameter']['Value']) + 1)
-            execute_with_xray(Name, ssm_client.put_parameter, Name=Name,
-                              Value=new_value, Type='String', Overwrite=True)
-            LogMessage(f"Parameter {Name} updated with {new_value}")
-        except Exception as e:
-            LogMessage(f"Error processing SSM parameter {Name}: {e}")
+        fan_out.add(ContainerName, "Container", post_container, ContainerName, RegionName, Messages)
+    FanOutResult, failed = dispatch(Sinks, Messages, InstanceName, fan_out)
+    LogMessage(f"Fan-out result: {json.dumps(FanOutResult)}")
+    return failed
+
+
+def send_batch_to_all_outputs(Inputs, URLPath="", Method="GET", EventSource=""):
+    """
+    Encaminha um lote de mensagens com um único fan-out.
+    :param Inputs: Lista de (RecordID, corpo da mensagem); RecordID é o MessageId SQS ou None.
+    :return: RecordIDs das mensagens que algum target não recebeu.
+    """
+    # Momento do recebimento, gravado no hop para as métricas de latência (inclui o cálculo de primos).
+    Received = time.time()
+    # Messages: um (RecordID, NewMessage, Stamp) por mensagem a ser encaminhada.
+    Messages = []
+    for n, (RecordID, message_body) in enumerate(Inputs):
+        Primes = generate_primes(PrimesFloor, PrimesCeil)
+        LogMessage(f"Event Source: {EventSource} Primes: {Primes}")
+        Agora = datetime.datetime.now()
+        # O payload segue inalterado no envelope; esta instância apenas se acrescenta à lista de hops.
+        Envelope, NewMessage = forward(message_body, InstanceName, received=Received)
+        if NewMessage is None:
+            LogMessage(f"Loop encontrado! {Envelope.get('Hops')}")
+            continue
+        # Os histogramas são gravados a cada METRICS_FLUSH_INTERVAL segundos.
+        get_hop_metrics().record(Envelope)
+        LogMessage(f"Message to be sent: {NewMessage}")
+        # Stamp torna únicos os IDs do DynamoDB e os nomes de arquivo dentro de um lote.
+        Stamp = Agora.isoformat() if len(Inputs) == 1 else f"{Agora.isoformat()}-{n}"
+        Messages.append((RecordID, NewMessage, Stamp))
+    if not Messages:
+        return []
+    # Sem trava global: requisições e consumidores SQS fazem fan-outs simultâneos; cada sink limita
+    # os próprios envios (SINK_CONCURRENCY) e o RDS envia um lote por vez (ver cloudman_hub.sinks).
+    return _send_to_all_outputs_helper(Messages, URLPath, Method)
 
 
 def send_to_all_outputs(message_body, URLPath="", Method="GET", EventSource=""):
-    Primes = generate_primes(PrimesFloor, PrimesCeil)
-    full_message_body = message_body + " " + Primes
-    LogMessage(f"Event Source: {EventSource}")
-    Agora = datetime.datetime.now()
-    NewMessage = f"Instance: {InstanceName}. Source: {Method}. Date/Time: {str(Agora)}. <- {full_message_body}"
-    LogMessage(f"Message to be sent: {NewMessage}")
-    with send_to_all_outputs_semaphore:
-        _send_to_all_outputs_helper(NewMessage, URLPath, Method, Agora)
+    send_batch_to_all_outputs([(None, message_body)], URLPath, Method, EventSource)
 
 
 @app.get("/health")
@@ -687,65 +558,63 @@ async def health_check():
     return {"status": "healthy"}
 
 
-@app.api_route("/{full_path:path}", methods=["GET", "POST"])
-async def catch_all_requests(full_path: str, request: Request):
-    Agora = datetime.datetime.now()
-    message_content = f"Received raw {request.method} request at {Agora}."
+# O fan-out (boto3, requests, primos) bloqueia: roda neste pool, para que um target lento não
+# trave o event loop, as demais requisições e o /health.
+RequestExecutor = ThreadPoolExecutor(max_workers=RequestMaxWorkers, thread_name_prefix="request")
+AcceptSlots = BoundedSemaphore(AcceptQueueSize)
+
+
+def process_request(message_content, full_path, Method):
+    # O segmento X-Ray é aberto na thread que faz as chamadas aos targets.
     if XRayEnabled:
         xray_recorder.begin_segment(SegmentName)
     try:
-        if request.method == "POST":
-            try:
-                message_content = str(await request.json())
-            except Exception:
-                message_content = (await request.body()).decode('utf-8', errors='ignore')
-        send_to_all_outputs(message_content, full_path,
-                            request.method, f"HTTP {request.method}")
-        return {"message": f"{request.method} received. Instance: {InstanceName} path: /{full_path}"}
-    except Exception as e:
-        LogMessage(f"Erro ao processar requisição {request.method}: {e}")
-        return {"status": "Error", "message": str(e)}, 500
+        send_to_all_outputs(message_content, full_path, Method, f"HTTP {Method}")
     finally:
         if XRayEnabled:
             xray_recorder.end_segment()
 
 
-Count = 0
-count_lock = Lock()
-
-
-async def process_sqs_messages():
-    global Count
-    with count_lock:
-        Count += 1
-        LogMessage(f"LoopMain {Count} {InstanceName}")
-    with ThreadPoolExecutor(max_workers=len(SQSSourceList)) as executor:
-        loop = asyncio.get_event_loop()
-        tasks = [loop.run_in_executor(executor, process_messages_from_queue, sqs_client,
-                                      queue_url, SQSName) for sqs_client, queue_url, SQSName in SQSSourceList]
-        await asyncio.gather(*tasks)
+def process_accepted_request(message_content, full_path, Method):
+    try:
+        process_request(message_content, full_path, Method)
+    except Exception as e:
+        LogMessage(f"Erro ao processar requisição {Method} aceita: {e}")
+    finally:
+        AcceptSlots.release()
 
 
-def process_messages_from_queue(sqs_client, queue_url, SQSName):
-    while True:
-        if XRayEnabled:
-            xray_recorder.begin_segment(SegmentName)
-        try:
-            def receive_messages(): return sqs_client.receive_message(
-                QueueUrl=queue_url, MaxNumberOfMessages=1, WaitTimeSeconds=20)
-
-            def delete_message(receipt_handle): return sqs_client.delete_message(
-                QueueUrl=queue_url, ReceiptHandle=receipt_handle)
-            messages = execute_with_xray(SQSName, receive_messages)
-            if 'Messages' in messages:
-                for message in messages['Messages']:
-                    send_to_all_outputs(
-                        message['Body'], "", "SQS", f"SQS {SQSName}")
-                    execute_with_xray(SQSName, delete_message,
-                                      message['ReceiptHandle'])
-                    LogMessage(f"Mensagem deletada da fila: {SQSName}")
-        except Exception as e:
-            LogMessage(f"Erro ao processar mensagem da fila {queue_url}: {e}")
-        finally:
-            if XRayEnabled:
-                xray_recorder.end_segment()
+@app.api_route("/{full_path:path}", methods=["GET", "POST"])
+async def catch_all_requests(full_path: str, request: Request):
+    Agora = datetime.datetime.now()
+    message_content = f"Received raw {request.method} request at {Agora}."
+    try:
+        if request.method == "POST":
+            # O corpo é decodificado uma única vez, por forward (JSON ou texto).
+            message_content = await request.body()
+        if AcceptAsync:
+            if not AcceptSlots.acquire(blocking=False):
+                return JSONResponse({"status": "Busy", "message": f"{AcceptQueueSize} mensagens pendentes"},
+                                    status_code=503)
+            RequestExecutor.submit(process_accepted_request, message_content, full_path, request.method)
+            return JSONResponse({"message": f"{request.method} accepted. Instance: {InstanceName} path: /{full_path}"},
+                                status_code=202)
+        await asyncio.get_running_loop().run_in_executor(
+            RequestExecutor, process_request, message_content, full_path, request.method)
+        return {"message": f"{request.method} received. Instance: {InstanceName} path: /{full_path}"}
+    except Exception as e:
+        LogMessage(f"Erro ao processar requisição {request.method}: {e}")
+        return JSONResponse({"status": "Error", "message": "Erro interno ao processar a requisição"}, status_code=500)
+
+
+# Cada fila SQS tem workers que recebem lotes de até 10 mensagens, encaminham o lote com um único
+# fan-out e o confirmam com DeleteMessageBatch. Com SQS_AUTOSCALE=True o número de workers acompanha
+# a profundidade da fila, entre SQS_MIN_WORKERS e SQS_MAX_WORKERS e limitado pela CPU (ver
+# cloudman_hub.sqs_consumer); sem ele ficam SQS_CONSUMER_WORKERS workers por fila.
+# O corpo da mensagem segue como POST para os ALBs; as mensagens que algum target não recebeu
+# ficam na fila e são entregues de novo.
+SQSConsumers = [
+    SQSConsumer(sqs_client, queue_url, SQSName,
+                lambda Inputs, SQSName=SQSName: send_batch_to_all_outputs(Inputs, "", "POST", f"SQS {SQSName}"),
+                segment=SegmentName)
+    for sqs_client, queue_url, SQSName in SQSSourceList]
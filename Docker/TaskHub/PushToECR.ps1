@@ -9,8 +9,8 @@ $awsProfile = "RBPM"  # Defina o nome do perfil da AWS
 # Autenticação no ECR com o perfil RBPM
 aws ecr get-login-password --region $region --profile $awsProfile | docker login --username AWS --password-stdin "$($ecrUri)"
 
-# Construir a imagem
-docker build -t $repositoryName .
+# Construir a imagem (o contexto é a raiz do repositório, para incluir o pacote cloudman_hub)
+docker build -t $repositoryName -f "$PSScriptRoot/dockerfile" "$PSScriptRoot/../.."
 
 # Marcar a imagem para o ECR
 docker tag "${repositoryName}:latest" "$($ecrUri)/$($repositoryName):$($imageTag)"
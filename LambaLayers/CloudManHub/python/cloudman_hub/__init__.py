@@ -0,0 +1,8 @@
+# file: __init__.py
+# Shared code of the CloudMan hubs (LambdaHub, LambdaHub2, CodeBuildHub, EC2Hub).
+# Deployed as the "python/" folder of a Lambda Layer; the containers and CodeBuild
+# projects add this folder to PYTHONPATH.
+
+from .log import LogMessage, set_log_function
+from .fanout import FanOut
+from .clients import get_client, get_resource
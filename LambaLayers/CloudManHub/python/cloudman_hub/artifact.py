@@ -0,0 +1,201 @@
+# file: artifact.py
+# Streaming transform of CodePipeline artifacts: the input is read with ranged GETs and
+# the output is written with multipart upload, so memory use does not grow with the artifact.
+import io
+import os
+import codecs
+import zipfile
+
+from .log import LogMessage
+
+ArtifactChunkBytes = int(os.getenv("ARTIFACT_CHUNK_BYTES", str(1024 * 1024)))
+ArtifactReadAheadBytes = int(os.getenv("ARTIFACT_READ_AHEAD_BYTES", str(1024 * 1024)))
+# S3 requires at least 5 MB for every part but the last one.
+ArtifactPartBytes = max(5 * 1024 * 1024,
+                        int(os.getenv("ARTIFACT_PART_BYTES", str(8 * 1024 * 1024))))
+TextExtensions = ('.txt',)
+ZipMagic = b'PK\x03\x04'
+
+
+class S3RangeReader(io.RawIOBase):
+    """Seekable, read-only file over an S3 object; each read is a ranged GET."""
+
+    def __init__(self, s3_client, bucket, key):
+        self.s3 = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.size = s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = self.size + offset
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.size or len(buffer) == 0:
+            return 0
+        end = min(self.position + len(buffer), self.size) - 1
+        response = self.s3.get_object(Bucket=self.bucket, Key=self.key,
+                                      Range=f"bytes={self.position}-{end}")
+        data = response['Body'].read()
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+def open_s3(s3_client, bucket, key):
+    """Buffered S3RangeReader: small reads (zip headers) are served from a read-ahead buffer."""
+    return io.BufferedReader(S3RangeReader(s3_client, bucket, key),
+                             buffer_size=ArtifactReadAheadBytes)
+
+
+class MultipartWriter:
+    """
+    Write-only file that uploads to S3 in parts of ArtifactPartBytes. Output smaller than
+    one part is written with a single put_object. The upload is aborted when the
+    writer is closed after an error (use it as a context manager).
+    """
+
+    def __init__(self, s3_client, bucket, key, part_size=None):
+        self.s3 = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = ArtifactPartBytes if part_size is None else part_size
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.closed = False
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _upload_part(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.s3.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key)['UploadId']
+        Number = len(self.parts) + 1
+        response = self.s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                       PartNumber=Number, Body=data)
+        self.parts.append({'PartNumber': Number, 'ETag': response['ETag']})
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.upload_id is None:
+            self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+        else:
+            if self.buffer:
+                self._upload_part(bytes(self.buffer))
+            self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                              MultipartUpload={'Parts': self.parts})
+        self.buffer = bytearray()
+
+    def abort(self):
+        self.closed = True
+        if self.upload_id is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def transform_text(reader, writer, function, chunk_size=None):
+    """
+    Applies function (str -> str) to a UTF-8 stream chunk by chunk. The incremental
+    decoder keeps characters split across two chunks together.
+    :return: Number of bytes read.
+    """
+    chunk_size = ArtifactChunkBytes if chunk_size is None else chunk_size
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    total = 0
+    while True:
+        chunk = reader.read(chunk_size)
+        if not chunk:
+            break
+        total += len(chunk)
+        writer.write(function(decoder.decode(chunk)).encode('utf-8'))
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        writer.write(function(tail).encode('utf-8'))
+    return total
+
+
+def transform_zip(reader, writer, function, text_extensions=TextExtensions):
+    """
+    Rewrites a zip archive entry by entry: text entries go through transform_text and
+    the others are copied unchanged. Only one entry chunk is held in memory at a time.
+    :return: Number of entries transformed.
+    """
+    transformed = 0
+    with zipfile.ZipFile(reader) as zin, zipfile.ZipFile(writer, 'w', zipfile.ZIP_DEFLATED) as zout:
+        for info in zin.infolist():
+            target = zipfile.ZipInfo(info.filename, info.date_time)
+            target.compress_type = info.compress_type
+            target.external_attr = info.external_attr
+            if info.is_dir():
+                zout.writestr(target, b'')
+                continue
+            with zin.open(info) as source, zout.open(target, 'w', force_zip64=info.file_size > 0x7fffffff) as destination:
+                if info.filename.lower().endswith(text_extensions):
+                    transform_text(source, destination, function)
+                    transformed += 1
+                else:
+                    while True:
+                        chunk = source.read(ArtifactChunkBytes)
+                        if not chunk:
+                            break
+                        destination.write(chunk)
+    return transformed
+
+
+def transform_artifact(s3_client, bucket, key, output_bucket, output_key, function=str.upper,
+                       text_extensions=TextExtensions):
+    """
+    Streams an artifact from S3 through function and writes the result to the output location.
+    Zip artifacts (what CodePipeline usually produces) are handled entry by entry; other
+    artifacts are transformed only when their key has a text extension.
+    :return: "zip", "text", or None when the artifact was not transformed.
+    """
+    reader = open_s3(s3_client, bucket, key)
+    try:
+        if reader.peek(len(ZipMagic))[:len(ZipMagic)] == ZipMagic:
+            with MultipartWriter(s3_client, output_bucket, output_key) as writer:
+                count = transform_zip(reader, writer, function, text_extensions)
+            LogMessage(f"Artifact {key}: {count} zip entries transformed into {output_key}")
+            return "zip"
+        if key.lower().endswith(text_extensions):
+            with MultipartWriter(s3_client, output_bucket, output_key) as writer:
+                size = transform_text(reader, writer, function)
+            LogMessage(f"Artifact {key}: {size} bytes transformed into {output_key}")
+            return "text"
+        return None
+    finally:
+        reader.close()
@@ -0,0 +1,142 @@
+# file: batch.py
+# Helpers for hubs that process every record of a batched SQS/SNS/S3 event.
+# A message is a tuple whose first item is the RecordID (the SQS messageId, or None
+# when the source has no partial-batch support) and whose second item is the body.
+import os
+
+from .log import LogMessage
+from .envelope import materialize
+from .codec import utf8
+
+# Limits of SendMessageBatch / PublishBatch.
+BatchMaxEntries = 10
+BatchMaxBytes = int(os.getenv("BATCH_MAX_BYTES", str(256 * 1024)))
+
+
+def _chunks(messages, max_bytes):
+    chunk, size = [], 0
+    for message in messages:
+        length = len(utf8(message[1]))
+        if chunk and (len(chunk) == BatchMaxEntries or size + length > max_bytes):
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(message)
+        size += length
+    if chunk:
+        yield chunk
+
+
+def send_message_batch(sqs_client, queue_url, messages):
+    """
+    Sends the messages to an SQS queue with SendMessageBatch (10 entries or 256 KB per call).
+    :param messages: List of (RecordID, Body, ...) tuples.
+    :return: List with the RecordID of every message that was not accepted.
+    """
+    failed = []
+    for chunk in _chunks(messages, BatchMaxBytes):
+        Entries = [{'Id': str(k), 'MessageBody': message[1]}
+                   for k, message in enumerate(chunk)]
+        try:
+            response = sqs_client.send_message_batch(
+                QueueUrl=queue_url, Entries=Entries)
+        except Exception as e:
+            LogMessage(f"SendMessageBatch to {queue_url} failed: {e}")
+            failed.extend(message[0] for message in chunk)
+            continue
+        for entry in response.get('Failed', []):
+            LogMessage(f"SQS entry rejected by {queue_url}: {entry.get('Code')} {entry.get('Message')}")
+            failed.append(chunk[int(entry['Id'])][0])
+    return failed
+
+
+def publish_batch(sns_client, topic_arn, messages, message_structure=None):
+    """
+    Publishes the messages to an SNS topic with PublishBatch (10 entries per call).
+    :param messages: List of (RecordID, Message, ...) tuples.
+    :param message_structure: 'json' when each Message holds per-protocol payloads.
+    :return: List with the RecordID of every message that was not published.
+    """
+    failed = []
+    for chunk in _chunks(messages, BatchMaxBytes):
+        Entries = []
+        for k, message in enumerate(chunk):
+            Entry = {'Id': str(k), 'Message': message[1]}
+            if message_structure:
+                Entry['MessageStructure'] = message_structure
+            Entries.append(Entry)
+        try:
+            response = sns_client.publish_batch(
+                TopicArn=topic_arn, PublishBatchRequestEntries=Entries)
+        except Exception as e:
+            LogMessage(f"PublishBatch to {topic_arn} failed: {e}")
+            failed.extend(message[0] for message in chunk)
+            continue
+        for entry in response.get('Failed', []):
+            LogMessage(f"SNS entry rejected by {topic_arn}: {entry.get('Code')} {entry.get('Message')}")
+            failed.append(chunk[int(entry['Id'])][0])
+    return failed
+
+
+def send_each(function, messages, executor=None):
+    """
+    Calls function(message) for each message, for targets without a batch API.
+    :param executor: Pool that runs the calls concurrently (None calls them one by one).
+    :return: List with the RecordID of every message whose call raised an exception.
+    """
+    failed = []
+    if executor is None or len(messages) < 2:
+        for message in messages:
+            try:
+                function(message)
+            except Exception as e:
+                LogMessage(f"Error sending message {message[0]}: {e}")
+                failed.append(message[0])
+        return failed
+    futures = [(message, executor.submit(function, message)) for message in messages]
+    for message, future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            LogMessage(f"Error sending message {message[0]}: {e}")
+            failed.append(message[0])
+    return failed
+
+
+def materialize_each(messages, max_bytes=None):
+    """
+    envelope.materialize of each message, for the targets that store the content
+    (S3, EFS, DynamoDB, RDS, CodeBuild artifacts): claim check pointers are replaced by
+    the document; a document larger than max_bytes keeps its pointer.
+    :return: (messages, RecordIDs of the messages whose document could not be read).
+    """
+    Materialized, unread = [], []
+    for message in messages:
+        try:
+            Materialized.append((message[0], materialize(message[1], max_bytes)) + tuple(message[2:]))
+        except Exception as e:
+            LogMessage(f"Claim check of message {message[0]} not read: {e}")
+            unread.append(message[0])
+    return Materialized, unread
+
+
+def failed_records(fan_out, result, messages):
+    """
+    Merges the failures of a FanOut run: a target that raised or timed out fails every
+    message; a target that returned a list fails only the RecordIDs in that list.
+    :return: Sorted list of the failed RecordIDs (None entries are dropped).
+    """
+    failed = set()
+    for entry in result["Targets"]:
+        if entry["Status"] != "OK":
+            failed.update(message[0] for message in messages)
+        else:
+            output = fan_out.outputs.get((entry["Type"], entry["Name"]))
+            if isinstance(output, list):
+                failed.update(output)
+    failed.discard(None)
+    return sorted(failed)
+
+
+def batch_item_failures(failed):
+    """Builds the partial-batch response of an SQS event source mapping (ReportBatchItemFailures)."""
+    return {"batchItemFailures": [{"itemIdentifier": RecordID} for RecordID in failed]}
@@ -0,0 +1,351 @@
+# file: benchmark.py
+# Offline fan-out benchmark of the hubs. Each scenario (hub, number of targets, batch size)
+# runs in a fresh process with in-process stand-ins of SQS, SNS, DynamoDB, S3, SSM, Lambda
+# and CodeBuild installed in clients.py; every stand-in call sleeps the injected latency,
+# so no network or AWS account is needed:
+#     python -m cloudman_hub.benchmark --hub lambda --hub ec2 --targets 1,4,16 --batch 1,10 --latency 5
+# The report gives events/s, messages/s and the p50/p95/p99 latency of each scenario.
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import random
+import logging
+import tempfile
+import argparse
+import threading
+import subprocess
+import contextlib
+import importlib.util
+
+# Hub modules, relative to the repository root.
+Hubs = {
+    "lambda": "LambdaFiles/LambdaHub/LambdaHub.py",
+    "codebuild": "CodeBuild/CodeBuildHub/CodeBuildHub.py",
+    "ec2": "Docker/TaskHub/EC2Hub.py",
+}
+# Target kinds of hubconfig.Kinds the targets are spread over (round robin).
+DefaultKinds = ("SQSTarget", "SNSTarget", "DynamoDBTarget", "S3Target", "SSMParameterTarget", "LambdaTarget")
+BenchRegion = "us-east-1"
+BenchAccount = "000000000000"
+RepositoryRoot = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "..", ".."))
+
+
+class FakeError(Exception):
+    """Error of a stand-in call, shaped like botocore's ClientError (e.response['Error']['Code'])."""
+
+    def __init__(self, code, message=""):
+        super().__init__(f"{code}: {message}")
+        self.response = {'Error': {'Code': code, 'Message': message}}
+
+
+class _Exceptions:
+    ConditionalCheckFailedException = type("ConditionalCheckFailedException", (FakeError,), {})
+
+    def __getattr__(self, name):
+        return FakeError
+
+
+class FakeAWS:
+    """
+    In-process stand-ins of the AWS APIs used by the hubs. Every call sleeps latency
+    seconds (plus a uniform jitter), is counted per operation and returns a minimal
+    successful response; objects and SSM parameters are kept in memory.
+
+    Usage:
+        aws = FakeAWS(latency=0.005)
+        clients.set_factories(aws.client, aws.resource)
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = {}
+        self.objects = {}
+        self.parameters = {}
+        self.lock = threading.Lock()
+
+    def wait(self, operation):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def client(self, service, region=None):
+        return FakeClient(self, service)
+
+    def resource(self, service, region=None):
+        return FakeResource(self, service)
+
+
+class _Meta:
+    def __init__(self, client):
+        self.client = client
+
+
+class FakeClient:
+    def __init__(self, aws, service):
+        self.aws = aws
+        self.service = service
+        self.exceptions = _Exceptions()
+        self.meta = _Meta(self)
+
+    def __getattr__(self, operation):
+        if operation.startswith('_'):
+            raise AttributeError(operation)
+
+        def call(**kwargs):
+            self.aws.wait(f"{self.service}.{operation}")
+            handler = getattr(self, f"_{operation}", None)
+            return handler(**kwargs) if handler else {}
+        return call
+
+    def _send_message(self, **kwargs):
+        return {'MessageId': uuid.uuid4().hex}
+
+    def _send_message_batch(self, Entries, **kwargs):
+        return {'Successful': [{'Id': entry['Id'], 'MessageId': uuid.uuid4().hex} for entry in Entries],
+                'Failed': []}
+
+    _publish = _send_message
+
+    def _publish_batch(self, PublishBatchRequestEntries, **kwargs):
+        return self._send_message_batch(PublishBatchRequestEntries)
+
+    def _invoke(self, **kwargs):
+        return {'StatusCode': 202}
+
+    def _start_build(self, projectName, **kwargs):
+        return {'build': {'id': f"{projectName}:{uuid.uuid4()}"}}
+
+    def _batch_write_item(self, **kwargs):
+        return {'UnprocessedItems': {}}
+
+    def _put_object(self, Bucket, Key, Body=b"", **kwargs):
+        self.aws.objects[(Bucket, Key)] = Body if isinstance(Body, bytes) else str(Body).encode('utf-8')
+        return {'ETag': uuid.uuid4().hex}
+
+    def _head_object(self, Bucket, Key, **kwargs):
+        if (Bucket, Key) not in self.aws.objects:
+            raise FakeError("404", "Not Found")
+        return {'ContentLength': len(self.aws.objects[(Bucket, Key)])}
+
+    def _get_object(self, Bucket, Key, **kwargs):
+        import io
+        if (Bucket, Key) not in self.aws.objects:
+            raise FakeError("NoSuchKey", Key)
+        Body = self.aws.objects[(Bucket, Key)]
+        return {'Body': io.BytesIO(Body), 'ContentLength': len(Body)}
+
+    def _get_parameter(self, Name, **kwargs):
+        Name = Name.split(":")[0]
+        with self.aws.lock:
+            Value, Version = self.aws.parameters.setdefault(Name, ("0", 1))
+        return {'Parameter': {'Name': Name, 'Value': Value, 'Version': Version}}
+
+    def _put_parameter(self, Name, Value, **kwargs):
+        with self.aws.lock:
+            Version = self.aws.parameters.get(Name, ("0", 0))[1] + 1
+            self.aws.parameters[Name] = (Value, Version)
+        return {'Version': Version}
+
+    def _receive_message(self, **kwargs):
+        return {'Messages': []}
+
+
+class FakeTable:
+    def __init__(self, resource, name):
+        self.name = name
+        self.meta = _Meta(resource.client)
+        self.aws = resource.aws
+
+    def __getattr__(self, operation):
+        if operation.startswith('_'):
+            raise AttributeError(operation)
+
+        def call(**kwargs):
+            self.aws.wait(f"dynamodb.{operation}")
+            return {}
+        return call
+
+
+class FakeResource:
+    def __init__(self, aws, service):
+        self.aws = aws
+        self.client = FakeClient(aws, service)
+        self.meta = _Meta(self.client)
+
+    def Table(self, name):
+        return FakeTable(self, name)
+
+
+def target_environment(count, kinds=DefaultKinds):
+    """Indexed target variables (see hubconfig.Kinds) of count targets spread over kinds."""
+    from .hubconfig import Kinds
+    Environment = {}
+    Indexes = {}
+    for n in range(count):
+        kind = kinds[n % len(kinds)]
+        i = Indexes[kind] = Indexes.get(kind, -1) + 1
+        Name = f"bench-{kind.lower()}-{i}"
+        Values = {"Name": Name, "Region": BenchRegion, "Account": BenchAccount,
+                  "URL": f"https://sqs.{BenchRegion}.amazonaws.com/{BenchAccount}/{Name}",
+                  "ARN": f"arn:aws:sns:{BenchRegion}:{BenchAccount}:{Name}"}
+        for field, variable in Kinds[kind][1].items():
+            if field in Values:
+                Environment[f"{variable}_{i}"] = Values[field]
+    return Environment
+
+
+def sqs_event(n, batch, payload_size):
+    return {"Records": [{"eventSource": "aws:sqs", "messageId": f"{n}-{k}",
+                         "eventSourceARN": f"arn:aws:sqs:{BenchRegion}:{BenchAccount}:bench-source",
+                         "body": json.dumps({"Event": n, "Record": k, "Data": "x" * payload_size})}
+                        for k in range(batch)]}
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered), math.ceil(p / 100.0 * len(ordered))) - 1)]
+
+
+def _load_hub(path):
+    spec = importlib.util.spec_from_file_location("hub_under_benchmark", path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def _ec2_sender(module):
+    """One POST per event through the FastAPI app, or a direct call without the test client (httpx)."""
+    try:
+        from fastapi.testclient import TestClient
+    except ImportError:
+        return lambda event: module.send_to_all_outputs(event, "bench", "POST", "HTTP POST")
+    client = TestClient(module.app)
+    return lambda event: client.post("/bench", json=event)
+
+
+def run_scenario(scenario):
+    """
+    Runs one scenario in this process (called by the worker process of main()).
+    :param scenario: Dict with Hub, Targets, Batch, Events, Warmup, LatencyMs, JitterMs, PayloadBytes, Kinds.
+    :return: Dict with the measured latencies (ms) and the stand-in call counts.
+    """
+    from . import clients
+    Environment = {"REGION": BenchRegion, "ACCOUNT": BenchAccount, "NAME": "bench-hub",
+                   "LAMBDA_NAME": "bench-hub", "Name": "bench-hub", "BATCH_MODE": "True",
+                   "EC2HUB_LOG_PATH": os.path.join(tempfile.gettempdir(), "ec2hub-benchmark.log")}
+    Environment.update(target_environment(scenario["Targets"], tuple(scenario["Kinds"])))
+    os.environ.update(Environment)
+    aws = FakeAWS(scenario["LatencyMs"] / 1000.0, scenario["JitterMs"] / 1000.0)
+    clients.set_factories(aws.client, aws.resource)
+    # Hub output (log lines, EMF) is dropped; only the measurements are reported.
+    logging.disable(logging.INFO)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        Start = time.time()
+        module = _load_hub(os.path.join(RepositoryRoot, Hubs[scenario["Hub"]]))
+        ImportMs = (time.time() - Start) * 1000
+        Batch = 1 if scenario["Hub"] == "ec2" else scenario["Batch"]
+        if scenario["Hub"] == "lambda":
+            handle = lambda event: module.lambda_handler(event, None)
+        elif scenario["Hub"] == "codebuild":
+            handle = module.main
+        else:
+            send = _ec2_sender(module)
+            handle = lambda event: send(json.loads(event["Records"][0]["body"]))
+        Latencies = []
+        for n in range(scenario["Warmup"] + scenario["Events"]):
+            event = sqs_event(n, Batch, scenario["PayloadBytes"])
+            Start = time.time()
+            handle(event)
+            if n >= scenario["Warmup"]:
+                Latencies.append((time.time() - Start) * 1000)
+    return {"ImportMs": ImportMs, "Batch": Batch, "LatenciesMs": Latencies, "Calls": aws.calls}
+
+
+def summarize(scenario, measured):
+    Latencies = measured["LatenciesMs"]
+    Total = sum(Latencies) / 1000.0
+    return {"Hub": scenario["Hub"], "Targets": scenario["Targets"], "Batch": measured["Batch"],
+            "Events": len(Latencies),
+            "EventsPerSecond": round(len(Latencies) / Total, 1) if Total else None,
+            "MessagesPerSecond": round(len(Latencies) * measured["Batch"] / Total, 1) if Total else None,
+            "P50Ms": round(percentile(Latencies, 50), 2), "P95Ms": round(percentile(Latencies, 95), 2),
+            "P99Ms": round(percentile(Latencies, 99), 2), "ImportMs": round(measured["ImportMs"], 1),
+            "Calls": sum(measured["Calls"].values())}
+
+
+def _worker(scenario_json):
+    scenario = json.loads(scenario_json)
+    Output = sys.stdout
+    measured = run_scenario(scenario)
+    Output.write(json.dumps(summarize(scenario, measured)) + "\n")
+    Output.flush()
+
+
+def _numbers(text):
+    return [int(value) for value in text.split(",") if value.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline fan-out benchmark of the CloudMan hubs.")
+    parser.add_argument("--hub", action="append", choices=sorted(Hubs),
+                        help="Hub to benchmark (repeatable; default all).")
+    parser.add_argument("--targets", default="1,4,16", help="Comma-separated target counts.")
+    parser.add_argument("--batch", default="1,10", help="Comma-separated batch sizes (records per event).")
+    parser.add_argument("--events", type=int, default=100, help="Measured events per scenario.")
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=5.0, help="Latency (ms) injected in every AWS call.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Extra latency (ms), uniform between 0 and jitter.")
+    parser.add_argument("--payload", type=int, default=256, help="Payload bytes per message.")
+    parser.add_argument("--kinds", default=",".join(DefaultKinds),
+                        help="Target kinds of hubconfig.Kinds, used round robin.")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON lines.")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.worker:
+        _worker(args.worker)
+        return 0
+
+    Results = []
+    for hub in args.hub or sorted(Hubs):
+        for batch in ([1] if hub == "ec2" else _numbers(args.batch)):
+            for count in _numbers(args.targets):
+                scenario = {"Hub": hub, "Targets": count, "Batch": batch, "Events": args.events,
+                            "Warmup": args.warmup, "LatencyMs": args.latency, "JitterMs": args.jitter,
+                            "PayloadBytes": args.payload, "Kinds": args.kinds.split(",")}
+                # A fresh process per scenario: the hubs read their targets once, at import.
+                Environment = dict(os.environ)
+                Environment["PYTHONPATH"] = os.pathsep.join(
+                    filter(None, [os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                  Environment.get("PYTHONPATH")]))
+                process = subprocess.run(
+                    [sys.executable, "-m", "cloudman_hub.benchmark", "--worker", json.dumps(scenario)],
+                    capture_output=True, text=True, cwd=tempfile.gettempdir(), env=Environment)
+                if process.returncode != 0 or not process.stdout.strip():
+                    Result = {"Hub": hub, "Targets": count, "Batch": batch,
+                              "Error": (process.stderr.strip().splitlines() or ["no output"])[-1]}
+                else:
+                    Result = json.loads(process.stdout.strip().splitlines()[-1])
+                Results.append(Result)
+                if args.json:
+                    print(json.dumps(Result))
+                elif "Error" in Result:
+                    print(f"{hub:<10} targets={count:<3} batch={batch:<3} ERROR {Result['Error']}")
+                else:
+                    print(f"{hub:<10} targets={count:<3} batch={Result['Batch']:<3} "
+                          f"{Result['EventsPerSecond']:>8} ev/s {Result['MessagesPerSecond']:>9} msg/s  "
+                          f"p50 {Result['P50Ms']:>8} ms  p95 {Result['P95Ms']:>8} ms  p99 {Result['P99Ms']:>8} ms")
+    return 1 if any("Error" in Result for Result in Results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+# file: claimcheck.py
+# Claim check for large messages: a payload that would not fit in SQS/SNS (256 KB) or in a
+# DynamoDB item (400 KB) is compressed and stored once in a staging bucket, and only a
+# pointer with its checksum travels through the hubs:
+#     {"ClaimCheck": {"Bucket": "...", "Key": "...", "Codec": "zstd", "Size": 1234567, "SHA256": "..."}}
+# The object key is the checksum, so the same payload is stored once however many hops
+# forward it. Old objects should be removed by a lifecycle rule on the staging bucket.
+import os
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+
+from .log import LogMessage
+from .clients import get_client
+from .codec import dumps_bytes, loads
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Empty bucket disables the claim check: large messages are sent inline, as before.
+ClaimCheckBucket = os.getenv("CLAIM_CHECK_BUCKET", "")
+ClaimCheckPrefix = os.getenv("CLAIM_CHECK_PREFIX", "claim-check")
+# Encoded messages above this size (bytes) are offloaded; leaves room for the SQS/SNS attributes.
+ClaimCheckThreshold = int(os.getenv("CLAIM_CHECK_THRESHOLD", str(240 * 1024)))
+ClaimCheckCodec = os.getenv("CLAIM_CHECK_CODEC", "zstd" if zstandard is not None else "gzip")
+# Rehydrated payloads kept in memory (by checksum) for the next reads.
+ClaimCheckCacheSize = int(os.getenv("CLAIM_CHECK_CACHE_SIZE", "8"))
+# Keys known to be in the staging bucket (skips the HEAD of a payload stored before).
+ClaimCheckStoredSize = int(os.getenv("CLAIM_CHECK_STORED_SIZE", "1024"))
+
+Extensions = {"zstd": "zst", "gzip": "gz"}
+
+_Stored = OrderedDict()
+_Cache = OrderedDict()
+_Lock = threading.Lock()
+
+
+def enabled():
+    return bool(ClaimCheckBucket)
+
+
+def is_claim_check(payload):
+    return isinstance(payload, dict) and isinstance(payload.get("ClaimCheck"), dict)
+
+
+def compress(data, codec):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    if codec == "gzip":
+        return gzip.compress(data, compresslevel=6)
+    raise ValueError(f"Unknown claim check codec '{codec}'")
+
+
+def decompress(data, codec):
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is not installed; cannot read a zstd claim check")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    if codec == "gzip":
+        return gzip.decompress(data)
+    raise ValueError(f"Unknown claim check codec '{codec}'")
+
+
+def _exists(s3_client, bucket, key):
+    try:
+        s3_client.head_object(Bucket=bucket, Key=key)
+        return True
+    except Exception as e:
+        if getattr(e, 'response', {}).get('Error', {}).get('Code') in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+
+def offload(payload, bucket=None, codec=None):
+    """
+    Stores a payload in the staging bucket (once per checksum) and returns its pointer.
+    :param payload: Any JSON value.
+    :return: Dict {"ClaimCheck": {...}} that replaces the payload.
+    """
+    bucket = bucket or ClaimCheckBucket
+    codec = codec or ClaimCheckCodec
+    data = dumps_bytes(payload)
+    Checksum = hashlib.sha256(data).hexdigest()
+    Key = f"{ClaimCheckPrefix}/{Checksum[:2]}/{Checksum}.{Extensions.get(codec, codec)}"
+    with _Lock:
+        Stored = (bucket, Key) in _Stored
+        if Stored:
+            _Stored.move_to_end((bucket, Key))
+    if not Stored:
+        s3_client = get_client('s3')
+        if not _exists(s3_client, bucket, Key):
+            Body = compress(data, codec)
+            s3_client.put_object(Bucket=bucket, Key=Key, Body=Body)
+            LogMessage(f"Claim check: {len(data)} bytes stored as s3://{bucket}/{Key} ({len(Body)} bytes)")
+        with _Lock:
+            _Stored[(bucket, Key)] = True
+            while len(_Stored) > ClaimCheckStoredSize:
+                _Stored.popitem(last=False)
+    return {"ClaimCheck": {"Bucket": bucket, "Key": Key, "Codec": codec,
+                           "Size": len(data), "SHA256": Checksum}}
+
+
+def rehydrate(payload):
+    """
+    Returns the original payload of a pointer (other payloads are returned unchanged).
+    The checksum is verified; a mismatch raises ValueError.
+    """
+    if not is_claim_check(payload):
+        return payload
+    Pointer = payload["ClaimCheck"]
+    with _Lock:
+        if Pointer["SHA256"] in _Cache:
+            _Cache.move_to_end(Pointer["SHA256"])
+            return loads(_Cache[Pointer["SHA256"]])
+    response = get_client('s3').get_object(Bucket=Pointer["Bucket"], Key=Pointer["Key"])
+    data = decompress(response['Body'].read(), Pointer.get("Codec", "gzip"))
+    if hashlib.sha256(data).hexdigest() != Pointer["SHA256"]:
+        raise ValueError(f"Claim check s3://{Pointer['Bucket']}/{Pointer['Key']}: checksum mismatch")
+    with _Lock:
+        _Cache[Pointer["SHA256"]] = data
+        while len(_Cache) > ClaimCheckCacheSize:
+            _Cache.popitem(last=False)
+    return loads(data)
@@ -0,0 +1,120 @@
+# file: clients.py
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+from .fanout import TargetTimeout
+
+# Connection settings shared by every client of the pool. The connect and read timeouts of
+# each attempt default to no more than the FanOut target timeout, so a call does not keep
+# running long after its target was reported as TIMEOUT (see fanout.py).
+MaxPoolConnections = int(os.getenv("BOTO_MAX_POOL_CONNECTIONS", "50"))
+MaxAttempts = int(os.getenv("BOTO_MAX_ATTEMPTS", "5"))
+ConnectTimeout = float(os.getenv("BOTO_CONNECT_TIMEOUT", str(min(5.0, TargetTimeout))))
+ReadTimeout = float(os.getenv("BOTO_READ_TIMEOUT", str(min(30.0, TargetTimeout))))
+TcpKeepAlive = os.getenv("BOTO_TCP_KEEPALIVE", "True") == "True"
+
+_Clients = {}
+_Resources = {}
+_Lock = threading.Lock()
+_Config = None
+# Source of new clients/resources: factory(service, region). None uses boto3.
+_ClientFactory = None
+_ResourceFactory = None
+
+
+def client_config():
+    """
+    Returns the botocore Config of the pool: a connection pool sized for the fan-out
+    workers, TCP keep-alive and adaptive retries.
+    """
+    global _Config
+    if _Config is None:
+        Settings = dict(max_pool_connections=MaxPoolConnections,
+                        connect_timeout=ConnectTimeout,
+                        read_timeout=ReadTimeout,
+                        retries={'max_attempts': MaxAttempts, 'mode': 'adaptive'})
+        try:
+            _Config = Config(tcp_keepalive=TcpKeepAlive, **Settings)
+        except TypeError:
+            # botocore older than 1.27 (e.g. the one pinned in the EC2Hub image) has no tcp_keepalive.
+            _Config = Config(**Settings)
+    return _Config
+
+
+def get_client(service, region=None):
+    """
+    Returns the process-wide boto3 client of a service and region, creating it on first use.
+    boto3 clients are thread safe, so the fan-out workers share them.
+    :param service: Service name, e.g. 'sqs'.
+    :param region: Region name (None uses the default region of the environment).
+    """
+    key = (service, region or None)
+    client = _Clients.get(key)
+    if client is None:
+        with _Lock:
+            client = _Clients.get(key)
+            if client is None:
+                if _ClientFactory is not None:
+                    client = _ClientFactory(service, region or None)
+                else:
+                    client = boto3.client(service, region_name=region or None, config=client_config())
+                _Clients[key] = client
+    return client
+
+
+def get_resource(service, region=None):
+    """
+    Returns the process-wide boto3 resource of a service and region (e.g. DynamoDB tables).
+    Resources are not thread safe to create, so creation is serialized here.
+    """
+    key = (service, region or None)
+    resource = _Resources.get(key)
+    if resource is None:
+        with _Lock:
+            resource = _Resources.get(key)
+            if resource is None:
+                if _ResourceFactory is not None:
+                    resource = _ResourceFactory(service, region or None)
+                else:
+                    resource = boto3.resource(service, region_name=region or None, config=client_config())
+                _Resources[key] = resource
+    return resource
+
+
+def clear():
+    """Drops every pooled client and resource (used when the credentials change)."""
+    with _Lock:
+        _Clients.clear()
+        _Resources.clear()
+
+
+def set_factories(client_factory=None, resource_factory=None):
+    """
+    Replaces boto3 as the source of new clients and resources, e.g. with the in-process
+    stand-ins of the offline benchmark (see benchmark.py). None restores boto3.
+    The pooled clients and resources are dropped.
+    :param client_factory: Function (service, region) -> client.
+    :param resource_factory: Function (service, region) -> resource.
+    """
+    global _ClientFactory, _ResourceFactory
+    _ClientFactory, _ResourceFactory = client_factory, resource_factory
+    clear()
+
+
+def close_connections():
+    """
+    Closes the HTTP connections of every pooled client (BaseClient.close, botocore 1.26+;
+    older clients are left as they are). A closed client reconnects on its next call.
+    """
+    with _Lock:
+        Pooled = list(_Clients.values()) + [resource.meta.client for resource in _Resources.values()]
+    for client in Pooled:
+        close = getattr(client, 'close', None)
+        if close is not None:
+            try:
+                close()
+            except Exception:
+                pass
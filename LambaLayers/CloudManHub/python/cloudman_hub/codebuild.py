@@ -0,0 +1,268 @@
+# file: codebuild.py
+# Coalescing of CodeBuild triggers: every trigger of a project inside the same time window
+# becomes one build, which receives all the messages of the window in one S3 artifact.
+import os
+import json
+import time
+
+from .log import LogMessage
+from .clients import get_client, get_resource
+
+# Window length in seconds (0 disables coalescing: one build per message, as before).
+CoalesceWindow = float(os.getenv("CODEBUILD_COALESCE_WINDOW", "0"))
+# DynamoDB table (partition key 'ID', string) used to elect the window leader.
+CoalesceTable = os.getenv("CODEBUILD_COALESCE_TABLE", "")
+CoalesceBucket = os.getenv("CODEBUILD_COALESCE_BUCKET", "")
+CoalescePrefix = os.getenv("CODEBUILD_COALESCE_PREFIX", "codebuild-coalesce")
+# Time the leader waits, after closing the window, for the payloads of the last members.
+CoalesceGrace = float(os.getenv("CODEBUILD_COALESCE_GRACE", "2"))
+# Items of old windows expire through the table TTL attribute.
+CoalesceTTL = int(os.getenv("CODEBUILD_COALESCE_TTL", "86400"))
+# Seconds kept free before the deadline of the leader (e.g. the end of the Lambda invocation)
+# to build the window and return.
+CoalesceMargin = float(os.getenv("CODEBUILD_COALESCE_MARGIN", "5"))
+# Seconds after which the claim of a window that was never built may be taken over.
+CoalesceClaimTimeout = int(os.getenv("CODEBUILD_COALESCE_CLAIM_TIMEOUT", "120"))
+
+
+def coalescing_enabled():
+    return CoalesceWindow > 0 and bool(CoalesceTable) and bool(CoalesceBucket)
+
+
+def read_artifact(location):
+    """
+    Reads the artifact of a coalesced build.
+    :param location: s3://bucket/key, as passed in EVENT_ARTIFACT.
+    :return: Dict {"Project", "Window", "Messages"}.
+    """
+    bucket, key = location[len("s3://"):].split("/", 1)
+    response = get_client('s3').get_object(Bucket=bucket, Key=key)
+    return json.loads(response['Body'].read())
+
+
+class BuildCoalescer:
+    """
+    Collapses the triggers of a project that arrive within one window into one build.
+
+    The window of a trigger is int(time / window). Each trigger registers in the window
+    item with a conditional update (ADD Members, only while the window is not Closed) and
+    writes its messages to S3 under the member number it got. The first member is the
+    leader: it waits for the end of the window (or for its own deadline, see set_deadline),
+    claims it (Closed, ClaimedAt; only while it has no BuildId and no live claim), joins
+    the payloads of every member into one artifact, starts one build with
+    EVENT_ARTIFACT=s3://bucket/key and records its BuildId.
+    A trigger that finds its window already closed registers in the next one.
+
+    The members other than the leader return as soon as their payload is stored, so a
+    window whose leader timed out or crashed would never be built: every member adds its
+    window to the Pending set of the project item ({project}#pending) before storing its
+    payload, and the pending windows that expired more than CoalesceClaimTimeout seconds
+    ago without a BuildId are claimed and built by the leader of a later window and by
+    sweep(). sweep() does not depend on new triggers: the hub calls it from a scheduled
+    invocation (see the CoalesceSweep event of LambdaHub).
+
+    Usage:
+        coalescer = BuildCoalescer(Region)
+        result = coalescer.trigger(ProjectName, [NewMessage1, NewMessage2])
+        ...
+        coalescer.sweep([ProjectName])     # scheduled, e.g. every 5 minutes
+    """
+
+    def __init__(self, region=None, window=None, table_name=None, bucket=None, prefix=None):
+        self.window = CoalesceWindow if window is None else window
+        self.region = region
+        self.table_name = table_name or CoalesceTable
+        self.bucket = bucket or CoalesceBucket
+        self.prefix = prefix or CoalescePrefix
+        self.deadline = None
+
+    # The clients are looked up on each use, so clients.clear() (SnapStart restore) replaces them.
+    @property
+    def table(self):
+        return get_resource('dynamodb', self.region).Table(self.table_name)
+
+    @property
+    def s3(self):
+        return get_client('s3', self.region)
+
+    @property
+    def codebuild(self):
+        return get_client('codebuild', self.region)
+
+    def max_duration(self):
+        """Longest time trigger() can take (the leader waits for the whole window)."""
+        return self.window + CoalesceGrace
+
+    def set_deadline(self, deadline):
+        """
+        Time (epoch seconds) by which trigger() must return, e.g. the end of the Lambda
+        invocation; a leader closes its window early to build it before the deadline.
+        """
+        self.deadline = deadline
+        if deadline is not None and deadline - time.time() < self.max_duration() + CoalesceMargin:
+            LogMessage(f"CodeBuild coalescing: window {self.window}s + grace {CoalesceGrace}s + margin "
+                       f"{CoalesceMargin}s does not fit in the {deadline - time.time():.0f}s left; "
+                       f"windows led by this invocation are closed early")
+
+    def _register(self, project):
+        ConditionalCheckFailed = self.table.meta.client.exceptions.ConditionalCheckFailedException
+        WindowID = None
+        for attempt in range(3):
+            # A window closed early by its leader still covers its time slot: go to the next one.
+            Now = int(time.time() // self.window)
+            WindowID = Now if WindowID is None else max(Now, WindowID + 1)
+            try:
+                response = self.table.update_item(
+                    Key={'ID': f"{project}#{WindowID}"},
+                    UpdateExpression='ADD Members :one SET #ttl = if_not_exists(#ttl, :ttl)',
+                    ConditionExpression='attribute_not_exists(Closed)',
+                    ExpressionAttributeNames={'#ttl': 'TTL'},
+                    ExpressionAttributeValues={':one': 1, ':ttl': int(time.time()) + CoalesceTTL},
+                    ReturnValues='UPDATED_NEW')
+                return WindowID, int(response['Attributes']['Members'])
+            except ConditionalCheckFailed:
+                # The leader already closed this window; the trigger goes to the next one.
+                pass
+        raise RuntimeError(f"Could not register in a coalescing window of {project}")
+
+    def trigger(self, project, messages):
+        """
+        :param messages: Messages (strings) to be delivered to the build.
+        :return: Dict with the window, member number and, for the leader, the build id.
+        """
+        WindowID, Member = self._register(project)
+        # Before the payload, so the window can be built by a later leader or sweep() if its leader fails.
+        Pending = self._pending(project, WindowID)
+        if Member == 1:
+            self._recover(project, Pending)
+        Folder = self._folder(project, WindowID)
+        self.s3.put_object(Bucket=self.bucket, Key=f"{Folder}/{Member:06d}.json",
+                           Body=json.dumps(messages).encode('utf-8'))
+        Result = {"Window": WindowID, "Member": Member, "Leader": Member == 1}
+        if Member == 1:
+            Result.update(self._lead(project, WindowID))
+        LogMessage(f"CodeBuild {project}: trigger coalesced {Result}")
+        return Result
+
+    def _folder(self, project, WindowID):
+        return f"{self.prefix}/{project}/{WindowID}"
+
+    def _payload_keys(self, Folder):
+        keys = []
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=Folder + "/"):
+            keys.extend(item['Key'] for item in page.get('Contents', []))
+        return sorted(keys)
+
+    def _claim(self, project, WindowID):
+        """
+        Closes the window and takes the right to build it.
+        :return: Members of the window, or None when it is built or claimed by another trigger.
+        """
+        Now = int(time.time())
+        try:
+            response = self.table.update_item(
+                Key={'ID': f"{project}#{WindowID}"},
+                UpdateExpression='SET Closed = :closed, ClaimedAt = :now',
+                ConditionExpression='attribute_exists(Members) AND attribute_not_exists(BuildId) AND '
+                                    '(attribute_not_exists(ClaimedAt) OR ClaimedAt < :stale)',
+                ExpressionAttributeValues={':closed': True, ':now': Now, ':stale': Now - CoalesceClaimTimeout},
+                ReturnValues='ALL_NEW')
+        except self.table.meta.client.exceptions.ConditionalCheckFailedException:
+            return None
+        return int(response['Attributes']['Members'])
+
+    def _pending(self, project, WindowID):
+        """
+        Adds the window to the pending ones of the project.
+        :return: Pending windows of the project.
+        """
+        response = self.table.update_item(
+            Key={'ID': f"{project}#pending"},
+            UpdateExpression='ADD Pending :window SET #ttl = :ttl',
+            ExpressionAttributeNames={'#ttl': 'TTL'},
+            ExpressionAttributeValues={':window': {WindowID}, ':ttl': int(time.time()) + CoalesceTTL},
+            ReturnValues='ALL_NEW')
+        return {int(value) for value in response['Attributes'].get('Pending', [])}
+
+    def sweep(self, projects):
+        """
+        Builds the pending windows of the projects left behind by their leaders.
+        :return: Number of windows built.
+        """
+        Built = 0
+        for project in projects:
+            try:
+                item = self.table.get_item(Key={'ID': f"{project}#pending"}).get('Item') or {}
+            except Exception as e:
+                LogMessage(f"CodeBuild {project}: error reading the pending windows: {e}")
+                continue
+            Built += self._recover(project, {int(value) for value in item.get('Pending', [])})
+        return Built
+
+    def _recover(self, project, windows):
+        """
+        Claims and builds the pending windows that expired without a BuildId.
+        :return: Number of windows built.
+        """
+        Built = 0
+        try:
+            for Pending in sorted(windows):
+                if time.time() < (Pending + 1) * self.window + CoalesceClaimTimeout:
+                    continue
+                Members = self._claim(project, Pending)
+                if Members is None:
+                    # Built (or being built) by another trigger.
+                    item = self.table.get_item(Key={'ID': f"{project}#{Pending}"}).get('Item') or {}
+                    if 'BuildId' in item or not item:
+                        self._done(project, Pending)
+                    continue
+                LogMessage(f"CodeBuild {project}: window {Pending} was not built by its leader, building it")
+                self._build(project, Pending, Members)
+                Built += 1
+        except Exception as e:
+            LogMessage(f"CodeBuild {project}: error recovering pending windows: {e}")
+        return Built
+
+    def _lead(self, project, WindowID):
+        End = (WindowID + 1) * self.window
+        if self.deadline is not None:
+            End = min(End, self.deadline - CoalesceGrace - CoalesceMargin)
+        time.sleep(max(0, End - time.time()))
+        Members = self._claim(project, WindowID)
+        if Members is None:
+            return {"Claimed": False}
+        return self._build(project, WindowID, Members)
+
+    def _build(self, project, WindowID, Members):
+        Folder = self._folder(project, WindowID)
+        # Members registered before the window closed may still be writing their payload.
+        Deadline = time.time() + CoalesceGrace
+        keys = self._payload_keys(Folder)
+        while len(keys) < Members and time.time() < Deadline:
+            time.sleep(0.2)
+            keys = self._payload_keys(Folder)
+        if len(keys) < Members:
+            LogMessage(f"CodeBuild {project}: {Members - len(keys)} payloads of window {WindowID} missing")
+        Messages = []
+        for key in keys:
+            Messages.extend(json.loads(self.s3.get_object(Bucket=self.bucket, Key=key)['Body'].read()))
+        ArtifactKey = f"{Folder}.json"
+        self.s3.put_object(Bucket=self.bucket, Key=ArtifactKey, Body=json.dumps(
+            {"Project": project, "Window": WindowID, "Messages": Messages}).encode('utf-8'))
+        Build = self.codebuild.start_build(
+            projectName=project,
+            environmentVariablesOverride=[{'name': 'EVENT_ARTIFACT', 'type': 'PLAINTEXT',
+                                           'value': f"s3://{self.bucket}/{ArtifactKey}"}])
+        BuildId = Build['build']['id']
+        self.table.update_item(Key={'ID': f"{project}#{WindowID}"}, UpdateExpression='SET BuildId = :build',
+                               ExpressionAttributeValues={':build': BuildId})
+        self._done(project, WindowID)
+        for start in range(0, len(keys), 1000):
+            self.s3.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': key} for key in keys[start:start + 1000]], 'Quiet': True})
+        return {"Members": Members, "Messages": len(Messages), "BuildId": BuildId}
+
+    def _done(self, project, WindowID):
+        self.table.update_item(Key={'ID': f"{project}#pending"}, UpdateExpression='DELETE Pending :window',
+                               ExpressionAttributeValues={':window': {WindowID}})
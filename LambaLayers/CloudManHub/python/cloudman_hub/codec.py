@@ -0,0 +1,72 @@
+# file: codec.py
+# JSON codec of the hubs. Uses orjson or msgspec when installed (several times faster than
+# the json module for the envelopes), else the standard library; all three produce the
+# same compact UTF-8 text. A forwarded message is encoded once per hop; the sinks derive
+# the forms they need (UTF-8 bytes, JSON string literal) from that text instead of
+# serializing the envelope again.
+#
+# Usage:
+#     Text = dumps(Envelope)
+#     Body = utf8(Text)          # EC2 POST, sizes
+#     Field = quoted(Text)       # Text as a JSON string inside another document
+import os
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# orjson, msgspec or json; the default is the fastest one installed.
+JSONCodec = os.getenv("JSON_CODEC", "orjson" if orjson is not None else
+                      "msgspec" if msgspec is not None else "json")
+
+_Encoder = msgspec.json.Encoder(enc_hook=str) if msgspec is not None else None
+_Decoder = msgspec.json.Decoder() if msgspec is not None else None
+
+
+def _json_bytes(value):
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False, default=str).encode('utf-8')
+
+
+def dumps_bytes(value):
+    """Compact UTF-8 JSON of value; values the fast codecs reject fall back to the json module."""
+    try:
+        if JSONCodec == "orjson" and orjson is not None:
+            return orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS)
+        if JSONCodec == "msgspec" and _Encoder is not None:
+            return _Encoder.encode(value)
+    except (TypeError, ValueError, OverflowError):
+        pass
+    return _json_bytes(value)
+
+
+def dumps(value):
+    """Compact JSON text of value (see dumps_bytes)."""
+    return dumps_bytes(value).decode('utf-8')
+
+
+def loads(data):
+    """Decodes JSON text or bytes; raises ValueError when it is not valid JSON."""
+    if JSONCodec == "orjson" and orjson is not None:
+        return orjson.loads(data)
+    if JSONCodec == "msgspec" and _Decoder is not None:
+        try:
+            return _Decoder.decode(data.encode('utf-8') if isinstance(data, str) else data)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e))
+    return json.loads(data)
+
+
+def utf8(text):
+    """UTF-8 bytes of a message."""
+    return text.encode('utf-8')
+
+
+def quoted(text):
+    """A message as a JSON string literal (json.dumps(text) without ASCII escaping)."""
+    return dumps(text)
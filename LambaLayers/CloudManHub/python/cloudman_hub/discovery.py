@@ -0,0 +1,232 @@
+# file: discovery.py
+# Cached Cloud Map discovery of the container targets. The instances of each service are
+# kept for DISCOVERY_TTL seconds; after that the cached list is still returned while one
+# background refresh fetches a new one (stale-while-revalidate), so DiscoverInstances is
+# off the hot path. A failed refresh keeps the last list; only a list older than
+# DISCOVERY_MAX_STALE (or the first use of a service) is fetched in the caller's thread; the
+# callers that need the same service meanwhile wait for that one fetch.
+#
+# The instance each message goes to is chosen by a selector (DISCOVERY_SELECTOR):
+#     round_robin        the instances in turn
+#     least_outstanding  the instance with fewest requests in flight from this process
+#     health_weighted    random, weighted by the Cloud Map health status and by the
+#                        recent failures of the instance seen by this process
+#     random             as before
+#
+# Usage:
+#     with get_discovery_cache().instance(Namespace, ContainerName, Region) as instance:
+#         if instance is not None:
+#             requests.post(f"http://{instance['Host']}:{instance['Port']}/...")
+import os
+import time
+import random
+import threading
+import itertools
+from contextlib import contextmanager
+from concurrent.futures import Future
+
+from .log import LogMessage
+from .clients import get_client
+from .xray import execute_with_xray
+
+DiscoveryTTL = float(os.getenv("DISCOVERY_TTL", "30"))
+DiscoveryMaxStale = float(os.getenv("DISCOVERY_MAX_STALE", "300"))
+DiscoverySelector = os.getenv("DISCOVERY_SELECTOR", "round_robin")
+# Weights of health_weighted per Cloud Map HealthStatus, and decay of the failure score per success.
+HealthWeights = {"HEALTHY": 1.0, "UNKNOWN": 0.5, "UNHEALTHY": 0.05}
+FailureDecay = 0.5
+
+_Cache = None
+_CacheLock = threading.Lock()
+
+
+def get_discovery_cache():
+    """Process-wide DiscoveryCache with the selector of DISCOVERY_SELECTOR."""
+    global _Cache
+    if _Cache is None:
+        with _CacheLock:
+            if _Cache is None:
+                _Cache = DiscoveryCache(selector=Selectors.get(DiscoverySelector, RoundRobinSelector)())
+    return _Cache
+
+
+class RandomSelector:
+    """Base of the selectors: pick() chooses an instance, the hooks follow its requests."""
+
+    def pick(self, key, instances):
+        return random.choice(instances)
+
+    def started(self, instance):
+        pass
+
+    def finished(self, instance, ok):
+        pass
+
+
+class RoundRobinSelector(RandomSelector):
+    def __init__(self):
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def pick(self, key, instances):
+        with self.lock:
+            counter = self.counters.setdefault(key, itertools.count())
+            return instances[next(counter) % len(instances)]
+
+
+class LeastOutstandingSelector(RandomSelector):
+    def __init__(self):
+        self.outstanding = {}
+        self.lock = threading.Lock()
+
+    def pick(self, key, instances):
+        with self.lock:
+            Fewest = min(self.outstanding.get(instance['Id'], 0) for instance in instances)
+            return random.choice([instance for instance in instances
+                                  if self.outstanding.get(instance['Id'], 0) == Fewest])
+
+    def started(self, instance):
+        with self.lock:
+            self.outstanding[instance['Id']] = self.outstanding.get(instance['Id'], 0) + 1
+
+    def finished(self, instance, ok):
+        with self.lock:
+            self.outstanding[instance['Id']] = self.outstanding.get(instance['Id'], 1) - 1
+
+
+class HealthWeightedSelector(RandomSelector):
+    def __init__(self):
+        # Instance Id -> failure score; each failure adds 1, each success multiplies it by FailureDecay.
+        self.failures = {}
+        self.lock = threading.Lock()
+
+    def weight(self, instance):
+        return HealthWeights.get(instance.get('Health'), 0.5) / (1 + self.failures.get(instance['Id'], 0))
+
+    def pick(self, key, instances):
+        with self.lock:
+            return random.choices(instances, weights=[self.weight(instance) for instance in instances])[0]
+
+    def finished(self, instance, ok):
+        with self.lock:
+            score = self.failures.get(instance['Id'], 0)
+            self.failures[instance['Id']] = score * FailureDecay if ok else score + 1
+
+
+Selectors = {
+    "random": RandomSelector,
+    "round_robin": RoundRobinSelector,
+    "least_outstanding": LeastOutstandingSelector,
+    "health_weighted": HealthWeightedSelector,
+}
+
+
+def discover(namespace, service, region=None):
+    """
+    DiscoverInstances of a service (healthy ones, or all when none is healthy).
+    :return: List of {'Id', 'Host', 'Port', 'Health'}.
+    """
+    response = execute_with_xray(
+        "DiscoverInstances", get_client('servicediscovery', region).discover_instances,
+        NamespaceName=namespace, ServiceName=service, HealthStatus='HEALTHY_OR_ELSE_ALL')
+    Instances = []
+    for instance in response.get('Instances') or []:
+        Attributes = instance.get('Attributes') or {}
+        Host = Attributes.get('AWS_INSTANCE_IPV4')
+        Port = Attributes.get('AWS_INSTANCE_PORT')
+        if Host and Port:
+            Instances.append({'Id': instance.get('InstanceId'), 'Host': Host, 'Port': Port,
+                              'Health': instance.get('HealthStatus')})
+    return Instances
+
+
+class DiscoveryCache:
+    """
+    Instances per (namespace, service, region) with stale-while-revalidate refresh.
+    """
+
+    def __init__(self, selector=None, ttl=None, max_stale=None, fetch=discover):
+        """
+        :param selector: Selector of the instances (default RoundRobinSelector).
+        :param fetch: Function (namespace, service, region) -> instances (default discover).
+        """
+        self.selector = selector or RoundRobinSelector()
+        self.ttl = DiscoveryTTL if ttl is None else ttl
+        self.max_stale = DiscoveryMaxStale if max_stale is None else max_stale
+        self.fetch = fetch
+        # key -> (instances, time of the fetch)
+        self.entries = {}
+        self.refreshing = set()
+        # key -> Future of the fetch in flight for a missing or expired entry
+        self.fetching = {}
+        self.lock = threading.Lock()
+
+    def _refresh(self, key):
+        try:
+            Instances = self.fetch(*key)
+            with self.lock:
+                self.entries[key] = (Instances, time.time())
+            return Instances
+        except Exception as e:
+            LogMessage(f"Discovery {key[1]}: refresh failed, keeping the cached instances: {e}")
+            return None
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def instances(self, namespace, service, region=None):
+        """Instances of the service; see the module comment for when they are fetched."""
+        key = (namespace, service, region)
+        with self.lock:
+            entry = self.entries.get(key)
+            Age = time.time() - entry[1] if entry else None
+            expired = entry is None or Age >= self.max_stale
+            refresh = not expired and Age >= self.ttl and key not in self.refreshing
+            if refresh:
+                self.refreshing.add(key)
+            pending = self.fetching.get(key) if expired else None
+            if expired and pending is None:
+                future = self.fetching[key] = Future()
+        if pending is not None:
+            # Another thread is fetching the service: its result (or error) is shared.
+            return pending.result()
+        if expired:
+            # Nothing usable yet: fetched in this thread (an error is raised to the caller).
+            try:
+                Instances = self.fetch(*key)
+            except Exception as e:
+                with self.lock:
+                    self.fetching.pop(key, None)
+                future.set_exception(e)
+                raise
+            with self.lock:
+                self.entries[key] = (Instances, time.time())
+                self.fetching.pop(key, None)
+            future.set_result(Instances)
+            return Instances
+        if refresh:
+            threading.Thread(target=self._refresh, args=(key,), name=f"discovery-{service}", daemon=True).start()
+        return entry[0]
+
+    @contextmanager
+    def instance(self, namespace, service, region=None):
+        """
+        Selected instance of the service ({'Id', 'Host', 'Port', 'Health'}, or None when it has
+        none). The block counts as one request to the instance; an exception marks it failed.
+        """
+        Instances = self.instances(namespace, service, region)
+        if not Instances:
+            yield None
+            return
+        instance = self.selector.pick((namespace, service, region), Instances)
+        self.selector.started(instance)
+        ok = False
+        try:
+            yield instance
+            ok = True
+        finally:
+            self.selector.finished(instance, ok)
+
+    def invalidate(self, namespace, service, region=None):
+        with self.lock:
+            self.entries.pop((namespace, service, region), None)
@@ -0,0 +1,100 @@
+# file: dynamodb.py
+import os
+import time
+import random
+import threading
+
+from .log import LogMessage
+
+# BatchWriteItem accepts at most 25 requests per call.
+BatchWriteMaxItems = 25
+BatchWriteMaxRetries = int(os.getenv("DYNAMODB_BATCH_MAX_RETRIES", "5"))
+BatchWriteBackoff = float(os.getenv("DYNAMODB_BATCH_BACKOFF", "0.05"))
+# Largest message stored with its claim check document: the item size limit (400 KB)
+# less the other attributes. Larger documents keep the pointer (see batch.materialize_each).
+MessageMaxBytes = 380 * 1024
+
+
+class DynamoDBSink:
+    """
+    DynamoDB target of a hub. The message counter (item ID=1, attribute Cont) is updated
+    with a single atomic ADD, and the message rows are buffered and written with
+    BatchWriteItem, retrying the unprocessed items with exponential backoff.
+
+    Usage:
+        sink = DynamoDBSink(dynamodb.Table(TableName), TableName)
+        sink.put(RecordID, {'ID': ID, 'Message': NewMessage})
+        failed = sink.flush()
+    """
+
+    def __init__(self, table, table_name, counter_key=None, counter_attribute='Cont'):
+        """
+        :param table: boto3 DynamoDB Table resource.
+        :param table_name: Name of the table.
+        :param counter_key: Key of the counter item (default {'ID': "1"}).
+        :param counter_attribute: Attribute incremented on each flush.
+        """
+        self.table = table
+        self.table_name = table_name
+        self.counter_key = counter_key or {'ID': "1"}
+        self.counter_attribute = counter_attribute
+        self.buffer = []
+        self.lock = threading.Lock()
+
+    def put(self, RecordID, item):
+        """Buffers a message row; it is written by the next flush()."""
+        with self.lock:
+            self.buffer.append((RecordID, item))
+
+    def increment(self, count=1):
+        """Atomically adds count to the counter item (created when it does not exist)."""
+        return self.table.update_item(
+            Key=self.counter_key,
+            UpdateExpression='ADD #cont :n',
+            ExpressionAttributeNames={'#cont': self.counter_attribute},
+            ExpressionAttributeValues={':n': count})
+
+    def _write(self, requests):
+        """Writes up to 25 (RecordID, item) pairs; returns the pairs still unprocessed after the retries."""
+        client = self.table.meta.client
+        pending = requests
+        for attempt in range(BatchWriteMaxRetries + 1):
+            RequestItems = {self.table_name: [
+                {'PutRequest': {'Item': item}} for RecordID, item in pending]}
+            response = client.batch_write_item(RequestItems=RequestItems)
+            unprocessed = response.get('UnprocessedItems', {}).get(self.table_name, [])
+            if not unprocessed:
+                return []
+            # Items are returned as they were sent; match them back by their key.
+            keys = [request['PutRequest']['Item'].get('ID') for request in unprocessed]
+            pending = [(RecordID, item) for RecordID, item in pending if item.get('ID') in keys]
+            if attempt < BatchWriteMaxRetries:
+                time.sleep(BatchWriteBackoff * (2 ** attempt) * (0.5 + random.random()))
+        LogMessage(f"DynamoDB {self.table_name}: {len(pending)} items unprocessed after {BatchWriteMaxRetries} retries")
+        return pending
+
+    def flush(self):
+        """
+        Increments the counter by the number of buffered rows and writes them.
+        :return: List with the RecordID of every row that was not written.
+        """
+        with self.lock:
+            requests, self.buffer = self.buffer, []
+        if not requests:
+            return []
+        failed = []
+        for start in range(0, len(requests), BatchWriteMaxItems):
+            chunk = requests[start:start + BatchWriteMaxItems]
+            try:
+                failed.extend(RecordID for RecordID, item in self._write(chunk))
+            except Exception as e:
+                LogMessage(f"BatchWriteItem to {self.table_name} failed: {e}")
+                failed.extend(RecordID for RecordID, item in chunk)
+        written = len(requests) - len(failed)
+        if written:
+            try:
+                self.increment(written)
+            except Exception as e:
+                # The rows are already stored; only the counter update is lost.
+                LogMessage(f"Counter update of {self.table_name} failed: {e}")
+        return failed
@@ -0,0 +1,164 @@
+# file: envelope.py
+# Message envelope shared by the hubs. Instead of prefixing the previous message with
+# "<- ..." on every hop, the payload travels unchanged and each hub appends one
+# compact [name, sent, received] entry (epoch ms) to the hop list:
+#     {"V": 1, "TraceId": "...", "MaxHops": 32, "Hops": [["LambdaA", 1718000000000, 1717999999950]], "Payload": ...}
+# The received stamp is optional (older hops are [name, sent]); see metrics.py for the
+# latencies derived from it.
+# Large payloads travel as a claim check pointer instead (see claimcheck.py).
+import os
+import time
+import uuid
+
+from .codec import dumps, loads, utf8
+
+EnvelopeVersion = 1
+MaxHops = int(os.getenv("ENVELOPE_MAX_HOPS", "32"))
+# Keys under which other senders wrap the message (EC2Hub/ECx POSTs, Lambda invoke payloads,
+# SNS notifications delivered to SQS without raw message delivery). A dict is only unwrapped
+# when it has one of them as its single key or is one of these transport shapes; any other
+# dict is the payload itself.
+WrapperKeys = ("MSG Data", "message", "Message")
+# {"message": Body, "source": source} of the Lambda target invocations of the hubs.
+LambdaInvokeKeys = {"message", "source"}
+
+
+def is_envelope(value):
+    return isinstance(value, dict) and "Hops" in value and "Payload" in value
+
+
+def _decode(value):
+    """Decodes bytes and (possibly double-encoded) JSON text; other text is returned as is."""
+    if isinstance(value, (bytes, bytearray)):
+        value = value.decode('utf-8', errors='replace')
+    for depth in range(3):
+        if not isinstance(value, str):
+            break
+        text = value.strip()
+        if not text or text[0] not in '{["':
+            break
+        try:
+            value = loads(text)
+        except ValueError:
+            break
+    return value
+
+
+def new_envelope(payload, trace_id=None, max_hops=None):
+    return {"V": EnvelopeVersion,
+            "TraceId": trace_id or uuid.uuid4().hex,
+            "MaxHops": MaxHops if max_hops is None else max_hops,
+            "Hops": [],
+            "Payload": payload}
+
+
+def _wrapper_key(value):
+    """Key holding the wrapped message when value is a transport wrapper, else None."""
+    if len(value) == 1:
+        key = next(iter(value))
+        return key if key in WrapperKeys else None
+    if value.get("Type") == "Notification" and "Message" in value and "TopicArn" in value:
+        return "Message"
+    if set(value) == LambdaInvokeKeys:
+        return "message"
+    return None
+
+
+def parse(message):
+    """
+    Reads a received message as an envelope.
+    :param message: dict, str or bytes; JSON text (also double-encoded) is decoded and the
+        transport wrappers (see WrapperKeys) are unwrapped.
+    :return: The received envelope, or a new one whose Payload is the (unwrapped) message.
+    """
+    value = _decode(message)
+    for depth in range(4):
+        if is_envelope(value):
+            return value
+        if not isinstance(value, dict):
+            break
+        key = _wrapper_key(value)
+        if key is None:
+            break
+        value = _decode(value[key])
+    if is_envelope(value):
+        return value
+    return new_envelope(value)
+
+
+def is_loop(envelope, name):
+    """True when the message already went through name, or reached its hop limit."""
+    Hops = envelope.get("Hops") or []
+    if len(Hops) >= envelope.get("MaxHops", MaxHops):
+        return True
+    return any(hop[0] == name for hop in Hops)
+
+
+def add_hop(envelope, name, timestamp=None, received=None):
+    """
+    Returns a copy of the envelope with the hop [name, sent epoch ms] appended, or
+    [name, sent, received] when the time the hub received the message is given.
+    :param timestamp: Send time in epoch seconds (default now).
+    :param received: Receive time in epoch seconds.
+    """
+    Hop = [name, int((time.time() if timestamp is None else timestamp) * 1000)]
+    if received is not None:
+        Hop.append(int(received * 1000))
+    Envelope = dict(envelope)
+    Envelope["Hops"] = list(envelope.get("Hops") or []) + [Hop]
+    return Envelope
+
+
+def encode(envelope):
+    """Compact JSON text of an envelope, encoded once per hop (see codec.py)."""
+    return dumps(envelope)
+
+
+def payload(envelope):
+    """Payload of an envelope; a claim check pointer is read from S3 only here, when the content is needed."""
+    from .claimcheck import rehydrate
+    return rehydrate(envelope.get("Payload"))
+
+
+def materialize(message, max_bytes=None):
+    """
+    Encoded envelope whose claim check pointer is replaced by the document it points to,
+    for the targets that store the content (S3, EFS, DynamoDB, RDS, CodeBuild artifacts);
+    the targets that forward the message keep the pointer.
+    :param message: Encoded envelope (text).
+    :param max_bytes: Keeps the pointer when the document would be larger (e.g. a DynamoDB item).
+    :return: The encoded envelope with the document, or message unchanged when it has no pointer.
+    """
+    if '"ClaimCheck"' not in message:
+        return message
+    Envelope = parse(message)
+    if not is_envelope(Envelope):
+        return message
+    from .claimcheck import is_claim_check
+    if not is_claim_check(Envelope["Payload"]):
+        return message
+    Text = encode(dict(Envelope, Payload=payload(Envelope)))
+    if max_bytes is not None and len(utf8(Text)) > max_bytes:
+        return message
+    return Text
+
+
+def forward(message, name, timestamp=None, received=None):
+    """
+    parse + loop check + add_hop in one call. With CLAIM_CHECK_BUCKET set, a payload whose
+    encoded envelope exceeds CLAIM_CHECK_THRESHOLD is replaced by a claim check pointer
+    (see claimcheck.py); a payload that is already a pointer is forwarded as is.
+    :param received: Time (epoch seconds) the hub received the message, stamped into the hop.
+    :return: (Envelope, Encoded) to be forwarded, or (Envelope, None) when it is a loop.
+    """
+    Envelope = parse(message)
+    if is_loop(Envelope, name):
+        return Envelope, None
+    Envelope = add_hop(Envelope, name, timestamp, received)
+    Encoded = encode(Envelope)
+    from . import claimcheck
+    if claimcheck.enabled() and len(utf8(Encoded)) > claimcheck.ClaimCheckThreshold \
+            and not claimcheck.is_claim_check(Envelope["Payload"]):
+        Envelope["Payload"] = claimcheck.offload(Envelope["Payload"])
+        Encoded = encode(Envelope)
+    return Envelope, Encoded
@@ -0,0 +1,177 @@
+# file: fanout.py
+# Delivery is at-least-once. A target that does not finish within its timeout is reported
+# as TIMEOUT and its messages are failed (and redelivered by SQS/Lambda), but a call that
+# already started cannot be interrupted: it keeps its pool worker until it returns and may
+# still deliver, so a redelivered message can reach that target twice. The clients of the
+# targets should bound each attempt with connect/read timeouts at or below
+# FANOUT_TARGET_TIMEOUT, which keeps that window short. A job that never got a worker is
+# cancelled and does not run at all.
+import os
+import time
+import math
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .log import LogMessage
+
+# Maximum number of targets dispatched at the same time and the time (seconds)
+# each target has to finish once it starts running. The pool is shared by all the fan-outs
+# of the process (e.g. the concurrent requests of EC2Hub), so it grows with the vCPUs.
+MaxWorkers = int(os.getenv("FANOUT_MAX_WORKERS", str(max(10, 4 * (os.cpu_count() or 1)))))
+TargetTimeout = float(os.getenv("FANOUT_TARGET_TIMEOUT", "10"))
+
+_Executor = None
+_ExecutorLock = threading.Lock()
+# Jobs submitted to the pool by every fan-out of the process and not finished yet.
+_Active = 0
+_ActiveLock = threading.Lock()
+
+
+def _finished(future):
+    global _Active
+    with _ActiveLock:
+        _Active -= 1
+
+
+def get_executor():
+    """
+    Returns the process-wide worker pool. It is created on first use and kept for the
+    lifetime of the execution environment, so warm invocations reuse the same threads.
+    """
+    global _Executor
+    if _Executor is None:
+        with _ExecutorLock:
+            if _Executor is None:
+                _Executor = ThreadPoolExecutor(
+                    max_workers=MaxWorkers, thread_name_prefix="fanout")
+    return _Executor
+
+
+class _Job:
+    def __init__(self, name, kind, function, args, kwargs, timeout):
+        self.name = name
+        self.kind = kind
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.timeout = timeout
+        self.started = None
+        self.finished = None
+
+
+class FanOut:
+    """
+    Dispatches every configured target of a hub concurrently on the shared worker pool.
+
+    Usage:
+        fan_out = FanOut(recorder=xray_recorder if xray_enabled else None)
+        fan_out.add(QueueName, "SQS", sqs.send_message, QueueUrl=URL, MessageBody=Body)
+        result = fan_out.run()
+
+    run() waits for all targets, enforcing the per-target timeout, and returns one
+    aggregated result with the status and duration of each target. The value returned
+    by each target function is kept in fan_out.outputs[(kind, name)].
+    """
+
+    def __init__(self, timeout=None, recorder=None):
+        """
+        :param timeout: Seconds each target may run before it is reported as TIMEOUT.
+        :param recorder: X-Ray recorder whose current trace entity is propagated to the workers.
+        """
+        self.timeout = TargetTimeout if timeout is None else timeout
+        self.recorder = recorder
+        self.jobs = []
+        self.outputs = {}
+
+    def add(self, name, kind, function, *args, **kwargs):
+        """
+        Registers a target call.
+        :param name: Target name, used in the result and in the X-Ray subsegment.
+        :param kind: Target type (SQS, SNS, DynamoDB, ...).
+        :param function: Function to be executed.
+        """
+        self.jobs.append(_Job(name, kind, function, args, kwargs, self.timeout))
+
+    def add_with_timeout(self, timeout, name, kind, function, *args, **kwargs):
+        """Same as add(), for a target that may run longer than the fan-out timeout."""
+        self.jobs.append(_Job(name, kind, function, args, kwargs, max(timeout, self.timeout)))
+
+    def _call(self, job, entity):
+        job.started = time.time()
+        if entity is not None:
+            self.recorder.set_trace_entity(entity)
+        try:
+            return job.function(*job.args, **job.kwargs)
+        finally:
+            job.finished = time.time()
+            if entity is not None:
+                self.recorder.clear_trace_entities()
+
+    def run(self):
+        Start = time.time()
+        entity = None
+        if self.recorder is not None:
+            try:
+                entity = self.recorder.get_trace_entity()
+            except Exception:
+                entity = None
+        global _Active
+        executor = get_executor()
+        futures = {}
+        with _ActiveLock:
+            # Jobs of other fan-outs ahead of these in the pool queue.
+            Ahead = _Active
+            _Active += len(self.jobs)
+        for job in self.jobs:
+            future = executor.submit(self._call, job, entity)
+            future.add_done_callback(_finished)
+            futures[future] = job
+        # A job still waiting for a worker after every wave had its full timeout is given up;
+        # the waves count the jobs of the other fan-outs queued before this one.
+        LongestTimeout = max([job.timeout for job in self.jobs] or [self.timeout])
+        QueueDeadline = Start + LongestTimeout * \
+            max(1, math.ceil((Ahead + len(self.jobs)) / float(MaxWorkers)))
+        Targets = {}
+        pending = set(futures)
+        while pending:
+            Now = time.time()
+            deadlines = [futures[f].started + futures[f].timeout
+                         for f in pending if futures[f].started]
+            if any(not futures[f].started for f in pending):
+                deadlines.append(QueueDeadline)
+            done, pending = wait(pending, timeout=max(0, min(deadlines) - Now),
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                job = futures[future]
+                Entry = {"Name": job.name, "Type": job.kind,
+                         "DurationMs": round(((job.finished or time.time()) - (job.started or Start)) * 1000, 2)}
+                try:
+                    self.outputs[(job.kind, job.name)] = future.result()
+                    Entry["Status"] = "OK"
+                except Exception as e:
+                    Entry["Status"] = "ERROR"
+                    Entry["Error"] = str(e)
+                    LogMessage(f"Target {job.kind} {job.name} failed: {e}\n{traceback.format_exc()}")
+                Targets[future] = Entry
+            Now = time.time()
+            for future in list(pending):
+                job = futures[future]
+                # cancel() fails when the job got a worker meanwhile: its own timeout applies then.
+                if (job.started and Now - job.started >= job.timeout) or \
+                        (not job.started and Now >= QueueDeadline and future.cancel()):
+                    pending.discard(future)
+                    Targets[future] = {"Name": job.name, "Type": job.kind, "Status": "TIMEOUT",
+                                       "DurationMs": round((Now - (job.started or Start)) * 1000, 2)}
+                    LogMessage(f"Target {job.kind} {job.name} timed out after {job.timeout}s")
+        Result = {"Targets": [Targets[f] for f in futures],
+                  "Succeeded": 0, "Failed": 0, "TimedOut": 0,
+                  "DurationMs": round((time.time() - Start) * 1000, 2)}
+        for Entry in Result["Targets"]:
+            if Entry["Status"] == "OK":
+                Result["Succeeded"] += 1
+            elif Entry["Status"] == "TIMEOUT":
+                Result["TimedOut"] += 1
+            else:
+                Result["Failed"] += 1
+        return Result
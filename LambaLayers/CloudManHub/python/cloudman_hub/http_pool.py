@@ -0,0 +1,198 @@
+# file: http_pool.py
+import os
+import time
+import threading
+import http.client
+from collections import deque
+
+from .log import LogMessage
+
+HTTPConnectTimeout = float(os.getenv("HTTP_CONNECT_TIMEOUT", "2"))
+HTTPReadTimeout = float(os.getenv("HTTP_READ_TIMEOUT", "5"))
+# Idle connections kept per host, and how long one may stay idle before it is discarded.
+# uvicorn (EC2Hub) closes idle keep-alive connections after 5 seconds.
+HTTPMaxIdle = int(os.getenv("HTTP_POOL_MAX_IDLE", "4"))
+HTTPIdleTimeout = float(os.getenv("HTTP_POOL_IDLE_TIMEOUT", "4"))
+# "True" sends the batched messages of one host back to back on one connection (HTTP/1.1 pipelining).
+HTTPPipelining = os.getenv("HTTP_PIPELINING", "False") == "True"
+
+# Errors raised when a pooled connection was closed by the server while idle.
+_StaleErrors = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                ConnectionResetError, BrokenPipeError, ConnectionAbortedError)
+
+_Pool = None
+_PoolLock = threading.Lock()
+
+
+def get_http_pool():
+    """Returns the process-wide HTTP pool, kept across warm invocations."""
+    global _Pool
+    if _Pool is None:
+        with _PoolLock:
+            if _Pool is None:
+                _Pool = HTTPPool()
+    return _Pool
+
+
+class _NonClosingReader:
+    """Read side of a pipelined connection; HTTPResponse.close() must not close it."""
+
+    def __init__(self, fp):
+        self.fp = fp
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+    def close(self):
+        pass
+
+
+class _SharedSocket:
+    """Gives every HTTPResponse of a pipelined connection the same buffered reader."""
+
+    def __init__(self, sock):
+        self.reader = _NonClosingReader(sock.makefile('rb'))
+
+    def makefile(self, *args, **kwargs):
+        return self.reader
+
+
+class HTTPPool:
+    """
+    Keep-alive HTTP/1.1 connections to the EC2 targets, reused across messages and
+    warm invocations. Each connection has a connect timeout and a read timeout, so a
+    dead instance fails the message instead of stalling the invocation.
+
+    Usage:
+        pool = get_http_pool()
+        results = pool.post_many(DNS, f'/{EC2Name}', [Body1, Body2])
+    """
+
+    def __init__(self, port=80, connect_timeout=None, read_timeout=None,
+                 max_idle=None, idle_timeout=None, pipelining=None):
+        self.port = port
+        self.connect_timeout = HTTPConnectTimeout if connect_timeout is None else connect_timeout
+        self.read_timeout = HTTPReadTimeout if read_timeout is None else read_timeout
+        self.max_idle = HTTPMaxIdle if max_idle is None else max_idle
+        self.idle_timeout = HTTPIdleTimeout if idle_timeout is None else idle_timeout
+        self.pipelining = HTTPPipelining if pipelining is None else pipelining
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def _connect(self, host):
+        conn = http.client.HTTPConnection(host, self.port, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        return conn
+
+    def _acquire(self, host):
+        """Returns (connection, reused)."""
+        Now = time.time()
+        with self.lock:
+            queue = self.idle.get(host)
+            while queue:
+                conn, released = queue.pop()
+                if Now - released < self.idle_timeout:
+                    return conn, True
+                conn.close()
+        return self._connect(host), False
+
+    def _release(self, host, conn):
+        with self.lock:
+            queue = self.idle.setdefault(host, deque())
+            if len(queue) < self.max_idle:
+                queue.append((conn, time.time()))
+                return
+        conn.close()
+
+    def post(self, host, path, body, headers=None):
+        """
+        Sends one POST, retrying once on a fresh connection when a pooled one was stale.
+        :return: (status, response body).
+        """
+        Headers = {'Content-type': 'application/json'}
+        Headers.update(headers or {})
+        for attempt in range(2):
+            if attempt == 0:
+                conn, reused = self._acquire(host)
+            else:
+                conn, reused = self._connect(host), False
+            try:
+                conn.request("POST", path, body=body, headers=Headers)
+                response = conn.getresponse()
+                data = response.read()
+            except _StaleErrors:
+                conn.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(host, conn)
+            return response.status, data
+
+    def post_many(self, host, path, bodies, headers=None):
+        """
+        Sends several POSTs to the same host over pooled connections, pipelined when enabled.
+        :return: One item per body, in order: the response status, or the exception raised.
+        """
+        if self.pipelining and len(bodies) > 1:
+            results = self._pipeline(host, path, bodies, headers)
+        else:
+            results = [None] * len(bodies)
+        for k, body in enumerate(bodies):
+            if results[k] is None:
+                try:
+                    results[k] = self.post(host, path, body, headers)[0]
+                except Exception as e:
+                    results[k] = e
+        return results
+
+    def _pipeline(self, host, path, bodies, headers):
+        """
+        Writes every request before reading the responses. Requests left without a
+        response (the server closed the connection) are returned as None, so post_many
+        sends them again one by one.
+        """
+        results = [None] * len(bodies)
+        Extra = "".join(f"{name}: {value}\r\n" for name, value in (headers or {}).items())
+        Payload = b"".join(
+            (f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+             f"{Extra}Content-Length: {len(body)}\r\n\r\n").encode('latin-1') + body
+            for body in bodies)
+        try:
+            conn, reused = self._acquire(host)
+        except Exception as e:
+            return [e] * len(bodies)
+        try:
+            conn.sock.sendall(Payload)
+            shared = _SharedSocket(conn.sock)
+            for k in range(len(bodies)):
+                response = http.client.HTTPResponse(shared, method="POST")
+                response.begin()
+                response.read()
+                results[k] = response.status
+                if response.will_close:
+                    break
+        except Exception as e:
+            LogMessage(f"Pipelining to {host} interrupted after {sum(r is not None for r in results)} "
+                       f"of {len(bodies)} responses: {e}")
+            conn.close()
+            return results
+        if all(r is not None for r in results):
+            self._release(host, conn)
+        else:
+            conn.close()
+        return results
+
+    def close(self):
+        """Closes every idle connection."""
+        with self.lock:
+            for queue in self.idle.values():
+                for conn, released in queue:
+                    conn.close()
+            self.idle.clear()
@@ -0,0 +1,217 @@
+# file: hubconfig.py
+# Precompiled hub configuration. The topology of a hub (its indexed target/source
+# environment variables plus what can be resolved ahead of time: EC2 DNS names and the
+# Cloud Map namespace) is written once at deploy time to a versioned JSON file:
+#     python -m cloudman_hub.hubconfig -o hub_config.json
+# and shipped with the function or container. At startup the hubs load that file and do
+# no environment scan and no control-plane call; without the file they scan the
+# environment as before.
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+
+from .log import LogMessage
+
+ConfigVersion = 1
+HubConfigFile = os.getenv("HUB_CONFIG_FILE", "hub_config.json")
+# Fingerprint of the environment the file was generated from (printed by the generator).
+# When set and different from the file's, the file is stale and is ignored.
+HubConfigFingerprint = os.getenv("HUB_CONFIG_FINGERPRINT", "")
+
+
+def _kind(prefix, *fields, required=("Name",), **variables):
+    """Indexed variables of a kind: field -> variable name without the _{i} suffix."""
+    Variables = {field: f"{prefix}_{field.upper()}" for field in fields}
+    Variables.update(variables)
+    return required, Variables
+
+
+# Every indexed variable family read by the hubs. Names are matched case-insensitively,
+# so AWS_SQS_QUEUE_TARGET_NAME_0 and aws_sqs_queue_Target_Name_0 are the same variable.
+Kinds = {
+    "SQSTarget": _kind("AWS_SQS_QUEUE_TARGET", "Name", "Region", "URL", "Account"),
+    "SNSTarget": _kind("AWS_SNS_TOPIC_TARGET", "Name", "Region", "ARN", "Account"),
+    "DynamoDBTarget": _kind("AWS_DYNAMODB_TABLE_TARGET", "Name", "Region", "Account"),
+    "LambdaTarget": _kind("AWS_LAMBDA_FUNCTION_TARGET", "Name", "Region", "Account"),
+    "CodeBuildTarget": _kind("AWS_CODEBUILD_PROJECT_TARGET", "Name", "Region", "Account"),
+    "S3Target": _kind("AWS_S3_BUCKET_TARGET", "Name", "Region", "Account"),
+    "EC2Target": _kind("AWS_INSTANCE_TARGET", "Name", "Region"),
+    "EFSTarget": _kind("AWS_EFS_FILE_SYSTEM_TARGET", "Name", Path="AWS_EFS_ACCESS_POINT_TARGET_PATH"),
+    "SSMParameterTarget": _kind("AWS_SSM_PARAMETER_TARGET", "Name", "Region", required=("Name", "Region")),
+    "RDSTarget": _kind("AWS_DB_INSTANCE_TARGET", "Name", "Endpoint"),
+    "ALBTarget": _kind("AWS_LB", "Name", URL="AWS_LB_DNS_NAME", required=("URL",)),
+    "ContainerTarget": _kind("CONTAINER_TARGET", "Name", "Region"),
+    "CloudMapTarget": _kind("AWS_SERVICE_DISCOVERY_SERVICE_TARGET", "Name", "Region"),
+    "CloudMapNamespace": _kind("AWS_SERVICE_DISCOVERY_NAMESPACE", "Name", "Region"),
+    "SQSSource": _kind("AWS_SQS_QUEUE_SOURCE", "Name", "Region", "URL", "Account"),
+    "SNSSource": _kind("AWS_SNS_TOPIC_SOURCE", "Name", "Region", "Account"),
+    "S3Source": _kind("AWS_S3_BUCKET_SOURCE", "Name"),
+    "SecretSource": _kind("AWS_SECRETSMANAGER_SECRET_VERSION_SOURCE", "Name", "ARN"),
+}
+
+_Config = None
+_ConfigLoaded = False
+_Scanned = None
+_ConfigLock = threading.Lock()
+
+
+def scan_environment(environ=None):
+    """
+    Reads every kind of Kinds from the environment. As in the original loops, the entries
+    of a kind stop at the first index without its required fields.
+    :return: Dict {kind: [{field: value}, ...]}.
+    """
+    Environment = {key.upper(): value for key, value in (os.environ if environ is None else environ).items()}
+    Targets = {}
+    for kind, (required, variables) in Kinds.items():
+        Entries = []
+        while True:
+            i = len(Entries)
+            Entry = {field: Environment.get(f"{variable}_{i}") for field, variable in variables.items()}
+            if not all(Entry[field] for field in required):
+                break
+            Entries.append(Entry)
+        Targets[kind] = Entries
+    return Targets
+
+
+def fingerprint(targets):
+    """Short hash of the scanned topology, used to detect a config file that is out of date."""
+    return hashlib.sha256(json.dumps(targets, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def _resolve_ec2(targets):
+    from .clients import get_client
+    Resolved = {}
+    for Target in targets.get("EC2Target", []):
+        response = get_client('ec2', Target["Region"]).describe_instances(
+            Filters=[{'Name': 'tag:Name', 'Values': [Target["Name"]]},
+                     {'Name': 'instance-state-name', 'Values': ['running']}])
+        for reservation in response['Reservations']:
+            for instance in reservation['Instances']:
+                Resolved[Target["Name"]] = [instance.get('PublicDnsName'), instance.get('PrivateDnsName')]
+    return Resolved
+
+
+def _resolve_cloud_map(targets):
+    from .clients import get_client
+    Resolved = {}
+    for Target in targets.get("CloudMapTarget", []) + targets.get("CloudMapNamespace", []):
+        client = get_client('servicediscovery', Target["Region"])
+        NamespaceID = None
+        for page in client.get_paginator('list_namespaces').paginate():
+            NamespaceID = next((ns['Id'] for ns in page['Namespaces'] if ns['Name'] == Target["Name"]), NamespaceID)
+        if NamespaceID is None:
+            continue
+        Services = []
+        for page in client.get_paginator('list_services').paginate(
+                Filters=[{'Name': 'NAMESPACE_ID', 'Values': [NamespaceID]}]):
+            for service in page['Services']:
+                Instances = []
+                for instance_page in client.get_paginator('list_instances').paginate(ServiceId=service['Id']):
+                    Instances.extend({"Id": instance['Id'], "Attributes": instance.get('Attributes', {})}
+                                     for instance in instance_page['Instances'])
+                Services.append({"Id": service['Id'], "Name": service['Name'], "Instances": Instances})
+        Resolved[Target["Name"]] = {"Id": NamespaceID, "Services": Services}
+    return Resolved
+
+
+def build_config(environ=None, resolve=True):
+    """
+    Builds the configuration document.
+    :param resolve: Also resolve the EC2 DNS names and the Cloud Map namespaces (needs AWS credentials).
+    """
+    Targets = scan_environment(environ)
+    Resolved = {}
+    if resolve:
+        Resolved["EC2"] = _resolve_ec2(Targets)
+        Resolved["CloudMap"] = _resolve_cloud_map(Targets)
+    return {"V": ConfigVersion, "Generated": int(time.time()), "Fingerprint": fingerprint(Targets),
+            "Targets": Targets, "Resolved": Resolved}
+
+
+def _config_path(path):
+    if os.path.isabs(path):
+        return path
+    for folder in (os.getenv("LAMBDA_TASK_ROOT"), os.getcwd(), os.path.dirname(os.path.abspath(sys.argv[0]))):
+        if folder and os.path.exists(os.path.join(folder, path)):
+            return os.path.join(folder, path)
+    return None
+
+
+def load_config(path=None):
+    """
+    Loads the configuration file once per process.
+    :return: The configuration dict, or None when there is no (valid, current) file.
+    """
+    global _Config, _ConfigLoaded
+    if _ConfigLoaded and path is None:
+        return _Config
+    with _ConfigLock:
+        if _ConfigLoaded and path is None:
+            return _Config
+        Config = None
+        File = _config_path(path or HubConfigFile)
+        if File:
+            try:
+                with open(File, encoding='utf-8') as f:
+                    Config = json.load(f)
+                if Config.get("V") != ConfigVersion:
+                    LogMessage(f"Hub config {File}: version {Config.get('V')} not supported, ignored")
+                    Config = None
+                elif HubConfigFingerprint and Config.get("Fingerprint") != HubConfigFingerprint:
+                    LogMessage(f"Hub config {File}: fingerprint differs from HUB_CONFIG_FINGERPRINT, ignored")
+                    Config = None
+                else:
+                    LogMessage(f"Hub config {File} loaded (generated at {Config.get('Generated')})")
+            except (OSError, ValueError) as e:
+                LogMessage(f"Hub config {File} could not be read: {e}")
+                Config = None
+        if path is None:
+            _Config, _ConfigLoaded = Config, True
+        return Config
+
+
+def targets(kind):
+    """
+    Entries of one kind of Kinds, from the configuration file or, without it, from the environment.
+    Usage:
+        for Target in targets("SQSTarget"):
+            Name, Region, URL = Target["Name"], Target["Region"], Target["URL"]
+    """
+    global _Scanned
+    Config = load_config()
+    if Config is not None:
+        return Config["Targets"].get(kind, [])
+    if _Scanned is None:
+        _Scanned = scan_environment()
+    return _Scanned[kind]
+
+
+def resolved(section, name):
+    """Value resolved at generation time (e.g. resolved("EC2", Name) -> [public, private]), or None."""
+    Config = load_config()
+    if Config is None:
+        return None
+    return Config.get("Resolved", {}).get(section, {}).get(name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generates the precompiled configuration of a CloudMan hub.")
+    parser.add_argument("-o", "--output", default=HubConfigFile)
+    parser.add_argument("--no-resolve", action="store_true",
+                        help="Do not resolve EC2 DNS names and Cloud Map namespaces.")
+    args = parser.parse_args(argv)
+    Config = build_config(resolve=not args.no_resolve)
+    with open(args.output, "w", encoding='utf-8') as f:
+        json.dump(Config, f, separators=(',', ':'))
+    print(f"{args.output}: fingerprint {Config['Fingerprint']}, "
+          f"{sum(len(entries) for entries in Config['Targets'].values())} entries")
+
+
+if __name__ == "__main__":
+    main()
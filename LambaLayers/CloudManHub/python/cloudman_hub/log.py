@@ -0,0 +1,18 @@
+# file: log.py
+# Each hub logs in its own way (print, logging, LogMessage). The shared modules
+# write through LogMessage so the hub can redirect the output with set_log_function.
+
+LogFunction = print
+
+
+def set_log_function(function):
+    """
+    Redirects the log output of the cloudman_hub modules.
+    :param function: Callable that receives a single string (e.g. print, logging.info, LogMessage).
+    """
+    global LogFunction
+    LogFunction = function
+
+
+def LogMessage(Msg):
+    LogFunction(Msg)
@@ -0,0 +1,256 @@
+# file: metrics.py
+# Hub metrics published as CloudWatch Embedded Metric Format (EMF) log lines: every
+# message and every target call is measured (no sampling, no X-Ray, no PutMetricData call).
+#
+# Hop latency: each hub stamps [name, sent ms, received ms] into the envelope hop list
+# (see envelope.py); from the last two hops:
+#     QueueLatency      = received by this hub - sent by the previous hub (queue + transport)
+#     ProcessingLatency = sent by this hub - received by this hub
+#     ChainLatency      = sent by this hub - sent by the first hub of the chain
+# Target calls: duration, bytes and outcome of every sink call, per target type and name.
+# Values are aggregated per dimension set into EMF histograms (Values/Counts).
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+from .log import LogMessage
+from .codec import dumps
+
+HopMetricsEnabled = os.getenv("HOP_METRICS_ENABLED", "True") == "True"
+TargetMetricsEnabled = os.getenv("TARGET_METRICS_ENABLED", "True") == "True"
+MetricsNamespace = os.getenv("METRICS_NAMESPACE", "CloudMan/Hops")
+TargetMetricsNamespace = os.getenv("TARGET_METRICS_NAMESPACE", "CloudMan/Targets")
+# Seconds between EMF lines of long-running hubs; the Lambda hubs flush after each invocation.
+MetricsFlushInterval = float(os.getenv("METRICS_FLUSH_INTERVAL", "60"))
+# EMF accepts at most 100 values per metric in one line.
+EMFMaxValues = 100
+
+MetricsFunction = print
+
+_HopMetrics = None
+_TargetMetrics = None
+_MetricsLock = threading.Lock()
+
+
+def set_metrics_function(function):
+    """Redirects the EMF lines (stdout by default, which CloudWatch Logs reads in Lambda)."""
+    global MetricsFunction
+    MetricsFunction = function
+
+
+def get_hop_metrics():
+    """Returns the process-wide hop latency aggregator."""
+    global _HopMetrics
+    if _HopMetrics is None:
+        with _MetricsLock:
+            if _HopMetrics is None:
+                _HopMetrics = HopMetrics()
+    return _HopMetrics
+
+
+def get_target_metrics(hub=None):
+    """
+    Returns the process-wide target call aggregator.
+    :param hub: Name of the hub (Hub dimension), taken on the first call.
+    """
+    global _TargetMetrics
+    if _TargetMetrics is None:
+        with _MetricsLock:
+            if _TargetMetrics is None:
+                _TargetMetrics = TargetMetrics(hub)
+    return _TargetMetrics
+
+
+def flush_metrics():
+    """Flushes every aggregator created in the process (end of a Lambda invocation, shutdown)."""
+    for aggregator in (_HopMetrics, _TargetMetrics):
+        if aggregator is not None:
+            aggregator.flush()
+
+
+def hop_latency(envelope):
+    """
+    Latencies of the last hop of an envelope.
+    :return: (Hub, Route, {metric: ms}), or None when the last hop has no receive stamp.
+    """
+    Hops = envelope.get("Hops") or []
+    if not Hops or len(Hops[-1]) < 3:
+        return None
+    Name, Sent, Received = Hops[-1][:3]
+    Latencies = {"ProcessingLatency": max(0, Sent - Received)}
+    if len(Hops) > 1:
+        Previous = Hops[-2]
+        Route = f"{Previous[0]}->{Name}"
+        # Clocks of different hosts may differ by a few ms; negative values are clamped.
+        Latencies["QueueLatency"] = max(0, Received - Previous[1])
+        Latencies["ChainLatency"] = max(0, Sent - Hops[0][1])
+    else:
+        Route = f"origin->{Name}"
+    return Name, Route, Latencies
+
+
+def _bucket(ms):
+    """Rounds to 2 significant digits (0.1 ms under 1 ms), which bounds the distinct values."""
+    if ms < 1:
+        return round(ms, 1)
+    return float(f"{ms:.2g}")
+
+
+class EMFAggregator:
+    """
+    Base of the aggregators: counts the values of each metric per dimension values and
+    writes them as EMF histograms on flush(), or by itself every flush_interval seconds.
+    Subclasses set dimensions (names) and units ({metric: unit}); Milliseconds values are
+    rounded by _bucket, the others are kept exact.
+    """
+    dimensions = ()
+    units = {}
+
+    def __init__(self, namespace, flush_interval=None):
+        self.namespace = namespace
+        self.flush_interval = MetricsFlushInterval if flush_interval is None else flush_interval
+        self.histograms = {}
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+
+    def add(self, key, values):
+        """
+        :param key: Tuple with the value of each dimension.
+        :param values: Dict {metric: value}.
+        """
+        with self.lock:
+            Histograms = self.histograms.setdefault(key, {})
+            for name, value in values.items():
+                Counts = Histograms.setdefault(name, {})
+                if self.units.get(name) == "Milliseconds":
+                    value = _bucket(value)
+                Counts[value] = Counts.get(value, 0) + 1
+            due = time.time() - self.last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def _lines(self, key, Histograms):
+        Series = {name: sorted(Histograms[name].items()) for name in self.units if name in Histograms}
+        for start in range(0, max(len(values) for values in Series.values()), EMFMaxValues):
+            Line = dict(zip(self.dimensions, key))
+            Metrics = []
+            for name, values in Series.items():
+                Chunk = values[start:start + EMFMaxValues]
+                if Chunk:
+                    Line[name] = {"Values": [value for value, count in Chunk],
+                                  "Counts": [count for value, count in Chunk]}
+                    Metrics.append({"Name": name, "Unit": self.units[name]})
+            Line["_aws"] = {"Timestamp": int(time.time() * 1000),
+                            "CloudWatchMetrics": [{"Namespace": self.namespace,
+                                                   "Dimensions": [list(self.dimensions)],
+                                                   "Metrics": Metrics}]}
+            yield Line
+
+    def flush(self):
+        """Writes one EMF line per dimension values with the histograms accumulated since the last flush."""
+        with self.lock:
+            Histograms, self.histograms = self.histograms, {}
+            self.last_flush = time.time()
+        for key, Series in Histograms.items():
+            for Line in self._lines(key, Series):
+                try:
+                    MetricsFunction(dumps(Line))
+                except Exception as e:
+                    LogMessage(f"Metrics of {key} not written: {e}")
+
+
+class HopMetrics(EMFAggregator):
+    """
+    Aggregates hop latencies per (Hub, Route).
+
+    Usage:
+        Envelope, NewMessage = forward(Message, Name, received=Received)
+        get_hop_metrics().record(Envelope)
+        ...
+        get_hop_metrics().flush()
+    """
+    dimensions = ("Hub", "Route")
+    units = {"QueueLatency": "Milliseconds", "ProcessingLatency": "Milliseconds",
+             "ChainLatency": "Milliseconds"}
+
+    def __init__(self, namespace=None, flush_interval=None):
+        super().__init__(namespace or MetricsNamespace, flush_interval)
+
+    def record(self, envelope):
+        if not HopMetricsEnabled:
+            return
+        Latency = hop_latency(envelope)
+        if Latency is None:
+            return
+        Hub, Route, Latencies = Latency
+        self.add((Hub, Route), Latencies)
+
+
+class _Call:
+    status = "OK"
+
+    def fail(self):
+        self.status = "ERROR"
+
+
+class TargetMetrics(EMFAggregator):
+    """
+    Aggregates the calls of each target per (Hub, TargetType, Target): Duration histogram,
+    Bytes handed to the target and the outcome counts (Calls, Errors, Timeouts and the
+    FailedMessages a target reported inside a successful call).
+
+    Usage:
+        with get_target_metrics(Name).measure(QueueName, "SQS", len(Body)):
+            sqs_client.send_message(QueueUrl=URL, MessageBody=Body)
+    or, for a FanOut run:
+        get_target_metrics(Name).record_fan_out(fan_out, FanOutResult, Bytes)
+    """
+    dimensions = ("Hub", "TargetType", "Target")
+    units = {"Duration": "Milliseconds", "Bytes": "Bytes", "Calls": "Count",
+             "Errors": "Count", "Timeouts": "Count", "FailedMessages": "Count"}
+
+    def __init__(self, hub=None, namespace=None, flush_interval=None):
+        super().__init__(namespace or TargetMetricsNamespace, flush_interval)
+        self.hub = hub or ""
+
+    def record(self, name, kind, duration_ms, nbytes=0, status="OK", failed_messages=0):
+        """
+        :param status: OK, ERROR or TIMEOUT (as in the FanOut result).
+        """
+        if not TargetMetricsEnabled:
+            return
+        self.add((self.hub, kind, name),
+                 {"Duration": duration_ms, "Bytes": nbytes, "Calls": 1,
+                  "Errors": int(status == "ERROR"), "Timeouts": int(status == "TIMEOUT"),
+                  "FailedMessages": failed_messages})
+
+    @contextmanager
+    def measure(self, name, kind, nbytes=0):
+        """
+        Times the block; an exception is recorded as an error and raised again. A call that
+        handles its own errors reports them with fail():
+            with Metrics.measure(ALBName, "ALB", Size) as call:
+                if not send_request(...):
+                    call.fail()
+        """
+        Start = time.time()
+        call = _Call()
+        try:
+            yield call
+        except BaseException:
+            call.fail()
+            raise
+        finally:
+            self.record(name, kind, (time.time() - Start) * 1000, nbytes, call.status)
+
+    def record_fan_out(self, fan_out, result, nbytes=0):
+        """
+        Records every target of a FanOut run. A target returning a list (the failed
+        RecordIDs, see batch.py) counts those as FailedMessages.
+        :param nbytes: Bytes handed to each target.
+        """
+        for entry in result["Targets"]:
+            output = fan_out.outputs.get((entry["Type"], entry["Name"]))
+            self.record(entry["Name"], entry["Type"], entry["DurationMs"], nbytes, entry["Status"],
+                        len(output) if entry["Status"] == "OK" and isinstance(output, list) else 0)
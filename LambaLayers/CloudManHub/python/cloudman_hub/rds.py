@@ -0,0 +1,207 @@
+# file: rds.py
+import time
+import threading
+
+from .log import LogMessage
+
+# The Lambda and CodeBuild hubs ship pymysql; the EC2Hub image ships mysql-connector.
+try:
+    import pymysql
+except ImportError:
+    pymysql = None
+try:
+    import mysql.connector as mysql_connector
+except ImportError:
+    mysql_connector = None
+
+# MySQL client errors of a connection that was closed by the server (e.g. after wait_timeout):
+# 2006 server has gone away, 2013 lost connection during query, 2055 lost connection at ...
+ConnectionLostErrors = (2006, 2013, 2055)
+# Credentials used when no secret is configured for a database.
+DefaultCredentials = ("TypeNewUserName", "TypeNewPassword")
+CreateTableQuery = """
+    CREATE TABLE IF NOT EXISTS exemplo (
+        id INT AUTO_INCREMENT,
+        texto VARCHAR(4000) NOT NULL,
+        PRIMARY KEY (id)
+    )
+"""
+
+
+def mysql_enabled():
+    return pymysql is not None or mysql_connector is not None
+
+
+def create_connection(host_name, user_name, user_password, db_name):
+    """Opens a MySQL connection (pymysql, else mysql-connector); None when it fails."""
+    try:
+        if pymysql is not None:
+            connection = pymysql.connect(host=host_name, user=user_name, password=user_password,
+                                         database=db_name, charset='utf8mb4',
+                                         cursorclass=pymysql.cursors.DictCursor)
+        elif mysql_connector is not None:
+            connection = mysql_connector.connect(host=host_name, user=user_name,
+                                                 passwd=user_password, database=db_name)
+        else:
+            LogMessage(f"RDS {db_name}: no MySQL driver installed (pymysql or mysql-connector)")
+            return None
+        LogMessage(f"RDS {db_name}: connected to {host_name}")
+        return connection
+    except Exception as e:
+        LogMessage(f"RDS {db_name}: connection to {host_name} failed: {e}")
+        return None
+
+
+def execute_query(connection, query, values=None):
+    """Executes and commits one statement; errors are logged."""
+    if connection is None:
+        return
+    cursor = connection.cursor()
+    try:
+        if values:
+            cursor.execute(query, values)
+        else:
+            cursor.execute(query)
+        connection.commit()
+    except Exception as e:
+        LogMessage(f"Query failed: {e}")
+    finally:
+        cursor.close()
+
+
+def connect_database(host_name, user_name, user_password, db_name):
+    """create_connection + creation of the message table; the connect function of an RDSSink."""
+    connection = create_connection(host_name, user_name, user_password, db_name)
+    if connection is not None:
+        execute_query(connection, CreateTableQuery)
+    return connection
+
+
+def match_credentials(database, credentials):
+    """
+    Username and password of a database: the first secret whose name contains the database
+    name, else the first secret, else DefaultCredentials.
+    :param credentials: List of (SecretName, username, password).
+    """
+    for SecretName, username, password in credentials:
+        if database in SecretName:
+            return username, password
+    if credentials:
+        return credentials[0][1], credentials[0][2]
+    return DefaultCredentials
+
+
+class RDSSink:
+    """
+    MySQL target of a hub. It is created once per database and kept across warm
+    invocations: the connection is validated with ping() before each flush and reopened
+    when MySQL dropped it. The rows of a batched event are buffered and written with a
+    single executemany (one multi-row INSERT) and one commit.
+
+    Usage:
+        sink = RDSSink(lambda: create_connection(Host, User, Password, DataBase), DataBase)
+        sink.put(RecordID, json.dumps(NewMessage))
+        failed = sink.flush()
+        sink.metrics()   # {"Commits", "Rows", "RowsPerCommit", "LastInsertMs", "AvgInsertMs"}
+    """
+
+    def __init__(self, connect, name, table='exemplo', column='texto'):
+        """
+        :param connect: Callable without arguments that opens a new connection (or returns None).
+        :param name: Database name, used in the logs.
+        :param table: Table that receives the messages.
+        :param column: Column that receives the message body.
+        """
+        self.connect = connect
+        self.name = name
+        self.query = f"INSERT INTO {table} ({column}) VALUES (%s)"
+        self.conn = None
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.commits = 0
+        self.rows = 0
+        self.insert_ms = 0.0
+        self.last_insert_ms = 0.0
+
+    def put(self, RecordID, value):
+        """Buffers a row; it is written by the next flush()."""
+        with self.lock:
+            self.buffer.append((RecordID, value))
+
+    def _reconnect(self):
+        self.close()
+        self.conn = self.connect()
+        if self.conn is None:
+            raise ConnectionError(f"Could not connect to database '{self.name}'")
+        return self.conn
+
+    def close(self):
+        """Closes the connection; the next flush() opens a new one."""
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+            self.conn = None
+
+    def connection(self):
+        """Returns a live connection, reconnecting when the current one no longer answers a ping."""
+        if self.conn is None:
+            return self._reconnect()
+        try:
+            self.conn.ping(reconnect=True)
+        except Exception as e:
+            LogMessage(f"RDS {self.name}: connection lost ({e}), reconnecting")
+            return self._reconnect()
+        return self.conn
+
+    def _insert(self, values):
+        conn = self.connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.executemany(self.query, values)
+            conn.commit()
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            raise
+
+    def flush(self):
+        """
+        Writes the buffered rows in one transaction; a dropped connection is retried once.
+        :return: List with the RecordID of every row that was not written.
+        """
+        with self.lock:
+            requests, self.buffer = self.buffer, []
+            if not requests:
+                return []
+            values = [(value,) for RecordID, value in requests]
+            Start = time.time()
+            try:
+                try:
+                    self._insert(values)
+                except Exception as e:
+                    if not (e.args and e.args[0] in ConnectionLostErrors):
+                        raise
+                    LogMessage(f"RDS {self.name}: {e}, retrying on a new connection")
+                    self._reconnect()
+                    self._insert(values)
+            except Exception as e:
+                LogMessage(f"RDS {self.name}: insert of {len(values)} rows failed: {e}")
+                return [RecordID for RecordID, value in requests]
+            self.last_insert_ms = (time.time() - Start) * 1000
+            self.insert_ms += self.last_insert_ms
+            self.commits += 1
+            self.rows += len(values)
+        LogMessage(f"RDS {self.name}: {len(values)} rows in 1 commit, {self.last_insert_ms:.1f} ms")
+        return []
+
+    def metrics(self):
+        """Insert latency and rows per commit since the sink was created."""
+        return {"Commits": self.commits,
+                "Rows": self.rows,
+                "RowsPerCommit": round(self.rows / self.commits, 2) if self.commits else 0,
+                "LastInsertMs": round(self.last_insert_ms, 2),
+                "AvgInsertMs": round(self.insert_ms / self.commits, 2) if self.commits else 0}
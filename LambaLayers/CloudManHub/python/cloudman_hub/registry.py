@@ -0,0 +1,105 @@
+# file: registry.py
+import os
+import time
+import threading
+
+from .log import LogMessage
+
+# Default lifetime (seconds) of a resolved target; 0 keeps it for the whole execution environment.
+RegistryTTL = float(os.getenv("REGISTRY_TTL", "300"))
+
+
+class TargetRegistry:
+    """
+    Lazy, memoized resolution of hub targets (DNS lookups, secrets, database connections...).
+
+    Nothing is resolved at import time: get() calls the factory the first time a key is
+    used and keeps the value for the lifetime of the execution environment, or until its
+    TTL expires. Concurrent callers of the same key wait for a single resolution.
+    Exceptions are not cached, so a failed resolution is retried on the next use.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = RegistryTTL if ttl is None else ttl
+        self.values = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+        self.timings = {}
+
+    def _key_lock(self, key):
+        with self.lock:
+            if key not in self.locks:
+                self.locks[key] = threading.Lock()
+            return self.locks[key]
+
+    def _cached(self, key):
+        entry = self.values.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires and time.time() >= expires:
+            return None
+        return entry
+
+    def get(self, key, factory, ttl=None):
+        """
+        :param key: Hashable identifier of the target, e.g. ('ec2', Name).
+        :param factory: Callable without arguments that resolves the value.
+        :param ttl: Lifetime in seconds for this key (None uses the registry TTL, 0 never expires).
+        :return: The cached or freshly resolved value.
+        """
+        entry = self._cached(key)
+        if entry is not None:
+            return entry[0]
+        with self._key_lock(key):
+            entry = self._cached(key)
+            if entry is not None:
+                return entry[0]
+            Start = time.time()
+            value = factory()
+            Elapsed = (time.time() - Start) * 1000
+            ttl = self.ttl if ttl is None else ttl
+            self.values[key] = (value, time.time() + ttl if ttl else None)
+            self.timings[key] = Elapsed
+            LogMessage(f"Registry: {key} resolved in {Elapsed:.1f} ms")
+            return value
+
+    def invalidate(self, key=None):
+        """Drops one key, or every key when key is None, so it is resolved again on next use."""
+        with self.lock:
+            if key is None:
+                self.values.clear()
+            else:
+                self.values.pop(key, None)
+
+
+class ColdStartTimer:
+    """
+    Collects the duration of each initialization step of a hub and logs the breakdown.
+
+    Usage:
+        ColdStart = ColdStartTimer()
+        ...imports...
+        ColdStart.mark("imports")
+        ...targets...
+        ColdStart.mark("targets")
+        ColdStart.report()
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.last = self.start
+        self.steps = []
+
+    def mark(self, name):
+        """Records the time spent since the previous mark (or since the timer was created)."""
+        Now = time.time()
+        self.steps.append((name, (Now - self.last) * 1000))
+        self.last = Now
+
+    def report(self):
+        Total = (time.time() - self.start) * 1000
+        Breakdown = ", ".join(f"{name} {elapsed:.1f} ms" for name, elapsed in self.steps)
+        LogMessage(f"Cold start: {Total:.1f} ms ({Breakdown})")
+        return {"TotalMs": round(Total, 2),
+                "Steps": {name: round(elapsed, 2) for name, elapsed in self.steps}}
@@ -0,0 +1,114 @@
+# file: s3_source.py
+# Reads the objects of aws:s3 events without loading them whole into memory.
+import os
+import json
+import zlib
+
+from .log import LogMessage
+
+# Largest content forwarded inline; bigger objects are forwarded by reference.
+# The default leaves room below the 256 KB limit of SQS/SNS for the rest of the message.
+S3MaxInlineBytes = int(os.getenv("S3_MAX_INLINE_BYTES", str(200 * 1024)))
+S3ChunkBytes = int(os.getenv("S3_CHUNK_BYTES", str(64 * 1024)))
+# Bytes of the beginning and of the end of an oversized object sent along with the reference (0 disables).
+S3SampleBytes = int(os.getenv("S3_SAMPLE_BYTES", "1024"))
+
+
+class _TooLarge(Exception):
+    pass
+
+
+def is_gzip(key, content_encoding=None):
+    return key.endswith(".gz") or (content_encoding or "").lower() == "gzip"
+
+
+def _read_chunks(body, gzip, max_bytes, chunk_size):
+    """Reads a streaming body chunk by chunk, decompressing it, and stops past max_bytes."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzip else None
+    parts, total = [], 0
+    try:
+        while True:
+            chunk = body.read(chunk_size)
+            if not chunk:
+                break
+            if decompressor is not None:
+                # max_length bounds the output of a single chunk (zip bombs).
+                chunk = decompressor.decompress(chunk, max_bytes - total + 1)
+            total += len(chunk)
+            if total > max_bytes:
+                raise _TooLarge()
+            parts.append(chunk)
+        if decompressor is not None:
+            tail = decompressor.flush()
+            total += len(tail)
+            if total > max_bytes:
+                raise _TooLarge()
+            parts.append(tail)
+    finally:
+        body.close()
+    return b"".join(parts)
+
+
+def sample_object(s3_client, bucket, key, size, gzip=False, sample_bytes=None):
+    """
+    Reads the first and the last bytes of an object with ranged GETs.
+    The tail of a gzip object cannot be decompressed on its own, so only its head is sampled.
+    :return: Tuple (Head, Tail) of strings (Tail is None for gzip objects).
+    """
+    sample_bytes = S3SampleBytes if sample_bytes is None else sample_bytes
+    response = s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{sample_bytes - 1}")
+    data = response['Body'].read()
+    if gzip:
+        data = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data, sample_bytes)
+        return data.decode('utf-8', errors='replace'), None
+    Head = data.decode('utf-8', errors='replace')
+    if size is not None and size <= sample_bytes:
+        return Head, None
+    response = s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes=-{sample_bytes}")
+    return Head, response['Body'].read().decode('utf-8', errors='replace')
+
+
+def reference_message(s3_client, bucket, key, size=None, etag=None, gzip=False, max_bytes=None):
+    """
+    Builds the message that replaces an oversized object: its location plus head/tail
+    samples, which together stay within max_bytes.
+    """
+    Message = {"S3Reference": {"Bucket": bucket, "Key": key,
+                               "ETag": (etag or "").strip('"'), "Size": size}}
+    SampleBytes = min(S3SampleBytes, (S3MaxInlineBytes if max_bytes is None else max_bytes) // 2)
+    if SampleBytes > 0:
+        try:
+            Message["Head"], Message["Tail"] = sample_object(
+                s3_client, bucket, key, size, gzip=gzip, sample_bytes=SampleBytes)
+        except Exception as e:
+            LogMessage(f"S3 sample of s3://{bucket}/{key} failed: {e}")
+    return json.dumps(Message)
+
+
+def read_s3_text(s3_client, bucket, key, size=None, etag=None, max_bytes=None, chunk_size=None):
+    """
+    Returns the text of an object, or a reference to it when the (decompressed) content
+    is larger than max_bytes. gzip objects (.gz key or Content-Encoding gzip) are
+    decompressed transparently.
+    :param size: Object size from the event; an uncompressed object over the cap is not downloaded.
+    :param etag: Object ETag from the event.
+    :return: Tuple (Message, Inline).
+    """
+    max_bytes = S3MaxInlineBytes if max_bytes is None else max_bytes
+    chunk_size = S3ChunkBytes if chunk_size is None else chunk_size
+    gzip = is_gzip(key)
+    if not gzip and size is not None and size > max_bytes:
+        return reference_message(s3_client, bucket, key, size, etag, max_bytes=max_bytes), False
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    gzip = gzip or is_gzip(key, response.get('ContentEncoding'))
+    etag = etag or response.get('ETag')
+    size = response.get('ContentLength', size)
+    if not gzip and size is not None and size > max_bytes:
+        response['Body'].close()
+        return reference_message(s3_client, bucket, key, size, etag, max_bytes=max_bytes), False
+    try:
+        data = _read_chunks(response['Body'], gzip, max_bytes, chunk_size)
+    except _TooLarge:
+        LogMessage(f"s3://{bucket}/{key} is larger than {max_bytes} bytes, forwarded by reference")
+        return reference_message(s3_client, bucket, key, size, etag, gzip, max_bytes), False
+    return data.decode('utf-8'), True
@@ -0,0 +1,462 @@
+# file: sinks.py
+# Pluggable targets of the hubs. Each target kind is a Sink with a single entry point,
+# send(messages) -> failed RecordIDs, where messages is the list of (RecordID, Body, Stamp)
+# of one event (a batch). build_sinks() creates the sinks of every target configured for
+# the hub (hubconfig.targets) and dispatch() runs them concurrently on a FanOut, so
+# batching, concurrency, retries and metrics are implemented here once for every hub.
+#
+# Usage:
+#     Sinks = build_sinks(LambdaName, Region)
+#     ...
+#     FanOutResult, failed = dispatch(Sinks, Messages, LambdaName)
+import os
+import time
+import random
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .log import LogMessage
+from .clients import get_client, get_resource
+from .fanout import FanOut, TargetTimeout
+from .batch import send_message_batch, publish_batch, send_each, failed_records, materialize_each
+from .codec import quoted, utf8
+from .dynamodb import DynamoDBSink, MessageMaxBytes
+from .http_pool import get_http_pool
+from .hubconfig import targets, resolved
+from .registry import TargetRegistry
+from .metrics import get_target_metrics
+from .ssm import get_ssm_counter
+from .xray import execute_with_xray, get_recorder
+
+# Times the messages a sink reported as failed are sent again (sinks with retry = True).
+SinkRetries = int(os.getenv("SINK_RETRIES", "1"))
+SinkRetryBackoff = float(os.getenv("SINK_RETRY_BACKOFF", "0.1"))
+# Workers that run the per-message calls of the targets without a batch API (Lambda, S3, ...).
+SinkMaxWorkers = int(os.getenv("SINK_MAX_WORKERS", str(max(16, 4 * (os.cpu_count() or 1)))))
+# Batches a sink sends at the same time across all the fan-outs of the process (0 = no limit).
+# SINK_CONCURRENCY_{KIND} (e.g. SINK_CONCURRENCY_LAMBDA) overrides it for one kind of target.
+SinkConcurrency = int(os.getenv("SINK_CONCURRENCY", "8"))
+# Target kinds of hubconfig.Kinds handled by build_sinks.
+SinkKinds = ("SQSTarget", "SNSTarget", "DynamoDBTarget", "S3Target", "LambdaTarget", "EFSTarget",
+             "RDSTarget", "SSMParameterTarget", "EC2Target", "CodeBuildTarget")
+
+_Executor = None
+_ExecutorLock = threading.Lock()
+_Registry = TargetRegistry()
+
+
+def get_sink_executor():
+    """Process-wide pool of the per-message calls (separate from the FanOut pool that runs the sinks)."""
+    global _Executor
+    if _Executor is None:
+        with _ExecutorLock:
+            if _Executor is None:
+                _Executor = ThreadPoolExecutor(max_workers=SinkMaxWorkers, thread_name_prefix="sink")
+    return _Executor
+
+
+class Sink:
+    """
+    Base of the targets. Subclasses implement deliver(messages), returning the RecordID
+    of every message that was not delivered, and may implement prepare() (one-time setup,
+    e.g. the counter item of a table) and close().
+    """
+    kind = None
+    # True when a failed message can be sent again without side effects (it was not written).
+    retry = True
+    # Seconds the sink may run in a FanOut (None uses the FanOut timeout).
+    timeout = None
+    # True when the sink must send one batch at a time (shared connection or buffer).
+    ordered = False
+    # True when the sink stores the content: claim check pointers are replaced by the document
+    # (see batch.materialize_each); documents above max_bytes keep the pointer.
+    persist = False
+    max_bytes = None
+    # boto3 service of the target (see client).
+    service = None
+
+    def __init__(self, name, region=None):
+        self.name = name
+        self.region = region
+        self.prepared = False
+        self.lock = threading.Lock()
+        self.slots = None
+        Limit = 1 if self.ordered else self.concurrency()
+        if Limit > 0:
+            self.slots = threading.BoundedSemaphore(Limit)
+
+    def concurrency(self):
+        """Batches this sink may send at the same time (0 = no limit)."""
+        return int(os.getenv(f"SINK_CONCURRENCY_{self.kind.upper()}", str(SinkConcurrency)))
+
+    @property
+    def client(self):
+        """
+        Pooled client of the target, looked up on each use: after clients.clear() (e.g. a
+        SnapStart restore) the sink gets a new client.
+        """
+        return get_client(self.service, self.region)
+
+    def prepare(self):
+        pass
+
+    def deliver(self, messages):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def call(self, function, *args, **kwargs):
+        """Calls the target inside an X-Ray subsegment named after it."""
+        return execute_with_xray(self.name, function, *args, **kwargs)
+
+    def each(self, function, messages):
+        """function(message) for each message, concurrently on the sink pool."""
+        return send_each(function, messages, get_sink_executor() if SinkMaxWorkers > 1 else None)
+
+    def send(self, messages):
+        """
+        Delivers the messages, retrying the failed ones. Concurrent calls (several fan-outs
+        of the hub) wait for a free slot of the sink; the wait counts in the FanOut timeout.
+        :return: RecordIDs of the messages that were not delivered.
+        """
+        if self.slots is None:
+            return self._send(messages)
+        with self.slots:
+            return self._send(messages)
+
+    def _send(self, messages):
+        if not self.prepared:
+            with self.lock:
+                if not self.prepared:
+                    self.prepare()
+                    self.prepared = True
+        unread = []
+        if self.persist:
+            messages, unread = materialize_each(messages, self.max_bytes)
+        failed = self.deliver(messages) if messages else []
+        for attempt in range(SinkRetries if self.retry else 0):
+            if not failed:
+                break
+            time.sleep(SinkRetryBackoff * (2 ** attempt) * (0.5 + random.random()))
+            Failed = set(failed)
+            LogMessage(f"{self.kind} {self.name}: retrying {len(Failed)} failed messages")
+            failed = self.deliver([message for message in messages if message[0] in Failed])
+        failed = list(failed) + unread
+        if failed:
+            LogMessage(f"{self.kind} {self.name}: {len(failed)} of {len(messages) + len(unread)} messages not delivered")
+        return failed
+
+
+class SQSSink(Sink):
+    kind = "SQS"
+    service = 'sqs'
+
+    def __init__(self, name, url, region=None):
+        super().__init__(name, region)
+        self.url = url
+
+    def deliver(self, messages):
+        return self.call(send_message_batch, self.client, self.url, messages)
+
+
+class SNSSink(Sink):
+    kind = "SNS"
+    service = 'sns'
+
+    def __init__(self, name, arn, region=None):
+        super().__init__(name, region)
+        self.arn = arn
+
+    def deliver(self, messages):
+        # The envelope is published as is; subscribers no longer receive it encoded twice as
+        # {"default": json.dumps(Body)} (envelope.parse still reads that form).
+        return self.call(publish_batch, self.client, self.arn, messages)
+
+
+class DynamoDBTableSink(Sink):
+    """Rows {'ID': "{hub}:{Stamp}", 'Message': Body} plus one atomic ADD on the counter item (ID=1)."""
+    kind = "DynamoDB"
+    # DynamoDBSink already retries the unprocessed items with backoff.
+    retry = False
+    persist = True
+    max_bytes = MessageMaxBytes
+
+    def __init__(self, name, hub, region=None, ttl_days=None, owner_attribute="HubName"):
+        """
+        :param ttl_days: Adds a TTL attribute that expires the rows after ttl_days.
+        :param owner_attribute: Attribute of the counter item naming the hub that created it.
+        """
+        super().__init__(name, region)
+        self.hub = hub
+        self.ttl_days = ttl_days
+        self.owner_attribute = owner_attribute
+
+    @property
+    def table(self):
+        return get_resource('dynamodb', self.region).Table(self.name)
+
+    def prepare(self):
+        table = self.table
+        try:
+            table.put_item(
+                Item={'ID': "1", self.owner_attribute: "Created by " + self.hub, 'Cont': 0},
+                ConditionExpression='attribute_not_exists(ID)')
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            pass
+
+    def deliver(self, messages):
+        sink = DynamoDBSink(self.table, self.name)
+        Item = {}
+        if self.ttl_days:
+            Item['TTL'] = int((datetime.datetime.now() + datetime.timedelta(days=self.ttl_days)).timestamp())
+        for RecordID, Body, Stamp in messages:
+            sink.put(RecordID, dict(Item, ID=f"{self.hub}:{Stamp}", Message=Body))
+        return self.call(sink.flush)
+
+
+class S3Sink(Sink):
+    """One object {hub}/{hub}:{Stamp}.txt per message."""
+    kind = "S3"
+    service = 's3'
+    persist = True
+
+    def __init__(self, name, hub, region=None):
+        super().__init__(name, region)
+        self.hub = hub
+
+    def deliver(self, messages):
+        def put_message(message):
+            self.call(self.client.put_object, Bucket=self.name,
+                      Key=f"{self.hub}/{self.hub}:{message[2]}.txt", Body=message[1])
+        return self.each(put_message, messages)
+
+
+class LambdaSink(Sink):
+    """Asynchronous invocation (InvocationType Event) with {"message": Body, "source": source}."""
+    kind = "Lambda"
+    service = 'lambda'
+
+    def __init__(self, name, region=None, source="aws:lambda"):
+        super().__init__(name, region)
+        self.source = source
+        self.suffix = ',"source":' + quoted(source) + '}'
+
+    def deliver(self, messages):
+        def invoke_message(message):
+            # The encoded envelope is embedded as a JSON string literal instead of being serialized again.
+            response = self.call(self.client.invoke, FunctionName=self.name, InvocationType='Event',
+                                 Payload='{"message":' + quoted(message[1]) + self.suffix)
+            if response.get('StatusCode') != 202:
+                raise RuntimeError(f"Invocation status {response.get('StatusCode')}")
+        return self.each(invoke_message, messages)
+
+
+class EFSSink(Sink):
+    """One file {hub}:{Stamp}.txt per message in the mounted access point."""
+    kind = "EFS"
+    persist = True
+
+    def __init__(self, name, path, hub):
+        super().__init__(name)
+        self.path = path
+        self.hub = hub
+
+    def prepare(self):
+        os.makedirs(self.path, exist_ok=True)
+
+    def deliver(self, messages):
+        def write_message(message):
+            with open(os.path.join(self.path, f"{self.hub}:{message[2]}.txt"), "w") as file:
+                file.write(message[1])
+        return send_each(write_message, messages)
+
+
+class RDSDatabaseSink(Sink):
+    """Every message of the batch in one multi-row INSERT and one commit (see rds.RDSSink)."""
+    kind = "RDS"
+    # RDSSink already retries once on a new connection.
+    retry = False
+    # One connection and one row buffer per database: a flush must only write (and report) its own batch.
+    ordered = True
+    persist = True
+
+    def __init__(self, name, rds_sink):
+        """
+        :param rds_sink: RDSSink, or a callable returning it (created on first use, e.g. from a TargetRegistry).
+        """
+        super().__init__(name)
+        self.rds_sink = rds_sink
+
+    def deliver(self, messages):
+        sink = self.rds_sink() if callable(self.rds_sink) else self.rds_sink
+        for RecordID, Body, Stamp in messages:
+            sink.put(RecordID, quoted(Body))
+        failed = self.call(sink.flush)
+        LogMessage(f"RDS metrics of '{self.name}': {sink.metrics()}")
+        return failed
+
+    def close(self):
+        if not callable(self.rds_sink):
+            self.rds_sink.close()
+
+
+class SSMSink(Sink):
+    """
+    One increment of len(messages) per batch (see ssm.SSMCounter). Increments that could not
+    be written stay pending in memory, so the messages are never failed (and counted twice).
+    """
+    kind = "SSM"
+    retry = False
+
+    def __init__(self, name, region, flush=True):
+        """
+        :param flush: Writes the increment at the end of each batch; False leaves it to the
+            SSMCounter thresholds and to a periodic flush of the hub.
+        """
+        super().__init__(name, region)
+        self.flush = flush
+
+    def deliver(self, messages):
+        counter = get_ssm_counter()
+        counter.add(self.name, self.region, len(messages))
+        pending = counter.flush(self.name, self.region) if self.flush else None
+        if pending:
+            LogMessage(f"SSM Parameter {self.name}: {pending[self.name]} increments pending")
+        return []
+
+
+def find_ec2_dns(name, region):
+    """Public DNS of the instance tagged Name=name (private DNS when it has none)."""
+    public_dns, private_dns = resolved("EC2", name) or (None, None)
+    if not (public_dns or private_dns):
+        response = get_client('ec2', region).describe_instances(
+            Filters=[{'Name': 'tag:Name', 'Values': [name]}])
+        for reservation in response['Reservations']:
+            for instance in reservation['Instances']:
+                public_dns = instance.get('PublicDnsName') or public_dns
+                private_dns = instance.get('PrivateDnsName') or private_dns
+    return public_dns or private_dns
+
+
+class EC2Sink(Sink):
+    """POST of each envelope to http://{dns}/{name}, on the keep-alive connections of the HTTP pool."""
+    kind = "EC2"
+
+    def __init__(self, name, region=None, dns=None):
+        """
+        :param dns: DNS name, or a callable (name, region) -> DNS; default find_ec2_dns, cached.
+        """
+        super().__init__(name, region)
+        self.dns = dns
+
+    def host(self):
+        if self.dns is None:
+            return _Registry.get(("ec2", self.name), lambda: find_ec2_dns(self.name, self.region))
+        return self.dns(self.name, self.region) if callable(self.dns) else self.dns
+
+    def deliver(self, messages):
+        Results = get_http_pool().post_many(self.host(), f'/{self.name}',
+                                            [utf8(message[1]) for message in messages])
+        failed = []
+        for message, Result in zip(messages, Results):
+            if isinstance(Result, Exception) or Result != 200:
+                LogMessage(f"EC2 {self.name}: message {message[0]} not delivered: {Result}")
+                failed.append(message[0])
+        return failed
+
+
+class CodeBuildSink(Sink):
+    """One build per message with EVENT=Body, or one build per window with a BuildCoalescer."""
+    kind = "CodeBuild"
+    service = 'codebuild'
+    # A build that failed to report its start may still run.
+    retry = False
+
+    def __init__(self, name, region=None, coalescer=None):
+        super().__init__(name, region)
+        self.coalescer = coalescer
+        # The window artifact in S3 holds the documents; EVENT (one build per message) keeps the pointer.
+        self.persist = coalescer is not None
+        if coalescer is not None:
+            # The window leader waits for the end of the window before starting the build.
+            self.timeout = coalescer.max_duration() + TargetTimeout
+
+    def deliver(self, messages):
+        if self.coalescer is not None:
+            self.call(self.coalescer.trigger, self.name, [message[1] for message in messages])
+            return []
+
+        def start_message(message):
+            self.call(self.client.start_build, projectName=self.name, environmentVariablesOverride=[
+                {'name': 'EVENT', 'value': message[1], 'type': 'PLAINTEXT'}])
+        return self.each(start_message, messages)
+
+
+def build_sinks(hub, region=None, account=None, kinds=SinkKinds,
+                lambda_source="aws:lambda", dynamodb_ttl_days=None, owner_attribute="HubName",
+                rds_sink=None, ssm_flush=True, ec2_dns=None, coalescer=None):
+    """
+    Creates the sinks of every configured target (hubconfig.targets) of the given kinds.
+    :param hub: Name of the hub, used in the DynamoDB IDs, S3 keys and EFS file names.
+    :param region: Default region of the targets without one; account likewise for URLs/ARNs.
+    :param rds_sink: Function (name, host) -> RDSSink; without it the RDS targets are skipped.
+    :param ssm_flush: False leaves the SSM increments to the hub's periodic flush (see SSMSink).
+    :param ec2_dns: Function (name, region) -> DNS of the EC2 targets (default find_ec2_dns, cached).
+    :param coalescer: BuildCoalescer of the CodeBuild targets (None starts one build per message).
+    :return: List of sinks, in the order of SinkKinds.
+    """
+    Sinks = []
+    for kind in SinkKinds:
+        if kind not in kinds:
+            continue
+        for Target in targets(kind):
+            Name = Target["Name"]
+            TargetRegion = Target.get("Region") or region
+            Account = Target.get("Account") or account
+            if kind == "SQSTarget":
+                URL = Target["URL"] or f"https://sqs.{TargetRegion}.amazonaws.com/{Account}/{Name}"
+                Sinks.append(SQSSink(Name, URL, TargetRegion))
+            elif kind == "SNSTarget":
+                ARN = Target["ARN"] or f"arn:aws:sns:{TargetRegion}:{Account}:{Name}"
+                Sinks.append(SNSSink(Name, ARN, TargetRegion))
+            elif kind == "DynamoDBTarget":
+                Sinks.append(DynamoDBTableSink(Name, hub, TargetRegion, dynamodb_ttl_days, owner_attribute))
+            elif kind == "S3Target":
+                Sinks.append(S3Sink(Name, hub, TargetRegion))
+            elif kind == "LambdaTarget":
+                Sinks.append(LambdaSink(Name, TargetRegion, lambda_source))
+            elif kind == "EFSTarget":
+                Sinks.append(EFSSink(Name, Target["Path"], hub))
+            elif kind == "RDSTarget":
+                if rds_sink is not None:
+                    Host = (Target["Endpoint"] or "").split(":")[0]
+                    Sinks.append(RDSDatabaseSink(Name, lambda Name=Name, Host=Host: rds_sink(Name, Host)))
+            elif kind == "SSMParameterTarget":
+                Sinks.append(SSMSink(Name, Target["Region"], ssm_flush))
+            elif kind == "EC2Target":
+                Sinks.append(EC2Sink(Name, TargetRegion, ec2_dns))
+            elif kind == "CodeBuildTarget":
+                Sinks.append(CodeBuildSink(Name, TargetRegion, coalescer))
+    LogMessage(f"Sinks of {hub}: " + ", ".join(f"{sink.kind} {sink.name}" for sink in Sinks))
+    return Sinks
+
+
+def dispatch(sinks, messages, hub=None, fan_out=None):
+    """
+    Sends the messages to every sink concurrently and records the target metrics.
+    :param messages: List of (RecordID, Body, Stamp).
+    :param fan_out: FanOut with other targets of the hub already added (default a new one).
+    :return: (FanOutResult, failed RecordIDs of the batch, see batch.failed_records).
+    """
+    fan_out = fan_out or FanOut(recorder=get_recorder())
+    for sink in sinks:
+        if sink.timeout:
+            fan_out.add_with_timeout(sink.timeout, sink.name, sink.kind, sink.send, messages)
+        else:
+            fan_out.add(sink.name, sink.kind, sink.send, messages)
+    FanOutResult = fan_out.run()
+    get_target_metrics(hub).record_fan_out(
+        fan_out, FanOutResult, sum(len(utf8(message[1])) for message in messages))
+    return FanOutResult, failed_records(fan_out, FanOutResult, messages)
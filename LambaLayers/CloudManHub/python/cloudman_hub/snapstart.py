@@ -0,0 +1,210 @@
+# file: snapstart.py
+# Lambda SnapStart support. With SnapStart the initialization phase runs once, the memory
+# of the environment is snapshotted and every cold start restores that snapshot. Open
+# sockets, secrets and random state would be shared by every restored environment, so:
+#   - before_snapshot hooks build what is safe to snapshot (imports, boto3 clients and
+#     their service models) and close every network connection;
+#   - after_restore hooks reseed random, drop cached secrets/DNS/connections and the pooled
+#     boto3 clients, and reopen what the hub needs eagerly. The clients are created again
+#     on first use with new credential providers (the service models stay loaded in the
+#     boto3 session), so no credentials of the snapshot are reused.
+# The hooks are registered in the Lambda runtime (snapshot_restore_py) when it exists
+# and kept here as well, so the local harness can run them:
+#     python -m cloudman_hub.snapstart LambdaFiles/LambdaHub/LambdaHub.py --event event.json
+import os
+import sys
+import json
+import time
+import random
+import importlib
+import importlib.util
+
+from .log import LogMessage
+from . import clients
+
+try:
+    from snapshot_restore_py import register_before_snapshot, register_after_restore
+except ImportError:
+    register_before_snapshot = register_after_restore = None
+
+_BeforeSnapshot = []
+_AfterRestore = []
+
+
+def snapstart_init():
+    """True while the initialization phase runs to create a SnapStart snapshot."""
+    return os.getenv("AWS_LAMBDA_INITIALIZATION_TYPE") == "snap-start"
+
+
+def before_snapshot(function):
+    """Decorator: function runs right before the snapshot is taken."""
+    _BeforeSnapshot.append(function)
+    if register_before_snapshot is not None:
+        register_before_snapshot(function)
+    return function
+
+
+def after_restore(function):
+    """Decorator: function runs right after a snapshot is restored, before the first event."""
+    _AfterRestore.append(function)
+    if register_after_restore is not None:
+        register_after_restore(function)
+    return function
+
+
+def run_before_snapshot():
+    for function in _BeforeSnapshot:
+        function()
+
+
+def run_after_restore():
+    for function in _AfterRestore:
+        function()
+
+
+def prewarm(client_specs=(), modules=()):
+    """
+    Imports modules and builds the boto3 clients of client_specs [(service, region)], so the
+    import and service model loading are part of the snapshot. No request is made.
+    """
+    for module in modules:
+        importlib.import_module(module)
+    for service, region in client_specs:
+        clients.get_client(service, region)
+
+
+def close_connections(registry=None):
+    """
+    Closes the network connections of the process: idle HTTP connections of the boto3
+    clients and of the EC2 pool, and every cached registry value with a close() method
+    (RDS sinks). The registry is emptied, so secrets, DNS and connections are resolved
+    again on first use.
+    """
+    clients.close_connections()
+    from . import http_pool
+    if http_pool._Pool is not None:
+        http_pool._Pool.close()
+    if registry is not None:
+        for value, expires in list(registry.values.values()):
+            if hasattr(value, 'close'):
+                try:
+                    value.close()
+                except Exception as e:
+                    LogMessage(f"SnapStart: close failed: {e}")
+        registry.invalidate()
+
+
+def restore(registry=None):
+    """
+    Default after-restore work: new random state and no connection, secret or boto3 client
+    (with its credentials) inherited from the snapshot.
+    """
+    random.seed()
+    close_connections(registry)
+    clients.clear()
+
+
+def open_sockets():
+    """
+    File descriptors of the process that are sockets, apart from stdin/stdout/stderr
+    (None where /proc is not available).
+    """
+    try:
+        Descriptors = os.listdir('/proc/self/fd')
+    except OSError:
+        return None
+    Sockets = []
+    for fd in Descriptors:
+        if int(fd) < 3:
+            continue
+        try:
+            if os.readlink(f'/proc/self/fd/{fd}').startswith('socket:'):
+                Sockets.append(int(fd))
+        except OSError:
+            pass
+    return Sockets
+
+
+def _restored_clone(module, event, write):
+    Start = time.time()
+    run_after_restore()
+    Report = {"Pid": os.getpid(), "RestoreMs": round((time.time() - Start) * 1000, 2),
+              "Random": random.random()}
+    if event is not None:
+        Start = time.time()
+        try:
+            Report["Result"] = module.lambda_handler(event, None)
+        except Exception as e:
+            Report["Error"] = repr(e)
+        Report["FirstEventMs"] = round((time.time() - Start) * 1000, 2)
+    os.write(write, json.dumps(Report, default=str).encode('utf-8'))
+
+
+def main(argv=None):
+    """
+    Local checkpoint/restore harness. The hub is imported in snap-start mode and the
+    before-snapshot hooks run; the process is then forked once per clone, which stands in
+    for restoring the snapshot (each clone starts from the same memory). Each clone runs
+    the after-restore hooks and, with --event, one invocation.
+    Fails when a socket is still open at the checkpoint or when two clones share random state.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description="Simulates SnapStart checkpoint/restore of a hub.")
+    parser.add_argument("hub", help="Path of the hub module, e.g. LambdaFiles/LambdaHub/LambdaHub.py")
+    parser.add_argument("--event", help="JSON file with an event for the first invocation of each clone")
+    parser.add_argument("--clones", type=int, default=2)
+    args = parser.parse_args(argv)
+
+    os.environ["AWS_LAMBDA_INITIALIZATION_TYPE"] = "snap-start"
+    Report = {"Hub": args.hub}
+    Start = time.time()
+    spec = importlib.util.spec_from_file_location("hub_under_test", args.hub)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    Report["InitMs"] = round((time.time() - Start) * 1000, 2)
+    Start = time.time()
+    run_before_snapshot()
+    Report["BeforeSnapshotMs"] = round((time.time() - Start) * 1000, 2)
+    Report["SocketsAtCheckpoint"] = open_sockets()
+    event = None
+    if args.event:
+        with open(args.event, encoding='utf-8') as f:
+            event = json.load(f)
+
+    Clones = []
+    for n in range(args.clones):
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read)
+            try:
+                _restored_clone(module, event, write)
+            finally:
+                os._exit(0)
+        os.close(write)
+        Chunks = []
+        while True:
+            chunk = os.read(read, 65536)
+            if not chunk:
+                break
+            Chunks.append(chunk)
+        os.close(read)
+        os.waitpid(pid, 0)
+        Clones.append(json.loads(b"".join(Chunks) or b"{}"))
+    Report["Clones"] = Clones
+
+    Failures = []
+    if Report["SocketsAtCheckpoint"]:
+        Failures.append(f"sockets open at checkpoint: {Report['SocketsAtCheckpoint']}")
+    Randoms = [clone.get("Random") for clone in Clones]
+    if len(set(Randoms)) != len(Randoms):
+        Failures.append("restored clones share the same random state")
+    Failures.extend(f"clone {clone.get('Pid')}: {clone['Error']}" for clone in Clones if "Error" in clone)
+    Report["Failures"] = Failures
+    print(json.dumps(Report, indent=2, default=str))
+    return 1 if Failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
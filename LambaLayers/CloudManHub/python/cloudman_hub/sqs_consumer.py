@@ -0,0 +1,231 @@
+# file: sqs_consumer.py
+# Long-running SQS consumer of the container hubs (EC2Hub, ECx). Each queue gets
+# SQS_CONSUMER_WORKERS threads; every worker receives up to 10 messages per call, hands
+# the whole batch to the hub (which dispatches it to the sinks at once) and acknowledges
+# the delivered messages with one DeleteMessageBatch. While a batch is being processed a
+# heartbeat extends its visibility timeout, so a slow batch is not redelivered to another
+# worker. Messages the hub reports as failed are left in the queue and are redelivered
+# once their visibility timeout expires (as the partial-batch response of the Lambda hubs).
+#
+# With SQS_AUTOSCALE=True the number of workers follows the queue depth: every
+# SQS_SCALE_INTERVAL seconds ApproximateNumberOfMessages is read and the workers grow at
+# once to one per SQS_MESSAGES_PER_WORKER messages (up to SQS_MAX_WORKERS, and only while
+# the CPU is below SQS_SCALE_CPU_LIMIT), so a backlog drains quickly. They shrink one at a
+# time, after SQS_SCALE_DOWN_PERIODS consecutive readings asking for fewer, down to
+# SQS_MIN_WORKERS; an idle queue keeps only that many long polls open.
+#
+# Usage:
+#     def handler(messages):          # [(MessageId, Body), ...]
+#         ...
+#         return failed               # MessageIds that were not delivered
+#     consumer = SQSConsumer(sqs_client, QueueURL, QueueName, handler, segment=InstanceName)
+#     consumer.start()
+#     ...
+#     consumer.stop()
+#     consumer.join()
+import os
+import math
+import threading
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from .log import LogMessage
+from .xray import execute_with_xray, get_recorder
+
+# Receive loops per queue.
+SQSConsumerWorkers = int(os.getenv("SQS_CONSUMER_WORKERS", "2"))
+# Messages per ReceiveMessage (1 to 10) and long-poll wait (seconds).
+SQSBatchSize = min(10, max(1, int(os.getenv("SQS_BATCH_SIZE", "10"))))
+SQSWaitTime = int(os.getenv("SQS_WAIT_TIME", "20"))
+# Visibility timeout (seconds) set on receive and renewed by the heartbeat every
+# SQS_HEARTBEAT_INTERVAL seconds while the batch is in flight.
+SQSVisibilityTimeout = int(os.getenv("SQS_VISIBILITY_TIMEOUT", "30"))
+SQSHeartbeatInterval = float(os.getenv("SQS_HEARTBEAT_INTERVAL", str(SQSVisibilityTimeout / 3)))
+# Worker autoscaling on the queue depth (see above); off by default, the queue keeps
+# SQS_CONSUMER_WORKERS workers.
+SQSAutoscale = os.getenv("SQS_AUTOSCALE", "False") == "True"
+SQSMinWorkers = int(os.getenv("SQS_MIN_WORKERS", "1"))
+SQSMaxWorkers = int(os.getenv("SQS_MAX_WORKERS", str(max(SQSConsumerWorkers, 4 * (os.cpu_count() or 1)))))
+SQSMessagesPerWorker = int(os.getenv("SQS_MESSAGES_PER_WORKER", "50"))
+SQSScaleInterval = float(os.getenv("SQS_SCALE_INTERVAL", "15"))
+SQSScaleDownPeriods = int(os.getenv("SQS_SCALE_DOWN_PERIODS", "3"))
+# CPU utilization (%) above which no workers are added.
+SQSScaleCPULimit = float(os.getenv("SQS_SCALE_CPU_LIMIT", "80"))
+
+
+def cpu_utilization():
+    """
+    CPU utilization (%) of the host: psutil since the previous call when installed,
+    else the 1-minute load average over the vCPUs.
+    """
+    if psutil is not None:
+        return psutil.cpu_percent(interval=None)
+    try:
+        return 100.0 * os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return 0.0
+
+
+class SQSConsumer:
+    """
+    Worker threads that receive, process and acknowledge the messages of one queue.
+    """
+
+    def __init__(self, client, url, name, handler, workers=None, segment=None, autoscale=None):
+        """
+        :param client: boto3 SQS client of the queue region.
+        :param handler: Function [(MessageId, Body)] -> failed MessageIds; an exception fails the batch.
+        :param workers: Receive loops started with the queue (default SQS_CONSUMER_WORKERS).
+        :param segment: X-Ray segment opened around each batch when X-Ray is enabled.
+        :param autoscale: Scales the workers on the queue depth (default SQS_AUTOSCALE).
+        """
+        self.client = client
+        self.url = url
+        self.name = name
+        self.handler = handler
+        self.workers = SQSConsumerWorkers if workers is None else workers
+        self.segment = segment
+        self.autoscale = SQSAutoscale if autoscale is None else autoscale
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        # Worker index -> thread; the workers with index >= self.workers leave after their batch.
+        self.threads = {}
+        self.scaler = None
+        self.low_readings = 0
+
+    def start(self):
+        self.resize(self.workers)
+        if self.autoscale:
+            self.scaler = threading.Thread(target=self.scale_loop, name=f"sqs-{self.name}-scaler", daemon=True)
+            self.scaler.start()
+        LogMessage(f"SQS {self.name}: {self.workers} workers, batches of {SQSBatchSize}")
+
+    def stop(self):
+        """Stops the workers after their current batch (see join)."""
+        self.stopped.set()
+
+    def join(self, timeout=None):
+        """Waits for the stopped workers, up to timeout seconds each (default one long poll)."""
+        with self.lock:
+            threads = list(self.threads.values())
+        for thread in threads:
+            thread.join(SQSWaitTime + 5 if timeout is None else timeout)
+        with self.lock:
+            self.threads = {}
+
+    def resize(self, workers):
+        """Sets the number of workers: missing ones are started, extra ones leave after their batch."""
+        with self.lock:
+            self.workers = workers
+            for i in range(workers):
+                thread = self.threads.get(i)
+                if thread is None or not thread.is_alive():
+                    thread = threading.Thread(target=self.run, args=(i,), name=f"sqs-{self.name}-{i}", daemon=True)
+                    self.threads[i] = thread
+                    thread.start()
+
+    def depth(self):
+        """Messages waiting in the queue (ApproximateNumberOfMessages)."""
+        response = self.client.get_queue_attributes(QueueUrl=self.url, AttributeNames=['ApproximateNumberOfMessages'])
+        return int(response['Attributes']['ApproximateNumberOfMessages'])
+
+    def scale(self, depth, cpu):
+        """
+        Workers for the given queue depth and CPU utilization, with hysteresis: up at once,
+        down by one after SQSScaleDownPeriods consecutive readings asking for fewer.
+        """
+        desired = min(max(math.ceil(depth / SQSMessagesPerWorker), SQSMinWorkers), SQSMaxWorkers)
+        if desired > self.workers:
+            self.low_readings = 0
+            if cpu >= SQSScaleCPULimit:
+                return self.workers
+            return desired
+        if desired < self.workers:
+            self.low_readings += 1
+            if self.low_readings >= SQSScaleDownPeriods:
+                self.low_readings = 0
+                return self.workers - 1
+            return self.workers
+        self.low_readings = 0
+        return self.workers
+
+    def scale_loop(self):
+        cpu_utilization()
+        while not self.stopped.wait(SQSScaleInterval):
+            try:
+                depth = self.depth()
+                cpu = cpu_utilization()
+                workers = self.scale(depth, cpu)
+                if workers != self.workers:
+                    LogMessage(f"SQS {self.name}: {depth} messages, CPU {cpu:.0f}%, "
+                               f"workers {self.workers} -> {workers}")
+                    self.resize(workers)
+            except Exception as e:
+                LogMessage(f"SQS {self.name}: error reading the queue depth: {e}")
+
+    def run(self, index=0):
+        while not self.stopped.is_set() and index < self.workers:
+            try:
+                self.poll()
+            except Exception as e:
+                LogMessage(f"SQS {self.name}: error processing messages: {e}")
+                self.stopped.wait(1)
+
+    def poll(self):
+        """
+        One receive / process / delete cycle.
+        :return: Number of messages received.
+        """
+        recorder = get_recorder()
+        if recorder is not None and self.segment:
+            recorder.begin_segment(self.segment)
+        try:
+            response = execute_with_xray(
+                self.name, self.client.receive_message, QueueUrl=self.url,
+                MaxNumberOfMessages=SQSBatchSize, WaitTimeSeconds=SQSWaitTime,
+                VisibilityTimeout=SQSVisibilityTimeout)
+            Messages = response.get('Messages') or []
+            if Messages:
+                self.process(Messages)
+            return len(Messages)
+        finally:
+            if recorder is not None and self.segment:
+                recorder.end_segment()
+
+    def process(self, Messages):
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self.heartbeat, args=(Messages, done), daemon=True)
+        heartbeat.start()
+        try:
+            failed = set(self.handler([(message['MessageId'], message['Body']) for message in Messages]) or [])
+        except Exception as e:
+            LogMessage(f"SQS {self.name}: batch of {len(Messages)} messages failed: {e}")
+            failed = {message['MessageId'] for message in Messages}
+        finally:
+            done.set()
+            heartbeat.join()
+        self.delete([message for message in Messages if message['MessageId'] not in failed])
+        if failed:
+            LogMessage(f"SQS {self.name}: {len(failed)} messages left in the queue for redelivery")
+
+    def heartbeat(self, Messages, done):
+        """Renews the visibility timeout of the batch until done is set."""
+        while not done.wait(SQSHeartbeatInterval):
+            try:
+                self.client.change_message_visibility_batch(QueueUrl=self.url, Entries=[
+                    {'Id': str(i), 'ReceiptHandle': message['ReceiptHandle'],
+                     'VisibilityTimeout': SQSVisibilityTimeout} for i, message in enumerate(Messages)])
+            except Exception as e:
+                LogMessage(f"SQS {self.name}: error extending the visibility timeout: {e}")
+
+    def delete(self, Messages):
+        if not Messages:
+            return
+        response = execute_with_xray(self.name, self.client.delete_message_batch, QueueUrl=self.url, Entries=[
+            {'Id': str(i), 'ReceiptHandle': message['ReceiptHandle']} for i, message in enumerate(Messages)])
+        for entry in response.get('Failed') or []:
+            LogMessage(f"SQS {self.name}: message {entry.get('Id')} not deleted: {entry.get('Message')}")
+        LogMessage(f"SQS {self.name}: {len(Messages) - len(response.get('Failed') or [])} messages deleted")
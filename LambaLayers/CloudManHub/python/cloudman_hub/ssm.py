@@ -0,0 +1,134 @@
+# file: ssm.py
+import os
+import time
+import random
+import threading
+
+from .log import LogMessage
+from .clients import get_client
+
+SSMFlushInterval = float(os.getenv("SSM_FLUSH_INTERVAL", "5"))
+SSMFlushSize = int(os.getenv("SSM_FLUSH_SIZE", "100"))
+SSMMaxRetries = int(os.getenv("SSM_MAX_RETRIES", "5"))
+SSMBackoff = float(os.getenv("SSM_BACKOFF", "0.2"))
+ThrottlingErrors = ("ThrottlingException", "TooManyUpdates", "ThrottledException")
+
+_Counter = None
+_CounterLock = threading.Lock()
+
+
+def get_ssm_counter():
+    """Returns the process-wide counter aggregator; pending increments survive warm invocations."""
+    global _Counter
+    if _Counter is None:
+        with _CounterLock:
+            if _Counter is None:
+                _Counter = SSMCounter()
+    return _Counter
+
+
+def _error_code(e):
+    return getattr(e, 'response', {}).get('Error', {}).get('Code')
+
+
+def _as_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+class SSMCounter:
+    """
+    Accumulates the increments of SSM counter parameters in memory and writes each
+    parameter once per flush instead of a get/put per event.
+
+    A flush happens when a parameter has SSMFlushSize pending increments, when
+    SSMFlushInterval seconds passed since its last flush, or when flush() is called
+    (end of a batch, shutdown). SSM has no conditional put, so the write is checked
+    with the parameter version: when another writer got in between the read and the
+    write, the increment is applied again over the value that writer stored.
+    Throttled calls back off and retry; increments that still could not be written
+    stay pending for the next flush instead of being dropped.
+
+    Usage:
+        counter = get_ssm_counter()
+        counter.add(Name, Region, len(Messages))
+        counter.flush()
+    """
+
+    def __init__(self, flush_interval=None, flush_size=None):
+        self.flush_interval = SSMFlushInterval if flush_interval is None else flush_interval
+        self.flush_size = SSMFlushSize if flush_size is None else flush_size
+        self.pending = {}
+        self.last_flush = {}
+        self.lock = threading.Lock()
+        self.flush_locks = {}
+
+    def add(self, name, region, count=1):
+        """Adds count to the parameter and flushes it when a threshold is reached."""
+        key = (name, region)
+        with self.lock:
+            self.pending[key] = self.pending.get(key, 0) + count
+            self.last_flush.setdefault(key, time.time())
+            due = (self.pending[key] >= self.flush_size or
+                   time.time() - self.last_flush[key] >= self.flush_interval)
+        if due:
+            self._flush_key(key)
+
+    def flush(self, name=None, region=None):
+        """
+        Writes the pending increments of one parameter, or of every parameter when name is None.
+        :return: Dict {name: pending count} of the parameters that could not be written.
+        """
+        with self.lock:
+            keys = [key for key in self.pending if name is None or key == (name, region)]
+        failed = {}
+        for key in keys:
+            if not self._flush_key(key):
+                failed[key[0]] = self.pending.get(key, 0)
+        return failed
+
+    def _flush_key(self, key):
+        with self.lock:
+            flush_lock = self.flush_locks.setdefault(key, threading.Lock())
+        with flush_lock:
+            with self.lock:
+                delta = self.pending.pop(key, 0)
+                self.last_flush[key] = time.time()
+            if not delta:
+                return True
+            try:
+                self._apply(key[0], key[1], delta)
+                return True
+            except Exception as e:
+                LogMessage(f"SSM {key[0]}: {delta} increments kept for the next flush: {e}")
+                with self.lock:
+                    self.pending[key] = self.pending.get(key, 0) + delta
+                return False
+
+    def _call(self, function, **kwargs):
+        for attempt in range(SSMMaxRetries + 1):
+            try:
+                return function(**kwargs)
+            except Exception as e:
+                if _error_code(e) not in ThrottlingErrors or attempt == SSMMaxRetries:
+                    raise
+                time.sleep(SSMBackoff * (2 ** attempt) * (0.5 + random.random()))
+
+    def _apply(self, name, region, delta):
+        ssm_client = get_client('ssm', region)
+        Parameter = self._call(ssm_client.get_parameter, Name=name, WithDecryption=True)['Parameter']
+        version, value = Parameter['Version'], _as_int(Parameter['Value'])
+        for attempt in range(SSMMaxRetries + 1):
+            new_version = self._call(ssm_client.put_parameter, Name=name, Value=str(value + delta),
+                                     Type='String', Overwrite=True)['Version']
+            if new_version == version + 1:
+                LogMessage(f"SSM Parameter {name} updated: {value + delta} (+{delta})")
+                return
+            # Someone wrote between our read and our write: rebase on the value stored right before ours.
+            Previous = self._call(ssm_client.get_parameter, Name=f"{name}:{new_version - 1}",
+                                  WithDecryption=True)['Parameter']
+            version, value = new_version, _as_int(Previous['Value'])
+        # Our increment is stored; only a concurrent writer's increment may have been overwritten.
+        LogMessage(f"SSM Parameter {name}: version conflicts on every one of {SSMMaxRetries + 1} writes")
@@ -0,0 +1,29 @@
+# file: xray.py
+# X-Ray subsegments of the target calls. Each hub decides whether X-Ray is enabled (SDK
+# installed and XRAY_ENABLED) and hands its recorder over with set_recorder; the shared
+# modules then wrap the calls of every target in a subsegment named after the target.
+
+_Recorder = None
+
+
+def set_recorder(recorder):
+    """
+    :param recorder: aws_xray_sdk xray_recorder, or None when X-Ray is disabled.
+    """
+    global _Recorder
+    _Recorder = recorder
+
+
+def get_recorder():
+    return _Recorder
+
+
+def execute_with_xray(segment_name, function, *args, **kwargs):
+    """
+    Executes function(*args, **kwargs), inside a subsegment segment_name when X-Ray is enabled.
+    :return: Result of the executed function.
+    """
+    if _Recorder is None:
+        return function(*args, **kwargs)
+    with _Recorder.in_subsegment(segment_name):
+        return function(*args, **kwargs)
@@ -1,9 +1,12 @@
-import traceback
+# The cold-start timer is created before the other imports so their cost is part of the breakdown.
+from cloudman_hub.registry import ColdStartTimer, TargetRegistry
+ColdStart = ColdStartTimer()
+
 import boto3
 import os
 import json
 import datetime
-import http.client
+import time
 from urllib.parse import unquote
 
 try:
@@ -19,376 +22,208 @@ XRay = os.getenv('XRAY_ENABLED', "False")
 if XRay == "False":
     xray_enabled = False
 
-try:
-    import pymysql
-    from pymysql import MySQLError
-    MySQLEnabled = True
-except:
-    MySQLEnabled = False
-    print("Pymysql not found!")
-
-# Create clients to access AWS services
+# Shared hub code (cloudman_hub Lambda Layer)
+from cloudman_hub import get_client
+from cloudman_hub.rds import RDSSink, connect_database, mysql_enabled, DefaultCredentials
+from cloudman_hub.s3_source import read_s3_text
+from cloudman_hub.artifact import transform_artifact
+from cloudman_hub.envelope import forward
+from cloudman_hub.metrics import get_hop_metrics, flush_metrics
+from cloudman_hub.codebuild import BuildCoalescer, coalescing_enabled
+from cloudman_hub.hubconfig import targets
+from cloudman_hub.snapstart import before_snapshot, after_restore, prewarm, close_connections, restore
+from cloudman_hub.batch import batch_item_failures
+from cloudman_hub.sinks import build_sinks, dispatch, find_ec2_dns
+from cloudman_hub.xray import set_recorder, execute_with_xray
+
+# The target calls of the shared code are traced in subsegments when X-Ray is enabled.
+set_recorder(xray_recorder if xray_enabled else None)
+
+# AWS clients are taken from the shared pool (cloudman_hub.clients) when used, so a
+# SnapStart restore gets new ones.
 
 Region = os.getenv("REGION")
 AccountID = os.getenv("ACCOUNT")
-sqs = boto3.client('sqs', region_name=Region)
-dynamodb = boto3.resource('dynamodb', region_name=Region)
-lambda_client = boto3.client('lambda', region_name=Region)
-sns = boto3.client('sns', region_name=Region)
-s3 = boto3.client('s3')
+# "True" processes every record of SQS/SNS/S3 events; "False" only the first one.
+BatchMode = os.getenv("BATCH_MODE", "True")
 LambdaName = os.getenv("LAMBDA_NAME",'')
 if not LambdaName:
     LambdaName = os.getenv("NAME", '')
-
-# Assuming that xray_enabled is a previously defined boolean variable
-# and that you have already configured X-Ray (for example, with xray_recorder.configure(...))
-
-def execute_with_xray(segment_name, function, *args, **kwargs):
-    """
-    Executes a function. If the function is for SQS (send_message), it executes within an X-Ray subsegment;
-    for other services, it executes the function normally, as they already have X-Ray integration.
-
-    :param segment_name: Name of the subsegment (used only for SQS).
-    :param function: Function to be executed.
-    :param args: Positional arguments for the function.
-    :param kwargs: Keyword arguments for the function.
-    :return: Result of the executed function.
-    """
-    # If the function is SQS send_message, wrap it with a subsegment
-    if function.__name__ == 'send_message':
-        if xray_enabled:
-            with xray_recorder.in_subsegment(segment_name) as subsegment:
-                try:
-                    result = function(*args, **kwargs)
-                    # Add annotation with the queue URL, if available
-                    if "QueueUrl" in kwargs:
-                        subsegment.put_annotation(
-                            "QueueUrl", kwargs["QueueUrl"])
-                    return result
-                except Exception as e:
-                    subsegment.add_exception(e, traceback.format_exc())
-                    raise
-        else:
-            return function(*args, **kwargs)
-    else:
-        # For other services, simply execute the function normally
-        return function(*args, **kwargs)
-
+# DNS lookups, secrets and database connections are resolved on first use and cached here.
+Registry = TargetRegistry()
+ColdStart.mark("imports and clients")
 
 # *************************** Target Resources ***********************************
+# Targets come from the precompiled hub config (HUB_CONFIG_FILE) when it is shipped with
+# the function, else from the AWS_*_TARGET_*_{i} environment variables (see cloudman_hub.hubconfig).
 
-# **************** Identify the URL of each SQS Target ***************************
-SQSTargetMaxNumber = 0
-SQSTargetName = []
-QueueTargetUrl = []
-Name = ""
-i = 0
-while True:
-    Name = os.getenv(f"AWS_SQS_QUEUE_TARGET_NAME_{str(i)}")
-    Region = os.getenv(f"AWS_SQS_QUEUE_TARGET_REGION_{str(i)}")
-    URL = os.getenv(f"AWS_SQS_QUEUE_TARGET_URL_{str(i)}")
-    if Name != None:
-        SQSTargetName.append(Name)
-        QueueTargetUrl.append(URL)
-    else:
-        SQSTargetMaxNumber = i
-        break
-    i += 1
-print(f"Total SQS Targets: {i} {SQSTargetName}")
-
-# ********** Identify the ARN of each SNS Target **************************
-SNSTargetMaxNumber = 0
-SNSTargetName = []
-TopicTargetARN = []
-
-i = 0
-while True:
-    Name = os.getenv(f"AWS_SNS_TOPIC_TARGET_NAME_{str(i)}")
-    Region = os.getenv(f"AWS_SNS_TOPIC_TARGET_REGION_{str(i)}")
-    ARN = os.getenv(f"AWS_SNS_TOPIC_TARGET_ARN_{str(i)}")
-    if Name != None:
-        SNSTargetName.append(Name)
-        TopicTargetARN.append(ARN)
-    else:
-        SNSTargetMaxNumber = i
-        break
-    i += 1
-print(f"Total SNS Targets: {i} {SNSTargetName}")
-
-# ************** Initialize each DynamoDB table *********************************
-DynamoDBTargetMaxNumber = 0
-TableNameTargetList = []
-ListDynamo = []
-i = 0
-while True:
-    TableName = os.getenv(f"AWS_DYNAMODB_TABLE_TARGET_NAME_{str(i)}")
-    Region = os.getenv(f"AWS_DYNAMODB_TABLE_TARGET_REGION_{str(i)}")
-    Account = os.getenv(f"AWS_DYNAMODB_TABLE_TARGET_ACCOUNT_{str(i)}")
-    if TableName != None:
-        TableNameTargetList.append([dynamodb.Table(TableName), TableName])
-        ListDynamo.append(TableName)
-        Table = TableNameTargetList[i][0]
-        response = Table.get_item(Key={'ID': "1"})
-        if 'Item' not in response:
-            Table.put_item(
-                Item={'ID': "1", "LambdaName": "Created by " + LambdaName, 'Cont': 0})
-    else:
-        DynamoDBTargetMaxNumber = i
-        break
-    i += 1
-print(f"Total DynamoDB Targets: {i} {ListDynamo}")
-
-# ************* Initialize each Lambda to be invoked ***************************
-LambdaMaxNumber = 0
-LambdaNameList = []
-i = 0
-while True:
-    Name = os.getenv(f"AWS_LAMBDA_FUNCTION_TARGET_NAME_{str(i)}")
-    Region = os.getenv(f"AWS_LAMBDA_FUNCTION_TARGET_REGION_{str(i)}")
-    Account = os.getenv(f"AWS_LAMBDA_FUNCTION_TARGET_ACCOUNT_{str(i)}")
-    if Name != None:
-        LambdaNameList.append(Name)
-        LambdaMaxNumber = i
-    else:
-        break
-    i += 1
-print(f"Total Lambda Targets: {i} {LambdaNameList}")
-
-# ************* Initialize each CodeBuild target ***************************
-CodeBuildMaxNumber = 0
-CodeBuildNameList = []
-i = 0
-while True:
-    Name = os.getenv(f"AWS_CODEBUILD_PROJECT_TARGET_NAME_{str(i)}")
-    Region = os.getenv(f"AWS_CODEBUILD_PROJECT_TARGET_REGION_{str(i)}")
-    Account = os.getenv(f"AWS_CODEBUILD_PROJECT_TARGET_ACCOUNT_{str(i)}")
-    if Name is not None:
-        CodeBuildNameList.append(Name)
-        CodeBuildMaxNumber = i
-    else:
-        break
-    i += 1
-print(f"Total CodeBuild Targets: {i} {CodeBuildNameList}")
-
-# ********** Identify each S3 target **************************
-S3TargetMaxNumber = 0
-S3BucketTarget = []
-i = 0
-while True:
-    Name = os.getenv(f"AWS_S3_BUCKET_TARGET_NAME_{str(i)}")
-    Region = os.getenv(f"AWS_S3_BUCKET_TARGET_REGION_{str(i)}")
-    Account = os.getenv(f"AWS_S3_BUCKET_TARGET_ACCOUNT_{str(i)}")
-    if Name is not None:
-        S3BucketTarget.append([Name, Region])
-    else:
-        S3TargetMaxNumber = i
-        break
-    i += 1
-print(f"Total S3 Targets: {i} ")
-
-# ********** Identify EC2 targets **************************
-EC2TargetDNS = []
-EC2TargetName = []
-i = 0
-while True:
-    Name = os.getenv(f"AWS_INSTANCE_TARGET_NAME_{str(i)}")
-    Region = os.getenv(f"AWS_INSTANCE_TARGET_REGION_{str(i)}")
-    if Name is not None:
-        public_dns, private_dns = find_ec2_dns_by_tag('Name', Name, Region)
-        EC2TargetName.append(Name)
-        if public_dns is not None:
-            EC2TargetDNS.append(public_dns)
-            print("Found public DNS")
-        else:
-            EC2TargetDNS.append(private_dns)
-            print("Found private DNS")
-    else:
-        break
-    i += 1
-print(f"Total EC2 Targets: {i} {EC2TargetName}")
-
-# ************** Initialize EFS *********************************
-EFSList = []
-EFSNameList = []
-i = 0
-while True:
-    Name = os.getenv(f"AWS_EFS_FILE_SYSTEM_TARGET_NAME_{str(i)}")
-    if Name is not None:
-        Path = os.getenv(f"AWS_EFS_ACCESS_POINT_TARGET_PATH_{str(i)}")
-        EFSList.append(Path)
-        EFSNameList.append(Name)
-    else:
-        EFSMaxNumber = i
-        break
-    i += 1
-print(f"Total EFS Targets: {i} {EFSNameList}")
-
-# ************** Initialize SSM Parameter *********************************
-SSMParameterTargetName = []
-SSMParameterTargetRegion = []
-i = 0
-while True:
-    Name = os.getenv(f"AWS_SSM_PARAMETER_TARGET_NAME_{str(i)}")
-    Region = os.getenv(f"AWS_SSM_PARAMETER_TARGET_REGION_{str(i)}")
-
-    if Name is not None and Region is not None:
-        SSMParameterTargetName.append(Name)
-        SSMParameterTargetRegion.append(Region)
-    else:
-        SSMParameterMaxNumber = i
-        break
-    i += 1
-print(f"Total SSM Parameters: {i} {SSMParameterTargetName}")
+# Each target is a sink of cloudman_hub.sinks, created below once per execution environment.
+# With CODEBUILD_COALESCE_WINDOW > 0 the triggers of a window start a single build.
+Coalescer = None
+if targets("CodeBuildTarget") and coalescing_enabled():
+    Coalescer = BuildCoalescer(Region)
 
 # *************************** Source Resources ***********************************
 
 # ***************** Identify the URL of each SQS Source *************************
-SQSSourceMaxNumber = 4
-SQSSourceName = []
-i = 0
-while True:
-    Name = os.getenv(f"AWS_SQS_QUEUE_SOURCE_NAME_{str(i)}")
-    if Name is not None:
-        SQSSourceName.append(Name)
-    else:
-        SQSSourceMaxNumber = i
-        break
-    i += 1
-print(f"Total SQS Sources: {i} {SQSSourceName}")
+SQSSourceName = [Target["Name"] for Target in targets("SQSSource")]
+SQSSourceMaxNumber = len(SQSSourceName)
+print(f"Total SQS Sources: {SQSSourceMaxNumber} {SQSSourceName}")
 
 # ********** Identify the ARN of each SNS Source **************************
-SNSSourceMaxNumber = 4
-SNSSourceName = []
-i = 0
-while True:
-    Name = os.getenv(f"AWS_SNS_TOPIC_SOURCE_NAME_{str(i)}")
-    Region = os.getenv(f"AWS_SNS_TOPIC_SOURCE_REGION_{str(i)}")
-    Account = os.getenv(f"AWS_SNS_TOPIC_SOURCE_ACCOUNT_{str(i)}")
-    if Name is not None:
-        SNSTargetName.append(Name)
-    else:
-        SNSSourceMaxNumber = i
-        break
-    i += 1
-print(f"Total SNS Sources: {i} {SNSSourceName}")
+SNSSourceName = [Target["Name"] for Target in targets("SNSSource")]
+SNSSourceMaxNumber = len(SNSSourceName)
+print(f"Total SNS Sources: {SNSSourceMaxNumber} {SNSSourceName}")
 
 # ********** Identify each S3 Source **************************
-S3SourceMaxNumber = 4
-S3BucketSourceName = []
-i = 0
-while True:
-    Name = os.getenv(f"AWS_S3_BUCKET_SOURCE_NAME_{str(i)}")
-    if Name is not None:
-        S3BucketSourceName.append(Name)
-    else:
-        S3SourceMaxNumber = i
-        break
-    i += 1
-print(f"Total S3 Notification Sources: {i} {S3BucketSourceName}")
-
-# ********* List to store username and password information for each secret
-SecretsCredentials = []
-SecretNameList = []
-i = 0
-while True:
-    SecretName = os.getenv(
-        f"AWS_SECRETSMANAGER_SECRET_VERSION_SOURCE_NAME_{i}")
-    SecretARN = os.getenv(f"AWS_SECRETSMANAGER_SECRET_VERSION_SOURCE_ARN_{i}")
-    if SecretName is not None:
-        client = boto3.client('secretsmanager', region_name=Region)
+S3BucketSourceName = [Target["Name"] for Target in targets("S3Source")]
+S3SourceMaxNumber = len(S3BucketSourceName)
+print(f"Total S3 Notification Sources: {S3SourceMaxNumber} {S3BucketSourceName}")
+
+# ********* List of the secrets; username and password are read on first use (see get_credentials)
+SecretTargets = [[Target["Name"], Target["ARN"], Region] for Target in targets("SecretSource")]
+SecretNameList = [Target[0] for Target in SecretTargets]
+print(f"Total Secret Sources: {len(SecretTargets)} {SecretNameList}")
+
+
+def ec2_target_dns(Name, Region):
+    """
+    Returns the DNS of an EC2 target, calling describe_instances only on first use
+    and again when the cached value expires (the DNS changes when the instance restarts).
+    The DNS resolved when the hub config was generated avoids the first describe_instances.
+    """
+    return Registry.get(("ec2", Name), lambda: find_ec2_dns(Name, Region))
+
+
+def get_credentials(database):
+    """
+    Returns (username, password) for a database: the secret whose name contains the
+    database name, else the first secret. The secret value is cached with the registry TTL.
+    """
+    if not SecretTargets:
+        return DefaultCredentials
+    Target = SecretTargets[0]
+    for SecretTarget in SecretTargets:
+        if database in SecretTarget[0]:
+            Target = SecretTarget
+            break
+    SecretName, SecretARN, SecretRegion = Target
+
+    def resolve():
+        client = get_client('secretsmanager', SecretRegion)
         response = client.get_secret_value(SecretId=SecretARN)
         secret = json.loads(response['SecretString'])
-        username = secret['username']
-        password = secret['password']
-        SecretsCredentials.append([SecretName, username, password])
-        SecretNameList.append(SecretName)
-    else:
-        break
-    i += 1
-print(f"Total Secret Sources: {i} {SecretNameList}")
-
-
-def create_connection(host_name, user_name, user_password, db_name):
-    connection = None
-    try:
-        connection = pymysql.connect(
-            host=host_name,
-            user=user_name,
-            password=user_password,
-            database=db_name,
-            charset='utf8mb4',
-            cursorclass=pymysql.cursors.DictCursor
-        )
-        print("Connection to MySQL DB successful")
-    except MySQLError as e:
-        print(f"The error '{e}' occurred")
-    return connection
-
-
-def execute_query(connection, query, values=None):
-    with connection.cursor() as cursor:
-        try:
-            if values:
-                cursor.execute(query, values)
-            else:
-                cursor.execute(query)
-            connection.commit()
-            print("Query executed successfully")
-        except MySQLError as e:
-            print(f"The error '{e}' occurred")
-
-
-# ******************* Initialize list to store RDS connections and create table. *******************
-RDSConnections = []
-i = 0
-if MySQLEnabled:
-    while True:
-        database = os.getenv(f"AWS_DB_INSTANCE_TARGET_NAME_{i}")
-        if database is not None:
-            EndPoint = os.getenv(f"AWS_DB_INSTANCE_TARGET_ENDPOINT_{i}")
-            Host = EndPoint.split(":")[0]
-            FoundSecret = False
-            if len(SecretsCredentials) > 0:
-                for j in range(len(SecretsCredentials)):
-                    if database in SecretsCredentials[j][0]:
-                        username = SecretsCredentials[j][1]
-                        password = SecretsCredentials[j][2]
-                        FoundSecret = True
-                        break
-                if not FoundSecret:
-                    username = SecretsCredentials[0][1]
-                    password = SecretsCredentials[0][2]
-            else:
-                username = "TypeNewUserName"
-                password = "TypeNewPassword"
-            print(
-                f"Database and endpoint {i} : {database}, {Host}, {username}")
-            # Establish the connection and create the table
-            connection = create_connection(Host, username, password, database)
-            if connection is not None:
-                RDSConnections.append([connection, database])
-                create_table_query = """
-                    CREATE TABLE IF NOT EXISTS exemplo (
-                        id INT AUTO_INCREMENT, 
-                        texto VARCHAR(4000) NOT NULL, 
-                        PRIMARY KEY (id)
-                    )
-                """
-                execute_query(connection, create_table_query)
-                print(f"Checkpoint A passed")
-        else:
-            print(f"Total RDS Targets: {i}")
-            break
-        i += 1
+        return secret['username'], secret['password']
+    return Registry.get(("secret", SecretName), resolve)
+
+
+def get_rds_sink(database, Host):
+    """
+    Returns the RDS sink of a database, created on first use and kept for the lifetime of
+    the execution environment. The sink opens (and reopens) the connection and the table
+    is created on each new connection.
+    """
+    def connect():
+        username, password = get_credentials(database)
+        print(f"Database and endpoint: {database}, {Host}")
+        # Establish the connection and create the table
+        return connect_database(Host, username, password, database)
+    return Registry.get(("rds", database), lambda: RDSSink(connect, database), ttl=0)
+
+
+# ******************* Sinks of every target (connections are opened on first use). *******************
+# DynamoDB rows expire after 1 day.
+Sinks = build_sinks(LambdaName, Region, AccountID, dynamodb_ttl_days=1,
+                    owner_attribute="LambdaName", rds_sink=get_rds_sink if mysql_enabled() else None,
+                    ec2_dns=ec2_target_dns, coalescer=Coalescer)
+ColdStart.mark("targets")
+
+
+# ******************* SnapStart (AWS_LAMBDA_INITIALIZATION_TYPE=snap-start) *******************
+@before_snapshot
+def prepare_snapshot():
+    # The clients of every target and their service models go into the snapshot; connections do not.
+    prewarm([('codebuild', None), ('codepipeline', None)]
+            + [('s3', Target["Region"]) for Target in targets("S3Target")]
+            + [('ec2', Target["Region"]) for Target in targets("EC2Target")]
+            + [('ssm', Target["Region"]) for Target in targets("SSMParameterTarget")]
+            + [('secretsmanager', SecretRegion) for SecretName, SecretARN, SecretRegion in SecretTargets])
+    close_connections(Registry)
+
+
+@after_restore
+def refresh_after_restore():
+    # Secrets, EC2 DNS and RDS connections are resolved again on first use after each restore.
+    restore(Registry)
+
+
+ColdStart.report()
 
 # ******************************************************************************
 
 
+def read_record(record):
+    """
+    Extracts the message of one record of an SNS, SQS or S3 event.
+
+    :param record: Item of event['Records'].
+    :return: Tuple (EventSource, Message, Information) of the record.
+    """
+    EventSource = record.get('eventSource') or record.get('EventSource')
+    Message = ""
+    Information = ""
+    if EventSource == "aws:sns":
+        SNSName = record['Sns']['TopicArn'].split(":")[-1]
+        EventSource += SNSName
+        Message = record['Sns']['Message']
+        Information = "Message from SNS " + SNSName
+    elif EventSource == "aws:sqs":
+        SQSName = record['eventSourceARN'].split(":")[-1]
+        Message = record['body']
+        Information = "Message from SQS " + SQSName
+    elif EventSource == "aws:s3":
+        EventSource += record['s3']["bucket"]['arn'].split(":")[-1]
+        FileSize = str(record['s3']['object']["size"])
+        bucket_name = record['s3']['bucket']["name"]
+        file_path_encoded = record['s3']['object']["key"]
+        # Decode the file name
+        file_path = unquote(file_path_encoded).replace('+', ' ')
+        Ext = file_path.split(".")[-1]
+        print("bucket_name", bucket_name, file_path)
+        # Read the file content (streamed; large files are forwarded by reference)
+        Inline = True
+        if Ext == "txt" or file_path.endswith(".txt.gz"):
+            Message, Inline = execute_with_xray(
+                bucket_name, read_s3_text, get_client('s3'), bucket_name, file_path,
+                size=record['s3']['object'].get("size"),
+                etag=record['s3']['object'].get("eTag"))
+        else:
+            Message = "File is not .txt"
+        Information = "File " + file_path + " from S3 bucket " + \
+            bucket_name + ", with size of " + FileSize
+        if not Inline:
+            Information += ", forwarded by reference"
+    return EventSource, Message, Information
+
+
 def lambda_handler(event, context):
+    # Receive time of the event, stamped into each forwarded hop for the latency metrics.
+    Received = time.time()
     print("event", event)
     # print("context", context)
+    # A window led by this invocation is closed and built before the Lambda timeout.
+    if Coalescer is not None and context is not None:
+        Coalescer.set_deadline(Received + context.get_remaining_time_in_millis() / 1000)
+    # Scheduled EventBridge rule with the constant input {"CoalesceSweep": true}: builds the
+    # coalescing windows whose leader failed; nothing is forwarded.
+    if isinstance(event, dict) and event.get("CoalesceSweep"):
+        Built = Coalescer.sweep([Target["Name"] for Target in targets("CodeBuildTarget")]) if Coalescer else 0
+        print("Coalescing windows recovered:", Built)
+        return {"Recovered": Built}
+    Records = event.get('Records') or []
     try:
-        EventSource = event['Records'][0]['source']
+        EventSource = Records[0].get('eventSource') or Records[0].get(
+            'EventSource') or Records[0]['source']
     except Exception as e:
         EventSource = "API"
     if 'CodePipeline.job' in event:
@@ -397,16 +232,15 @@ def lambda_handler(event, context):
         EventSource = event['source']
     Subject = "None"
     Message = ""
-    if EventSource == "aws:sns":
-        SNSName = event['Records'][0]['Sns']['TopicArn'].split(":")[-1]
-        EventSource += SNSName
-        Subject = event['Records'][0]['Sns']['Subject']
-        Message = event['Records'][0]['Sns']['Message']
-        Information = "Message from SNS " + SNSName
-    elif EventSource == "aws:sqs":
-        SQSName = event['Records'][0]['eventSourceARN'].split(":")[-1]
-        Message = event['Records'][0]['body']
-        Information = "Message from SQS " + SQSName
+    # Inputs holds one (EventSource, Message, Information, RecordID) entry per message to be processed.
+    Inputs = []
+    if EventSource in ("aws:sns", "aws:sqs", "aws:s3"):
+        # In batch mode every record is processed; otherwise only the first one.
+        if BatchMode != "True":
+            Records = Records[:1]
+        for record in Records:
+            Inputs.append(read_record(record) + (record.get('messageId'),))
+        EventSource = Inputs[0][0] if len(Inputs) == 1 else EventSource
     elif EventSource == "aws.events":
         EBName = event['resources'][0].split("/")[-1]
         Message = f"Event from {EBName}"
@@ -416,26 +250,6 @@ def lambda_handler(event, context):
         Information = "Event from Lambda"
         Message = event["message"]
         print("Message", Message)
-    elif EventSource == "aws:s3":
-        s3 = boto3.client('s3')
-        EventSource += event['Records'][0]['s3']["bucket"]['arn'].split(":")[-1]
-        FileSize = str(event['Records'][0]['s3']['object']["size"])
-        bucket_name = event['Records'][0]['s3']['bucket']["name"]
-        file_path_encoded = event['Records'][0]['s3']['object']["key"]
-        # Decode the file name
-        file_path = unquote(file_path_encoded).replace('+', ' ')
-        Ext = file_path.split(".")[-1]
-        print("bucket_name", bucket_name, file_path)
-        # Read the file content
-        if Ext == "txt":
-            response = execute_with_xray(
-                bucket_name, s3.get_object, Bucket=bucket_name, Key=file_path)
-            Message = response['Body'].read().decode('utf-8')
-            # print("File Content: ",file_content)
-        else:
-            Message = "File is not .txt"
-        Information = "File " + file_path + " from S3 bucket " + \
-            bucket_name + ", with size of " + FileSize
     elif 'requestContext' in event and 'elb' in event['requestContext']:
         EventSource = "aws:elb"
         ALBName = event['requestContext']['elb']['targetGroupArn'].split(":")[-1]
@@ -454,136 +268,51 @@ def lambda_handler(event, context):
         Subject = "None"
         try:
             Source = event["source"]
-            Message = str(event["message"])
+            Message = event["message"]
         except:
             Source = "API"
-            Message = str(event)
+            Message = event
         else:
             Information = "Event from API"
-
-    print("Source of Event: ", EventSource)
-    if LambdaName in Message:
-        print("Loop Found!")
+    if not Inputs:
+        Inputs.append((EventSource, Message, "", None))
+
+    print("Source of Event: ", EventSource, "Records:", len(Inputs))
+    # Messages holds one (RecordID, NewMessage, Stamp) entry per message to be forwarded.
+    Messages = []
+    for n, (RecordSource, Message, Information, RecordID) in enumerate(Inputs):
+        # The payload travels unchanged in the envelope; this hub only appends itself to the hop list.
+        Envelope, NewMessage = forward(Message, LambdaName, received=Received)
+        if NewMessage is None:
+            print("Loop Found!", RecordID, Envelope.get("Hops"))
+            continue
+        get_hop_metrics().record(Envelope)
+        Agora = datetime.datetime.now()
+        # Stamp makes the DynamoDB IDs and file names unique inside a batch.
+        Stamp = str(Agora) if len(Inputs) == 1 else f"{Agora}-{n}"
+        print("Message to be sent: ", NewMessage)
+        Messages.append((RecordID, NewMessage, Stamp))
+    if not Messages:
         return
-    Agora = datetime.datetime.now()
-    NewMessage = f"Lambda: {LambdaName}. Source: {EventSource}. Date/Time: {str(Agora)}. <- {Message}"
-    print("Message to be sent: ", NewMessage)
-
-    # ************************* SQS Block **************************************
-    # Define the queue name for sending the message
-    for i in range(SQSTargetMaxNumber):
-        message_body = NewMessage
-        print("Sending message to queue:",
-              SQSTargetName[i], "with QueueUrl:", QueueTargetUrl[i])
-        response = execute_with_xray(
-            # Subsegment name (can be the queue name)
-            SQSTargetName[i],
-            # Function to be executed (sending the message)
-            sqs.send_message,
-            QueueUrl=QueueTargetUrl[i],  # Named parameter for the queue URL
-            MessageBody=message_body    # Message body
-        )
-        print('SQS message ' + str(i) +
-              ' sent with ID:', response['MessageId'])
-    # ************************* DynamoDB Block **********************************
-    for i in range(DynamoDBTargetMaxNumber):
-        Table = TableNameTargetList[i][0]
-        TableName = TableNameTargetList[i][1]
-        get_item_response = execute_with_xray(
-            TableName, Table.get_item, Key={'ID': "1"})
-        item = get_item_response['Item']
-        cont = item['Cont'] + 1
-        execute_with_xray(TableName, Table.update_item, Key={'ID': "1"},
-                          UpdateExpression='SET Cont = :val1', ExpressionAttributeValues={':val1': cont})
-        ttl_timestamp = int((datetime.datetime.now() + datetime.timedelta(days=1)).timestamp())
-        ID = LambdaName + ":" + str(Agora)
-        put_item_response = execute_with_xray(TableName, Table.put_item, Item={'ID': ID,"Message": NewMessage,'TTL': ttl_timestamp})
-        print("DynamoDB response", put_item_response)
-
-    # ************************* SNS Block **********************************
-    for i in range(SNSTargetMaxNumber):
-        topic_arn = TopicTargetARN[i]
-        message = NewMessage
-        response = execute_with_xray(topic_arn, sns.publish, TopicArn=topic_arn,
-                                     Message=json.dumps({'default': json.dumps(message)}), MessageStructure='json')
-        print("SNS response", response)
-
-    # ************************* Lambda Block ********************
-    lambda_client = boto3.client('lambda')
-    for function_name in LambdaNameList:
-        response = execute_with_xray(function_name, lambda_client.invoke, FunctionName=function_name,
-                                     InvocationType='Event', Payload=json.dumps({"message": NewMessage, "source": "aws:lambda"}))
-        if response.get('StatusCode') == 202:
-            print(f"Invoked lambda: {function_name}")
-        else:
-            print(f"Invocation error for {function_name}.")
-    # ************************* S3 Block **********************************
-    for i in range(S3TargetMaxNumber):
-        bucket_name = S3BucketTarget[i][0]
-        S3Region = S3BucketTarget[i][1]
-        s3 = boto3.client('s3', region_name=S3Region)
-        folder_name = LambdaName + "/"
-        file_name = LambdaName + ":" + str(Agora) + ".txt"
-        file_content = NewMessage
-        file_path = folder_name + file_name
-        response = execute_with_xray(
-            bucket_name, s3.put_object, Bucket=bucket_name, Key=file_path, Body=file_content)
-        print(f"Object inserted in bucket '{bucket_name}'")
-
-    # ************************* EFS Block **********************************
-    for efs_mount_path in EFSList:
-        # Write a test file to EFS
-        file_name = LambdaName + ":" + str(Agora) + ".txt"
-        test_file_path = os.path.join(efs_mount_path, file_name)
-        with open(test_file_path, "w") as file:
-            file.write(NewMessage)
-
-    for connection, db_name in RDSConnections:
-        insert_query = "INSERT INTO exemplo (texto) VALUES (%s)"
-        try:
-            Data = json.dumps(NewMessage)
-            execute_query(connection, insert_query, (Data,))
-            print(
-                f"Item inserted into table 'exemplo' of database '{db_name}'")
-        except MySQLError as e:
-            print(f"Error inserting item into database '{db_name}': {e}")
-
-    # ************************* SSM Parameter Block **********************************
-    for Name, region in zip(SSMParameterTargetName, SSMParameterTargetRegion):
-        ssm_client = boto3.client('ssm', region_name=region)
-        try:
-            response = execute_with_xray(
-                Name, ssm_client.get_parameter, Name=Name, WithDecryption=True)
-            current_value = response['Parameter']['Value']
-            try:
-                int_value = int(current_value)
-                new_value = str(int_value + 1)
-            except ValueError:
-                new_value = '0'
-            execute_with_xray(Name, ssm_client.put_parameter, Name=Name,
-                              Value=new_value, Type='String', Overwrite=True)
-            print(f"SSM Parameter {Name} updated: {new_value}")
-        except Exception as e:
-            print(f"Error processing parameter {Name} in region {region}: {e}")
-
-    # ************************* EC2 Block **********************************
-    MessageJSON = json.dumps(NewMessage).encode('utf-8')
-    for DNS, EC2Name in zip(EC2TargetDNS, EC2TargetName):
-        try:
-            Path = f'/{EC2Name}'
-            Conn = http.client.HTTPConnection(DNS)
-            Headers = {'Content-type': 'application/json'}
-            Response = execute_with_xray(
-                EC2Name, Conn.request, "POST", Path, body=MessageJSON, headers=Headers)
-            Response = Conn.getresponse()
-            if Response.status == 200:
-                print(f'Message sent with success to {EC2Name}.')
-            else:
-                print(
-                    f'Error sending message to {EC2Name}. Code: {Response.status}')
-            Conn.close()
-        except Exception as e:
-            print(f'Error sending message {EC2Name}: {str(e)}')
+
+    # Every target is dispatched concurrently (see cloudman_hub.sinks); each sink returns the RecordID
+    # of the messages it failed to deliver and the per-target status and timing are aggregated in FanOutResult.
+    # ALB, API and CodePipeline events return their own response and never started builds.
+    TargetSinks = Sinks
+    if EventSource in ("aws:elb", "API", "aws:codepipeline"):
+        TargetSinks = [sink for sink in Sinks if sink.kind != "CodeBuild"]
+    FanOutResult, failed = dispatch(TargetSinks, Messages, LambdaName)
+    print("Fan-out result: ", json.dumps(FanOutResult))
+    # Duration, bytes and outcome of every target were recorded by dispatch; written with the hop latencies.
+    flush_metrics()
+    NewMessage = Messages[-1][1]
+
+    # ************************* SQS Partial Batch Response **********************************
+    # Only the failed records are redelivered (requires ReportBatchItemFailures on the trigger).
+    if EventSource.startswith("aws:sqs"):
+        if failed:
+            print("Records to be redelivered: ", failed)
+        return batch_item_failures(failed)
 
     # ************************* ALB Response **********************************
     if EventSource == "aws:elb":
@@ -626,29 +355,21 @@ def lambda_handler(event, context):
             bucket = artifact_location['bucketName']
             key = artifact_location['objectKey']
 
-            # Check if the file is a text file
-            if key.endswith(".txt"):
-                # Read the file content
-                response = s3.get_object(Bucket=bucket, Key=key)
-                file_content = response['Body'].read().decode('utf-8')
-                print(f"File content from {key}: {file_content}")
-
-                # Convert the file content to uppercase
-                upper_case_content = file_content.upper()
-
-                # Save the modified file back to the S3 bucket with the name of the first output artifact
-                if output_artifacts:
-                    output = output_artifacts[0]
-                    output_location = output['location']['s3Location']
-                    output_bucket = output_location['bucketName']
-                    output_key = output_location['objectKey']
-
-                    # Save the modified file back to the S3 bucket with the output artifact name
-                    s3.put_object(Bucket=output_bucket, Key=output_key,
-                                  Body=upper_case_content.encode('utf-8'))
-                    print(f"Modified file saved to {output_key}")
+            # Upper-case the artifact into the first output artifact, streaming it in chunks
+            # (zip artifacts entry by entry) and writing it with multipart upload
+            if output_artifacts:
+                output = output_artifacts[0]
+                output_location = output['location']['s3Location']
+                output_bucket = output_location['bucketName']
+                output_key = output_location['objectKey']
+                Kind = transform_artifact(
+                    get_client('s3'), bucket, key, output_bucket, output_key, str.upper)
+                if Kind:
+                    print(f"Modified {Kind} artifact saved to {output_key}")
+                else:
+                    print(f"Artifact {key} is not a zip or text file, not transformed")
         # Send success result to CodePipeline
-        codepipeline = boto3.client('codepipeline')
+        codepipeline = get_client('codepipeline')
         codepipeline.put_job_success_result(jobId=job_id)
         return {
             'statusCode': 200,
@@ -657,9 +378,4 @@ def lambda_handler(event, context):
             })
         }
 
-    # ************************* CodeBuild Block ********************
-    codebuild = boto3.client('codebuild')
-    environment_variables = [
-        {'name': 'EVENT', 'value': NewMessage, 'type': 'PLAINTEXT'}]
-    for CodeBuildName in CodeBuildNameList:
-        response = execute_with_xray(CodeBuildName, codebuild.start_build, projectName=CodeBuildName,environmentVariablesOverride=environment_variables)
+    return FanOutResult
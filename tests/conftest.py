@@ -0,0 +1,8 @@
+# file: conftest.py
+# Tests of the shared hub package (LambaLayers/CloudManHub/python/cloudman_hub). The AWS
+# clients are replaced with in-test stubs (monkeypatched get_client/get_resource of the
+# module under test); boto3 must be installed only because clients.py imports it.
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "LambaLayers", "CloudManHub", "python"))
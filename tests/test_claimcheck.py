@@ -0,0 +1,105 @@
+import io
+import json
+
+import pytest
+
+from cloudman_hub import claimcheck
+from cloudman_hub.batch import materialize_each
+from cloudman_hub.envelope import forward, payload, materialize
+
+
+class NotFound(Exception):
+    response = {'Error': {'Code': "404"}}
+
+
+class StubS3:
+    def __init__(self):
+        self.objects = {}
+        self.puts = 0
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise NotFound()
+        return {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+        self.puts += 1
+
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    stub = StubS3()
+    monkeypatch.setattr(claimcheck, "get_client", lambda service, region=None: stub)
+    monkeypatch.setattr(claimcheck, "ClaimCheckBucket", "staging")
+    monkeypatch.setattr(claimcheck, "ClaimCheckThreshold", 1024)
+    monkeypatch.setattr(claimcheck, "ClaimCheckCodec", "gzip")
+    claimcheck._Stored.clear()
+    claimcheck._Cache.clear()
+    yield stub
+    claimcheck._Stored.clear()
+    claimcheck._Cache.clear()
+
+
+Large = {"rows": ["row %d" % i for i in range(1000)]}
+
+
+def test_offload_and_rehydrate_round_trip(s3):
+    Pointer = claimcheck.offload(Large)
+    assert claimcheck.is_claim_check(Pointer)
+    assert (Pointer["ClaimCheck"]["Bucket"], Pointer["ClaimCheck"]["Key"]) in s3.objects
+    claimcheck._Cache.clear()
+    assert claimcheck.rehydrate(Pointer) == Large
+
+
+def test_offload_stores_each_payload_once(s3):
+    claimcheck.offload(Large)
+    claimcheck._Stored.clear()
+    claimcheck.offload(Large)
+    assert s3.puts == 1
+
+
+def test_rehydrate_checks_the_checksum(s3):
+    Pointer = claimcheck.offload(Large)
+    Key = (Pointer["ClaimCheck"]["Bucket"], Pointer["ClaimCheck"]["Key"])
+    s3.objects[Key] = claimcheck.compress(b'{"rows": []}', "gzip")
+    with pytest.raises(ValueError):
+        claimcheck.rehydrate(Pointer)
+
+
+def test_forward_offloads_large_payloads(s3):
+    Envelope, Encoded = forward(Large, "HubA")
+    assert claimcheck.is_claim_check(json.loads(Encoded)["Payload"])
+    assert len(Encoded) < 1024
+    # The next hub forwards the pointer as is and reads the document only when needed.
+    Envelope, Encoded = forward(Encoded, "HubB")
+    assert claimcheck.is_claim_check(Envelope["Payload"])
+    assert s3.puts == 1
+    assert payload(Envelope) == Large
+
+
+def test_small_payloads_are_not_offloaded(s3):
+    Envelope, Encoded = forward("small", "HubA")
+    assert json.loads(Encoded)["Payload"] == "small"
+    assert s3.puts == 0
+
+
+def test_materialize_replaces_the_pointer(s3):
+    Envelope, Encoded = forward(Large, "HubA")
+    assert json.loads(materialize(Encoded))["Payload"] == Large
+    assert materialize(Encoded, max_bytes=1024) == Encoded
+    assert materialize("plain text") == "plain text"
+
+
+def test_materialize_each_fails_only_unreadable_documents(s3):
+    Envelope, Readable = forward(Large, "HubA")
+    Envelope, Lost = forward(dict(Large, lost=True), "HubA")
+    del s3.objects[(Envelope["Payload"]["ClaimCheck"]["Bucket"], Envelope["Payload"]["ClaimCheck"]["Key"])]
+    Stored, unread = materialize_each([("a", Readable, "1"), ("b", Lost, "2"), ("c", "plain", "3")])
+    assert unread == ["b"]
+    assert [message[0] for message in Stored] == ["a", "c"]
+    assert json.loads(Stored[0][1])["Payload"] == Large
+    assert Stored[1] == ("c", "plain", "3")
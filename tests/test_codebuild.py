@@ -0,0 +1,154 @@
+import io
+import json
+import time
+import threading
+
+import pytest
+
+from cloudman_hub import codebuild
+
+
+class ConditionalCheckFailed(Exception):
+    pass
+
+
+class StubTable:
+    """The update expressions of BuildCoalescer on an in-memory table."""
+
+    class meta:
+        class client:
+            class exceptions:
+                ConditionalCheckFailedException = ConditionalCheckFailed
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def get_item(self, Key):
+        item = self.items.get(Key['ID'])
+        return {'Item': dict(item)} if item is not None else {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, ConditionExpression=None,
+                    ExpressionAttributeNames=None, ReturnValues=None):
+        Values = ExpressionAttributeValues
+        with self.lock:
+            item = self.items.setdefault(Key['ID'], {})
+            if ConditionExpression == 'attribute_not_exists(Closed)' and 'Closed' in item:
+                raise ConditionalCheckFailed()
+            if ConditionExpression and 'ClaimedAt' in ConditionExpression:
+                if 'Members' not in item or 'BuildId' in item or \
+                        ('ClaimedAt' in item and not item['ClaimedAt'] < Values[':stale']):
+                    raise ConditionalCheckFailed()
+            if UpdateExpression.startswith('ADD Members'):
+                item['Members'] = item.get('Members', 0) + 1
+            elif UpdateExpression.startswith('SET Closed'):
+                item.update(Closed=True, ClaimedAt=Values[':now'])
+            elif UpdateExpression.startswith('ADD Pending'):
+                item['Pending'] = item.get('Pending', set()) | Values[':window']
+            elif UpdateExpression.startswith('DELETE Pending'):
+                item['Pending'] = item.get('Pending', set()) - Values[':window']
+            elif UpdateExpression.startswith('SET BuildId'):
+                item['BuildId'] = Values[':build']
+            return {'Attributes': dict(item)}
+
+
+class StubS3:
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body
+
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+    def get_paginator(self, name):
+        objects = self.objects
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                return [{'Contents': [{'Key': key} for key in list(objects) if key.startswith(Prefix)]}]
+        return Paginator()
+
+    def delete_objects(self, Bucket, Delete):
+        for entry in Delete['Objects']:
+            self.objects.pop(entry['Key'], None)
+
+
+class StubCodeBuild:
+    def __init__(self):
+        self.artifacts = []
+
+    def start_build(self, projectName, environmentVariablesOverride):
+        self.artifacts.append(environmentVariablesOverride[0]['value'])
+        return {'build': {'id': f"{projectName}:{len(self.artifacts)}"}}
+
+
+class StubAWS:
+    def __init__(self):
+        self.table = StubTable()
+        self.s3 = StubS3()
+        self.codebuild = StubCodeBuild()
+
+    def get_client(self, service, region=None):
+        return {'s3': self.s3, 'codebuild': self.codebuild}[service]
+
+    def get_resource(self, service, region=None):
+        return self
+
+    def Table(self, name):
+        return self.table
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    monkeypatch.setattr(codebuild, "CoalesceGrace", 0.05)
+    monkeypatch.setattr(codebuild, "CoalesceMargin", 0)
+    monkeypatch.setattr(codebuild, "CoalesceClaimTimeout", 0)
+    stubs = StubAWS()
+    monkeypatch.setattr(codebuild, "get_client", stubs.get_client)
+    monkeypatch.setattr(codebuild, "get_resource", stubs.get_resource)
+    return stubs
+
+
+def start_of_window(window):
+    """Waits for the next window, so the triggers of a test fall in the same one."""
+    time.sleep(window - time.time() % window)
+
+
+def built_messages(aws):
+    return [json.loads(aws.s3.objects[location.split("/", 3)[3]])["Messages"]
+            for location in aws.codebuild.artifacts]
+
+
+def test_one_build_per_window(aws):
+    coalescer = codebuild.BuildCoalescer(window=0.3, table_name="t", bucket="b", prefix="p")
+    results = []
+    start_of_window(0.3)
+    threads = [threading.Thread(target=lambda n=n: results.append(coalescer.trigger("proj", [f"m{n}"])))
+               for n in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(result["Leader"] for result in results) == 1
+    assert [sorted(messages) for messages in built_messages(aws)] == [["m0", "m1", "m2"]]
+    assert aws.table.items["proj#pending"]["Pending"] == set()
+
+
+def test_sweep_builds_a_window_whose_leader_failed(aws, monkeypatch):
+    coalescer = codebuild.BuildCoalescer(window=0.2, table_name="t", bucket="b", prefix="p")
+
+    def crash(project, WindowID):
+        raise RuntimeError("leader timed out")
+    monkeypatch.setattr(coalescer, "_lead", crash)
+    start_of_window(0.2)
+    with pytest.raises(RuntimeError):
+        coalescer.trigger("proj", ["m0"])
+    # The other member is acknowledged right away; its window is pending.
+    assert coalescer.trigger("proj", ["m1"])["Leader"] is False
+    assert coalescer.sweep(["proj"]) == 0
+    time.sleep(0.3)
+    assert coalescer.sweep(["proj"]) == 1
+    assert [sorted(messages) for messages in built_messages(aws)] == [["m0", "m1"]]
+    assert coalescer.sweep(["proj"]) == 0
@@ -0,0 +1,67 @@
+import time
+import threading
+
+import pytest
+
+from cloudman_hub.discovery import DiscoveryCache, RoundRobinSelector
+
+Instances = [{'Id': "i-1", 'Host': "10.0.0.1", 'Port': "80"}, {'Id': "i-2", 'Host': "10.0.0.2", 'Port': "80"}]
+
+
+def concurrently(function, count=10):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(function())) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_a_cold_entry_is_fetched_once():
+    calls = []
+
+    def fetch(namespace, service, region):
+        calls.append(service)
+        time.sleep(0.1)
+        return Instances
+    cache = DiscoveryCache(fetch=fetch)
+    assert concurrently(lambda: cache.instances("ns", "svc")) == [Instances] * 10
+    assert calls == ["svc"]
+
+
+def test_a_failed_cold_fetch_is_raised_to_every_waiting_caller():
+    calls = []
+
+    def fetch(namespace, service, region):
+        calls.append(service)
+        time.sleep(0.1)
+        raise RuntimeError("DiscoverInstances failed")
+    cache = DiscoveryCache(fetch=fetch)
+
+    def instances():
+        try:
+            return cache.instances("ns", "svc")
+        except RuntimeError as e:
+            return e
+    assert all(isinstance(result, RuntimeError) for result in concurrently(instances))
+    assert calls == ["svc"]
+    assert cache.fetching == {}
+
+
+def test_stale_entries_are_served_while_one_refresh_runs():
+    calls = []
+
+    def fetch(namespace, service, region):
+        calls.append(service)
+        return Instances
+    cache = DiscoveryCache(fetch=fetch, ttl=0, max_stale=60)
+    cache.instances("ns", "svc")
+    assert concurrently(lambda: cache.instances("ns", "svc")) == [Instances] * 10
+    time.sleep(0.1)
+    assert 2 <= len(calls) <= 11
+
+
+def test_round_robin():
+    selector = RoundRobinSelector()
+    assert [selector.pick("svc", Instances)['Id'] for _ in range(3)] == ["i-1", "i-2", "i-1"]
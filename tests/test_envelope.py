@@ -0,0 +1,55 @@
+import json
+
+from cloudman_hub.envelope import parse, forward, is_envelope, new_envelope, add_hop
+
+
+def test_parse_wraps_plain_messages():
+    Envelope = parse("hello")
+    assert is_envelope(Envelope)
+    assert Envelope["Payload"] == "hello"
+    assert Envelope["Hops"] == []
+
+
+def test_parse_reads_an_encoded_envelope():
+    Original = add_hop(new_envelope({"k": 1}), "HubA", timestamp=1)
+    assert parse(json.dumps(Original)) == Original
+    assert parse(json.dumps(Original).encode('utf-8')) == Original
+
+
+def test_parse_unwraps_transport_wrappers():
+    Original = new_envelope("x")
+    assert parse({"MSG Data": json.dumps(Original)}) == Original
+    assert parse({"message": json.dumps(Original), "source": "aws:lambda"}) == Original
+    assert parse({"Type": "Notification", "TopicArn": "arn", "MessageId": "1",
+                  "Message": json.dumps(Original)}) == Original
+    # Double-encoded JSON text
+    assert parse(json.dumps(json.dumps({"MSG Data": "payload"})))["Payload"] == "payload"
+
+
+def test_parse_keeps_dicts_with_other_fields():
+    Message = {"message": "text", "id": 7}
+    assert parse(Message)["Payload"] == Message
+
+
+def test_forward_appends_a_hop():
+    Envelope, Encoded = forward("hello", "HubA", timestamp=1.5)
+    assert Envelope["Hops"] == [["HubA", 1500]]
+    assert json.loads(Encoded) == Envelope
+    Envelope, Encoded = forward(Encoded, "HubB", timestamp=2)
+    assert [hop[0] for hop in Envelope["Hops"]] == ["HubA", "HubB"]
+    assert Envelope["Payload"] == "hello"
+
+
+def test_forward_stops_loops():
+    Envelope, Encoded = forward("hello", "HubA")
+    Envelope, Encoded = forward(Encoded, "HubB")
+    Envelope, Encoded = forward(Encoded, "HubA")
+    assert Encoded is None
+
+
+def test_forward_stops_at_max_hops():
+    Encoded = json.dumps(new_envelope("hello", max_hops=2))
+    for name in ("HubA", "HubB"):
+        Envelope, Encoded = forward(Encoded, name)
+        assert Encoded is not None
+    assert forward(Encoded, "HubC")[1] is None
@@ -0,0 +1,49 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cloudman_hub import fanout
+from cloudman_hub.fanout import FanOut
+
+
+def test_statuses_and_outputs():
+    release = threading.Event()
+    fan_out = FanOut(timeout=0.2)
+    fan_out.add("ok", "T", lambda: "done")
+    fan_out.add("error", "T", lambda: 1 / 0)
+    fan_out.add("slow", "T", release.wait, 5)
+    try:
+        result = fan_out.run()
+    finally:
+        release.set()
+    Statuses = {entry["Name"]: entry["Status"] for entry in result["Targets"]}
+    assert Statuses == {"ok": "OK", "error": "ERROR", "slow": "TIMEOUT"}
+    assert (result["Succeeded"], result["Failed"], result["TimedOut"]) == (1, 1, 1)
+    assert fan_out.outputs == {("T", "ok"): "done"}
+
+
+def test_queue_deadline_only_gives_up_jobs_without_a_worker(monkeypatch):
+    # One worker, held by a call outside the fan-out for longer than the target timeout.
+    monkeypatch.setattr(fanout, "_Executor", ThreadPoolExecutor(max_workers=1))
+    monkeypatch.setattr(fanout, "MaxWorkers", 1)
+    fanout._Executor.submit(time.sleep, 0.4)
+    fan_out = FanOut(timeout=0.5)
+    fan_out.add("late", "T", time.sleep, 0.3)
+    # Started at 0.4s, after the queue deadline (0.5s) passes it still has its own timeout.
+    assert fan_out.run()["Targets"][0]["Status"] == "OK"
+
+
+def test_a_job_that_never_got_a_worker_does_not_run(monkeypatch):
+    monkeypatch.setattr(fanout, "_Executor", ThreadPoolExecutor(max_workers=1))
+    monkeypatch.setattr(fanout, "MaxWorkers", 1)
+    release = threading.Event()
+    fanout._Executor.submit(release.wait, 5)
+    calls = []
+    fan_out = FanOut(timeout=0.2)
+    fan_out.add("queued", "T", calls.append, 1)
+    try:
+        assert fan_out.run()["Targets"][0]["Status"] == "TIMEOUT"
+    finally:
+        release.set()
+    fanout._Executor.shutdown(wait=True)
+    assert calls == []
@@ -0,0 +1,79 @@
+import io
+import json
+import threading
+
+import pytest
+
+from cloudman_hub import sinks, claimcheck
+from cloudman_hub.sinks import SQSSink, S3Sink, dispatch
+from cloudman_hub.fanout import FanOut
+from cloudman_hub.envelope import forward
+
+Messages = [("r0", "a", "0"), ("r1", "b", "1"), ("r2", "c", "2")]
+
+
+class StubSQS:
+    def __init__(self, rejected=()):
+        self.rejected = set(rejected)
+        self.sent = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.sent.extend(entry['MessageBody'] for entry in Entries)
+        return {'Failed': [{'Id': entry['Id'], 'Code': "InternalError"}
+                           for entry in Entries if entry['MessageBody'] in self.rejected]}
+
+
+class StubS3:
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body
+
+
+class SlowSink(sinks.Sink):
+    kind = "Slow"
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.release = threading.Event()
+
+    def deliver(self, messages):
+        self.release.wait(5)
+        return []
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    stubs = {'sqs': StubSQS(rejected={"b"}), 's3': StubS3()}
+    monkeypatch.setattr(sinks, "get_client", lambda service, region=None: stubs[service])
+    return stubs
+
+
+def test_partial_failure_fails_only_the_rejected_messages(aws):
+    FanOutResult, failed = dispatch([SQSSink("queue", "https://sqs/queue")], Messages, "hub")
+    assert FanOutResult["Succeeded"] == 1
+    assert failed == ["r1"]
+    # The failed message was sent again once (SINK_RETRIES).
+    assert aws['sqs'].sent.count("b") == 2
+    assert aws['sqs'].sent.count("a") == 1
+
+
+def test_a_timed_out_sink_fails_every_message(aws):
+    sink = SlowSink("slow")
+    try:
+        FanOutResult, failed = dispatch([SQSSink("queue", "https://sqs/queue"), sink], Messages, "hub",
+                                        fan_out=FanOut(timeout=0.2))
+    finally:
+        sink.release.set()
+    assert FanOutResult["TimedOut"] == 1
+    assert failed == ["r0", "r1", "r2"]
+
+
+def test_persisting_sinks_store_the_claim_check_document(aws, monkeypatch):
+    Document = {"rows": ["row %d" % i for i in range(100)]}
+    Pointer = {"ClaimCheck": {"Bucket": "staging", "Key": "k", "Codec": "gzip", "Size": 1, "SHA256": "x"}}
+    monkeypatch.setattr(claimcheck, "rehydrate", lambda payload: Document if payload == Pointer else payload)
+    Envelope, Encoded = forward(Pointer, "hub")
+    assert S3Sink("bucket", "hub").send([("r0", Encoded, "0")]) == []
+    assert json.loads(aws['s3'].objects["hub/hub:0.txt"])["Payload"] == Document
@@ -0,0 +1,36 @@
+from cloudman_hub import clients, snapstart
+from cloudman_hub.registry import TargetRegistry
+
+
+class StubClient:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_restore_drops_the_pooled_clients(monkeypatch):
+    pooled = StubClient()
+    monkeypatch.setitem(clients._Clients, ('sqs', None), pooled)
+    snapstart.restore()
+    # Closed, and replaced (with new credentials) on the next get_client.
+    assert pooled.closed
+    assert ('sqs', None) not in clients._Clients
+
+
+class Connection:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_restore_drops_cached_secrets_and_connections():
+    registry = TargetRegistry()
+    connection = registry.get(("rds", "db"), Connection)
+    registry.get(("secrets",), lambda: ["secret"])
+    snapstart.restore(registry)
+    assert connection.closed
+    assert registry.get(("secrets",), lambda: ["new"]) == ["new"]
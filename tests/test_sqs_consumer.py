@@ -0,0 +1,62 @@
+from cloudman_hub.sqs_consumer import SQSConsumer
+
+
+class StubSQS:
+    def __init__(self, not_deleted=()):
+        self.not_deleted = set(not_deleted)
+        self.deleted = []
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.deleted.extend(entry['ReceiptHandle'] for entry in Entries)
+        return {'Failed': [{'Id': entry['Id'], 'Message': "stub"}
+                           for entry in Entries if entry['ReceiptHandle'] in self.not_deleted]}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        return {}
+
+
+def received(count):
+    return [{'MessageId': f"m{i}", 'ReceiptHandle': f"h{i}", 'Body': f"body {i}"} for i in range(count)]
+
+
+def test_deletes_only_the_delivered_messages():
+    sqs = StubSQS()
+    batches = []
+
+    def handler(messages):
+        batches.append(messages)
+        return ["m1"]
+    SQSConsumer(sqs, "https://sqs/queue", "queue", handler).process(received(3))
+    assert batches == [[("m0", "body 0"), ("m1", "body 1"), ("m2", "body 2")]]
+    assert sqs.deleted == ["h0", "h2"]
+
+
+def test_a_failed_batch_is_left_in_the_queue():
+    sqs = StubSQS()
+
+    def handler(messages):
+        raise RuntimeError("targets down")
+    SQSConsumer(sqs, "https://sqs/queue", "queue", handler).process(received(3))
+    assert sqs.deleted == []
+
+
+def test_a_fully_delivered_batch_is_deleted_in_one_call():
+    sqs = StubSQS(not_deleted={"h1"})
+    SQSConsumer(sqs, "https://sqs/queue", "queue", lambda messages: []).process(received(2))
+    assert sqs.deleted == ["h0", "h1"]
+
+
+def test_workers_scale_up_at_once_and_down_one_at_a_time(monkeypatch):
+    from cloudman_hub import sqs_consumer
+    monkeypatch.setattr(sqs_consumer, "SQSMessagesPerWorker", 10)
+    monkeypatch.setattr(sqs_consumer, "SQSMinWorkers", 1)
+    monkeypatch.setattr(sqs_consumer, "SQSMaxWorkers", 8)
+    monkeypatch.setattr(sqs_consumer, "SQSScaleDownPeriods", 2)
+    monkeypatch.setattr(sqs_consumer, "SQSScaleCPULimit", 80)
+    consumer = SQSConsumer(StubSQS(), "https://sqs/queue", "queue", lambda messages: [], workers=1)
+    assert consumer.autoscale is False
+    assert consumer.scale(1000, cpu=10) == 8
+    assert consumer.scale(1000, cpu=90) == 1
+    consumer.workers = 8
+    assert consumer.scale(0, cpu=10) == 8
+    assert consumer.scale(0, cpu=10) == 7